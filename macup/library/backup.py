@@ -1,10 +1,42 @@
 import macup.library.classes as cls
 from macup.library.filter import buildFilter
+from macup.library.scanindex import ScanIndex, indexedScanTree
+from macup.library.changes import ChangeJournal
+from macup.library.copyengine import COPIED, ChunkedCopies, CompressedCopies, CopyEngine, CopyReport, CopyResult, \
+    DEFAULT_COPY_WORKERS, DeltaUpdates, FAILED, SKIPPED, getCopyMode
+from macup.library.hashcache import HashCache, getHashCachePath
+from macup.library.dedup import SnapshotWriter
+from macup.library.delta import SignatureCache, getSignatureCachePath
+from macup.library.directories import DirectoryMaker
+from macup.library.manifest import ManifestWriter
+from macup.library.mirror import deleteStale, planMirror, printPlan
+from macup.library.packing import PackWriter
+from macup.library.scanner import PathEntry, passesFilter, scanAhead, scanTree, shouldDescend
+from macup.library.snapshots import SnapshotFolder
+from macup.library.treestore import TreeStore
 from macup.library.constants import *
 
+import contextlib
 import os
 import re
-import shutil
+
+
+def iterFileTree(ft_node):
+    """
+    Yields every node under a FileTree node, depth first, with each directory before its contents. An explicit stack
+    is used rather than recursion, so deep trees cannot hit the recursion limit.
+
+    :param ft_node: A FileTree object, from which to traverse; it is not yielded itself
+    :return: A generator of FileTree nodes
+    """
+
+    # Children are pushed in reverse, so they are popped in their original order
+    stack = list(reversed(ft_node.children))
+    while stack:
+        node = stack.pop()
+        yield node
+        if node.is_directory:
+            stack.extend(reversed(node.children))
 
 
 def traverseFileTree(ft_node, dir_func=tuple(), file_func=tuple(), use_child_as_parameter=False):
@@ -23,7 +55,7 @@ def traverseFileTree(ft_node, dir_func=tuple(), file_func=tuple(), use_child_as_
         raise ValueError("Both function parameters cannot be empty.")
 
     output = []
-    for child in ft_node.children:
+    for child in iterFileTree(ft_node):
 
         if child.is_directory:  # Decides which function should be used
             function = dir_func if dir_func else file_func
@@ -37,36 +69,45 @@ def traverseFileTree(ft_node, dir_func=tuple(), file_func=tuple(), use_child_as_
 
         output.append(return_val)
 
-        if child.is_directory:  # The recursion must go on!
-            output += traverseFileTree(child, dir_func, file_func, use_child_as_parameter)
-
     return output
 
 
+def partitionItems(ft_node):
+    """
+    Sorts every item in and under a directory into directories and files, in a single pass.
+
+    :param ft_node: A FileTree node to work from, or an iterable of entries from the scanner or a TreeStore
+    :return: A tuple of a list of directories and a list of files, as FileTree nodes (or entries)
+    """
+
+    if isinstance(ft_node, cls.FileTree):
+        items = iterFileTree(ft_node)
+        is_directory = lambda node: node.is_directory
+    else:
+        items = ft_node
+        is_directory = lambda entry: entry.is_dir()
+
+    directories, files = [], []
+    for item in items:
+        (directories if is_directory(item) else files).append(item)
+    return directories, files
+
+
 def getAll(type_, ft_node):
     """
-    Returns a list of directories or files, depending on type, contained in a directory and their descendants.
+    Returns a list of directories or files, depending on type, contained in a directory and their descendants. To get
+    both, use partitionItems, which only walks the tree once.
 
     :param type_: FILES or DIRECTORY
-    :param ft_node: A FileTree node to work from
-    :return: All the FileTree nodes of the type_ in and under the filetree provided
+    :param ft_node: A FileTree node to work from, or an iterable of entries from the scanner or a TreeStore
+    :return: All the FileTree nodes (or entries) of the type_ in and under the filetree provided
     """
 
     if type_ != DIRECTORY and type_ != FILES:
         raise ValueError(f"type_ must be '{DIRECTORY}' or '{FILES}', not '{type_}'")
 
-    def checkIfItem(ft):
-        if type_ == DIRECTORY and ft.is_directory:
-            return ft
-        elif type_ == FILES and not ft.is_directory:
-            return ft
-
-    # Will contain None values
-    unfiltered_items = traverseFileTree(ft_node, dir_func=(checkIfItem,), use_child_as_parameter=True)
-
-    # Removes None values
-    items = list(filter(lambda item: item is not None, unfiltered_items))
-    return items
+    directories, files = partitionItems(ft_node)
+    return directories if type_ == DIRECTORY else files
 
 
 def graftItem(item_path, source, target):
@@ -99,46 +140,370 @@ def graftDirectories(directories, source_dir, target_dir):
 
 def buildDirectories(directories):
     """
-    Ensures all the directories are present, adding ones that are not.
+    Ensures all the directories are present, adding ones that are not. They are made parents first, each with one
+    mkdir (see DirectoryMaker).
 
     :param directories: Collection of directories to make/check
     """
 
-    for directory in directories:
-        os.makedirs(directory, exist_ok=True)
+    DirectoryMaker().makeAll(directories)
 
 
-def copyFiles(files, source_dir, target_dir, overwrite):
+def copyFiles(files, source_dir, target_dir, overwrite, engine=None, mtime_tolerance=0.0, packer=None,
+              link_dest_dir=None, directory_maker=None):
     """
-    Copies the files to the target directory, checking if they already exist, overwriting them if told to.
+    Copies the files to the target directory, handling ones that already exist according to the copy mode. A file
+    that fails to copy doesn't stop the others; the failures are collected in the report returned.
 
     :param source_dir: Source directory; note, this is not the directory the files are in, but the directory from which
     the backup originates from
-    :param overwrite: Boolean value to overwrite already present files or not
+    :param overwrite: The copy mode: SKIP_EXISTING, OVERWRITE, UPDATE (copy only files whose size or modification
+    time differ) or CHECKSUM (copy only files whose size or contents differ); True and False mean OVERWRITE and
+    SKIP_EXISTING
     :param target_dir: Target directory to which files will be copied
     :param files: Iterable collection of file paths to be copied
+    :param engine: A CopyEngine to queue the copies on, in which case they may not have finished on return; if None,
+    the files are copied in parallel and waited for
+    :param mtime_tolerance: In UPDATE mode, how many seconds modification times may differ by and still count as the
+    same, e.g. FAT_MTIME_TOLERANCE for a FAT or exFAT target
+    :param packer: A PackWriter or SnapshotWriter for the target, if its storage format is PACKED or DEDUPLICATED;
+    files it takes are stored in it rather than copied, and the folders of the files that are copied are made as
+    needed
+    :param link_dest_dir: The previous snapshot's folder, if target_dir is a new snapshot; files UPDATE or CHECKSUM
+    mode finds unchanged since it are hard-linked from it rather than copied
+    :param directory_maker: The DirectoryMaker making the folders of the files copied when packing, so each is only
+    made once
+    :return: A CopyReport of the files copied, or the engine's report if one was given
+    """
+
+    copy_mode = getCopyMode(overwrite)
+    if engine is not None:
+        for file in files:
+            target = graftItem(file, source_dir, target_dir)
+            link_dest = None if link_dest_dir is None else graftItem(file, source_dir, link_dest_dir)
+            if packer is None or not _packFile(packer, engine.report, file, target, source_dir, copy_mode,
+                                               mtime_tolerance, directory_maker):
+                engine.submit(file, target, copy_mode, mtime_tolerance, link_dest)
+        return engine.report
+
+    with _openHashCache(target_dir, copy_mode) as hash_cache, CopyEngine(hash_cache=hash_cache) as engine:
+        copyFiles(files, source_dir, target_dir, copy_mode, engine, mtime_tolerance, packer, link_dest_dir,
+                  directory_maker)
+    return engine.report
+
+
+def _packFile(packer, report, file, target, source_dir, copy_mode, mtime_tolerance, directory_maker=None):
+    """
+    Packs a file if the packer takes it, adding the result to the report; otherwise makes sure its target folder
+    exists, as folders aren't built in the target when packing.
+
+    :return: True if the file was handled, False if it is to be copied
+    """
+
+    try:
+        stat = os.stat(file)
+        if not packer.shouldPack(stat):
+            (directory_maker or DirectoryMaker()).make(os.path.dirname(target))
+            return False
+
+        size = packer.packFile(file, os.path.relpath(file, source_dir), stat, copy_mode, mtime_tolerance)
+        if size is None:
+            result = CopyResult(file, target, SKIPPED)
+        else:
+            result = CopyResult(file, target, COPIED, size, backend=packer.backend)
+    except Exception as error:
+        result = CopyResult(file, target, FAILED, error=error)
+    report.add(result)
+    return True
+
+
+def _packDirectory(packer, directory, source_dir):
+    """ Records a folder in the packer's index, unless it has been deleted since it was scanned """
+    try:
+        stat = os.stat(directory)
+    except FileNotFoundError:
+        return
+    packer.addDirectory(os.path.relpath(directory, source_dir), stat)
+
+
+def _openSnapshotFolder(target_dir, storage):
+    """
+    :return: A new SnapshotFolder in the target if the storage format is SNAPSHOTS, otherwise a context manager giving
+    None
+    """
+
+    if storage == SNAPSHOTS:
+        return SnapshotFolder(target_dir)
+    return contextlib.nullcontext()
+
+
+def _openPackWriter(target_dir, storage, source_dir):
+    """
+    :return: A PackWriter for the target if the storage format is PACKED, a SnapshotWriter starting a new snapshot of
+    the source if it is DEDUPLICATED, otherwise a context manager giving None
     """
-    # Generate the new locations for each file
-    new_file_paths = [graftItem(file, source_dir, target_dir) for file in files]
 
-    # Copy files
-    for i, new_file_path in enumerate(new_file_paths):
-        if (not os.path.isfile(new_file_path)) or overwrite:  # If file doesn't exist or overwrite is true:
-            shutil.copy(files[i], new_file_path)
+    if storage == PACKED:
+        return PackWriter(target_dir)
+    if storage == DEDUPLICATED:
+        return SnapshotWriter(target_dir, source_dir)
+    return contextlib.nullcontext()
 
 
-def backup(src_dir, target_dir, filters, overwrite):
+def _openHashCache(target_dir, copy_mode):
+    """ :return: The target's HashCache if the copy mode is CHECKSUM, otherwise a context manager giving None """
+    if copy_mode == CHECKSUM:
+        return HashCache(getHashCachePath(target_dir))
+    return contextlib.nullcontext()
+
+
+def _openSignatureCache(target_dir, storage, delta_threshold):
+    """
+    :return: The target's SignatureCache if files are delta updated and the storage format overwrites the same
+    targets from one backup to the next (MIRROR or PACKED), otherwise a context manager giving None
+    """
+
+    if delta_threshold is not None and storage in (MIRROR, PACKED):
+        return SignatureCache(getSignatureCachePath(target_dir))
+    return contextlib.nullcontext()
+
+
+def _copyStrategies(compression, delta_threshold, signature_cache):
+    """
+    :return: The CopyStrategy objects for the engine, in the order they are tried: compression first, as compressed
+    copies are never patched, then delta updates, then chunked copies of the large files left
+    """
+
+    if compression not in COMPRESSIONS:
+        raise ValueError(f"compression must be one of {COMPRESSIONS}, but got '{compression}'.")
+    strategies = []
+    if compression != NO_COMPRESSION:
+        strategies.append(CompressedCopies(compression))
+    if delta_threshold is not None:
+        strategies.append(DeltaUpdates(delta_threshold, signature_cache))
+    strategies.append(ChunkedCopies())
+    return strategies
+
+
+def _openManifest(target_dir, storage):
+    """
+    :return: A ManifestWriter for the target if the storage format is MIRROR, otherwise a context manager giving None;
+    the other formats keep indexes of their own
+    """
+
+    if storage == MIRROR:
+        return ManifestWriter(target_dir)
+    return contextlib.nullcontext()
+
+
+def _recordDirectory(manifest, entry, target):
+    """ Records a directory made in the target in the manifest, unless its source has been deleted since """
+    try:
+        stat = entry.stat()
+    except FileNotFoundError:
+        return
+    manifest.addDirectory(target, stat)
+
+
+def _scanDirtyPaths(src_dir, dirty_paths, filter_, scan_workers):
+    """
+    Scans only the given paths under the source, and everything under those that are directories. The directories
+    leading to each path are yielded first (once each), and a path is skipped if it or any of them is filtered out.
+    """
+
+    yielded_dirs = set()
+    for dirty_path in dirty_paths:
+        if os.path.normpath(dirty_path) == os.path.normpath(src_dir):
+            yield from scanTree(src_dir, filter_, scan_workers)
+            return
+
+        relative_path = os.path.relpath(dirty_path, src_dir)
+        if relative_path.startswith(os.pardir) or not os.path.lexists(dirty_path):
+            # Outside the source, or deleted
+            continue
+
+        # The directories leading to the path and the path itself, from the top down
+        parts = relative_path.split(os.sep)
+        chain = [PathEntry(os.path.join(src_dir, *parts[:i])) for i in range(1, len(parts) + 1)]
+        if not all(passesFilter(filter_, entry) for entry in chain):
+            continue
+
+        for entry in chain[:-1]:
+            if entry.path not in yielded_dirs:
+                yielded_dirs.add(entry.path)
+                yield entry
+        if chain[-1].path not in yielded_dirs:
+            yield chain[-1]
+            if chain[-1].is_dir() and shouldDescend(filter_, chain[-1]):
+                yielded_dirs.add(chain[-1].path)
+                yield from scanTree(chain[-1].path, filter_, scan_workers)
+
+
+def scanSource(src_dir, filters, scan_workers=1, index_path=None, dirty_paths=None):
+    """
+    Scans the source for the items to back up, through the scan index if one is given.
+
+    :param src_dir: Directory to copy items from
+    :param filters: List of Filter objects
+    :param scan_workers: Number of threads listing the source at the same time; not used with an index
+    :param index_path: Path of a scan index file, or None to scan without one
+    :param dirty_paths: Paths from a change journal; if given, only these are scanned
+    :return: A generator of entries, each directory coming before its contents
+    """
+
+    filter_ = buildFilter(filters)
+    if dirty_paths is not None:
+        yield from _scanDirtyPaths(src_dir, dirty_paths, filter_, scan_workers)
+    elif index_path is None:
+        yield from scanTree(src_dir, filter_, scan_workers)
+    else:
+        with ScanIndex(index_path) as index:
+            yield from indexedScanTree(src_dir, index, filter_)
+
+
+def planBackup(src_dir, filters, scan_workers=1, index_path=None):
+    """
+    Scans the source ahead of a backup into a compact TreeStore, which knows the number and size of the files to be
+    copied before copying starts, and can be passed to backup as its plan.
+
+    :param src_dir: Directory to copy items from
+    :param filters: List of Filter objects
+    :param scan_workers: Number of threads listing the source at the same time
+    :param index_path: Path of a scan index file, or None to scan without one
+    :return: A TreeStore of the items to back up
+    """
+
+    return TreeStore.fromEntries(src_dir, scanSource(src_dir, filters, scan_workers, index_path))
+
+
+def backup(src_dir, target_dir, filters, overwrite, scan_workers=1, plan=None, index_path=None, journal_path=None,
+           copy_workers=DEFAULT_COPY_WORKERS, mtime_tolerance=0.0, progress=None, storage=MIRROR,
+           compression=NO_COMPRESSION, delta_threshold=None, delete_stale=False, dry_run=False):
+    """
+    Copies the items under src_dir that satisfy the filters into target_dir.
+
+    :param src_dir: Directory to copy items from
+    :param target_dir: Directory to copy items to
+    :param filters: List of Filter objects
+    :param overwrite: The copy mode (SKIP_EXISTING, OVERWRITE, UPDATE or CHECKSUM), or whether or not to overwrite
+    already existing files; CHECKSUM keeps a cache of hashes in the target's METADATA_DIR folder
+    :param scan_workers: Number of threads listing the source at the same time; raise it for slow or network volumes
+    :param plan: A TreeStore from planBackup to copy from; if None, the source is scanned while copying
+    :param index_path: Path of a scan index file, so only directories changed since the last run are listed
+    :param journal_path: Path of a change journal; if a watcher has kept it complete since the last backup, only the
+    paths recorded in it are scanned and copied
+    :param copy_workers: Number of threads copying files at the same time
+    :param mtime_tolerance: In UPDATE mode, how many seconds modification times may differ by and still count as the
+    same
+    :param progress: A function called with a source path, the bytes of it copied so far and its size, as files are
+    copied; large files report after each chunk. It is called from the copying threads.
+    :param storage: The storage format, MIRROR, PACKED, DEDUPLICATED or SNAPSHOTS. PACKED packs small files into tar
+    segments in the target's METADATA_DIR folder, to be read back with a PackReader, and copies the rest as MIRROR
+    does. DEDUPLICATED stores every file as chunks shared with other files, runs and sources backed up to the same
+    target, in a new snapshot to be read back with a SnapshotReader. SNAPSHOTS copies into a new dated folder in the
+    target, hard-linking files unchanged since the previous one from it; the copy mode decides what counts as
+    unchanged: CHECKSUM compares contents, OVERWRITE links nothing, and the others compare sizes and modification
+    times. Every snapshot is complete, so the whole source is scanned, even with a change journal.
+    :param compression: How to compress the files copied (a constant from COMPRESSIONS); files that wouldn't shrink
+    are copied as they are, and compression.restoreTree restores the target, decompressing the rest. Files stored
+    as PACKED or DEDUPLICATED aren't compressed.
+    :param delta_threshold: Files at least this many bytes that are copied over an existing target have only their
+    changed blocks written, e.g. delta.DELTA_THRESHOLD; None to rewrite them in full. Signatures of the patched
+    files are kept in the target's METADATA_DIR folder, so unchanged targets needn't be read to be compared.
+    :param delete_stale: Whether to make the target an exact mirror of the source, deleting what is in it but no
+    longer in the source or no longer passes the filters, before copying; only for MIRROR storage. MacUp's own
+    METADATA_DIR folder is kept.
+    :param dry_run: Whether to only print what the backup would add, update and (with delete_stale) delete, as
+    mirror.printPlan does, without changing anything; only for MIRROR storage. Files are compared as UPDATE mode does.
+    :return: A CopyReport; files that failed to copy are listed in its failures, rather than stopping the backup. It
+    is empty for a dry run. A MIRROR backup also writes a manifest of the target (see manifest), which the next
+    backup reads in UPDATE mode rather than looking at the target.
+    """
+
+    if (delete_stale or dry_run) and storage != MIRROR:
+        raise ValueError(f"Mirroring and dry runs need {MIRROR} storage, but got '{storage}'.")
+    if dry_run:
+        printPlan(planMirror(src_dir, target_dir, filters, mtime_tolerance), deletions=delete_stale)
+        return CopyReport()
+
     # todo: progress monitoring
     # todo: exception handling
-    # Build file tree, according to filters
-    source_filetree_node = cls.FileTree(src_dir, buildFilter(filters))
-
-    # Get all the paths of every directory under the source node
-    dir_paths = [dir_filetree.path for dir_filetree in getAll(DIRECTORY, source_filetree_node)]
-    # Build new directories
-    target_dir_paths = graftDirectories(dir_paths, src_dir, target_dir)
-    buildDirectories(target_dir_paths)
-
-    # Get paths of all files to be copied under the source node, then copy them
-    file_paths = [file_filetree.path for file_filetree in getAll(FILES, source_filetree_node)]
-    copyFiles(file_paths, src_dir, target_dir, overwrite)
+    journal = None if journal_path is None else ChangeJournal(journal_path)
+    dirty_paths = None
+    if journal is not None:
+        # The journal is reset before copying, so changes made during the backup are kept for the next one
+        dirty_paths = journal.readAndReset()
+
+    try:
+        # The backup is a pipeline: the scanner runs on a thread of its own, a bounded way ahead of this one, which
+        # builds each directory as it comes and queues files to the copying threads as soon as their directory
+        # exists. Directories are yielded before their contents, so a file's directory is always built first. The
+        # engine only takes so many files at a time, so when copying falls behind this thread waits, the scanner
+        # fills its queue and waits too, and memory stays flat however big the tree. Copying starts with the first
+        # file found, and the scan goes on while files are copied rather than only between submits.
+        if storage not in STORAGE_FORMATS:
+            raise ValueError(f"storage must be one of {STORAGE_FORMATS}, but got '{storage}'.")
+        if plan is None:
+            # A snapshot holds every file, not just the changed ones
+            scan = contextlib.closing(scanAhead(scanSource(src_dir, filters, scan_workers, index_path,
+                                                           None if storage == SNAPSHOTS else dirty_paths)))
+        else:
+            scan = contextlib.nullcontext(plan)
+        copy_mode = getCopyMode(overwrite)
+        # The snapshot is only marked complete once the engine has finished copying into it, and if the backup
+        # fails, the scan is stopped before the engine is waited for
+        with _openSnapshotFolder(target_dir, storage) as snapshot, \
+                _openHashCache(target_dir, copy_mode) as hash_cache, \
+                _openPackWriter(target_dir, storage, src_dir) as packer, \
+                _openSignatureCache(target_dir, storage, delta_threshold) as signature_cache, \
+                _openManifest(target_dir, storage) as manifest, \
+                CopyEngine(copy_workers, hash_cache=hash_cache, progress=progress,
+                           strategies=_copyStrategies(compression, delta_threshold, signature_cache),
+                           manifest=manifest) as engine, \
+                scan as entries:
+            copy_dir, link_dest_dir = target_dir, None
+            # Folders the previous manifest has are taken as existing, without even a mkdir
+            directory_maker = DirectoryMaker(None if manifest is None or manifest.previous is None else
+                                             manifest.previous.knownDirectories())
+            if delete_stale:
+                # Deleted before anything is copied, so their space is free for the copies, and an item whose type
+                # changed, like a file that became a folder, is out of the way
+                deleteStale(target_dir, planMirror(src_dir, target_dir, filters, mtime_tolerance), engine.report,
+                            copy_workers, manifest)
+            if snapshot is not None:
+                copy_dir = snapshot.path
+                link_dest_dir = None if copy_mode == OVERWRITE else snapshot.previous
+                # Copies into a snapshot keep their modification times, so the next snapshot can compare them
+                copy_mode = CHECKSUM if copy_mode == CHECKSUM else UPDATE
+
+            for entry in entries:
+                if not entry.is_dir():
+                    copyFiles([entry.path], src_dir, copy_dir, copy_mode, engine, mtime_tolerance, packer,
+                              link_dest_dir, directory_maker)
+                elif packer is not None:
+                    # Folders are recorded in the packer's index rather than built, so files that are packed make no
+                    # folders in the target at all
+                    _packDirectory(packer, entry.path, src_dir)
+                else:
+                    directory = graftItem(entry.path, src_dir, copy_dir)
+                    try:
+                        directory_maker.make(directory)
+                    except OSError as error:
+                        # The files in it fail too, but the rest of the backup goes on
+                        engine.report.add(CopyResult(entry.path, directory, FAILED, error=error))
+                        continue
+                    if manifest is not None:
+                        if directory_maker.missing_known:
+                            # The previous manifest has folders that are missing from the target
+                            manifest.distrust()
+                        _recordDirectory(manifest, entry, directory)
+    except BaseException:
+        if journal is not None:
+            # Whatever this backup was meant to cover still needs backing up next time
+            journal.record([src_dir] if dirty_paths is None else dirty_paths)
+        raise
+
+    if journal is not None:
+        # Files that failed are tried again next time
+        journal.record([failure.source for failure in engine.report.failures])
+    return engine.report
@@ -0,0 +1,196 @@
+"""
+Batch evaluation of filters over many paths at once. Rather than testing keywords and regexes one by one, all the
+keywords of a kind are looked for in a single pass, and compatible blacklist regexes are merged into one pattern.
+The results are the same as applyFilters gives for each path.
+"""
+
+from macup.library.constants import *
+from macup.library.filter import directoryWhitelistTest, metadataTest
+
+import os
+import re
+
+# Patterns using these can't be merged, as merging renumbers groups or moves inline flags away from the start
+_UNMERGEABLE_REGEX = re.compile(r"\\\d|\(\?P=|\(\?[aiLmsux]+\)")
+
+
+class KeywordSet:
+    """
+    Finds which of a set of keywords occur in a string with one combined pattern, in a single pass over the string.
+    A lookahead finds the longest keyword starting at every position, and every keyword contained in a keyword found
+    is also present, which covers keywords that overlap or are inside each other.
+    """
+
+    def __init__(self, keywords):
+        """
+        :param keywords: The keywords to look for
+        """
+
+        self.keywords = frozenset(keywords)
+        self._has_empty = "" in self.keywords
+        non_empty = sorted((keyword for keyword in self.keywords if keyword), key=len, reverse=True)
+
+        self._pattern = None
+        if non_empty:
+            # Alternatives are tried in order, so longest first finds the longest keyword at each position
+            self._pattern = re.compile("(?=(" + "|".join(map(re.escape, non_empty)) + "))")
+        self._contained = {keyword: frozenset(other for other in self.keywords if other in keyword)
+                           for keyword in non_empty}
+
+    def containsAny(self, string):
+        """ :return: True if any of the keywords is in the string """
+        return self._has_empty or (self._pattern is not None and self._pattern.search(string) is not None)
+
+    def find(self, string):
+        """ :return: The set of keywords in the string """
+        found = {""} if self._has_empty else set()
+        if self._pattern is not None:
+            for match in self._pattern.finditer(string):
+                found |= self._contained[match.group(1)]
+        return found
+
+    def containsAll(self, string):
+        """ :return: True if every keyword is in the string """
+        return len(self.find(string)) == len(self.keywords)
+
+
+def mergeRegexes(patterns):
+    """
+    Merges regexes into as few compiled patterns as possible, such that a string matches (with re.match) one of the
+    merged patterns exactly when it matches one of the originals. Each original is a named group, r0, r1, ..., so the
+    one that matched can be found.
+
+    :param patterns: List of regex patterns
+    :return: A list of (compiled pattern, list of the indices in patterns it covers) tuples
+    """
+
+    mergeable = [i for i, pattern in enumerate(patterns) if not _UNMERGEABLE_REGEX.search(pattern)]
+    merged = []
+    if len(mergeable) > 1:
+        try:
+            combined = "|".join(f"(?P<r{i}>{patterns[i]})" for i in mergeable)
+            merged.append((re.compile(combined), mergeable))
+        except re.error:
+            # E.g. two patterns defining the same group name; they are compiled one by one instead
+            mergeable = []
+    else:
+        mergeable = []
+
+    merged += [(re.compile(pattern), [i]) for i, pattern in enumerate(patterns) if i not in mergeable]
+    return merged
+
+
+class _RuleGroup:
+    """
+    The tests of the rules that apply to one item type, with keywords and compatible regexes batched together.
+    """
+
+    def __init__(self, filters, is_directory):
+        self.tests = []  # List of (applies to filename, test function returning whether the item may be copied)
+        self.metadata_tests = []  # List of (test function of a stat result, whitelist)
+        for application in (FILENAMES, PATHS):
+            rules = [filter_ for filter_ in filters if filter_.application == application]
+            on_filename = application == FILENAMES
+
+            blacklist_keywords = [rule.data for rule in rules if rule.filter_type == KEYWORD and not rule.whitelist]
+            if blacklist_keywords:
+                keyword_set = KeywordSet(blacklist_keywords)
+                self.tests.append((on_filename, lambda string, ks=keyword_set: not ks.containsAny(string)))
+
+            whitelist_keywords = [rule.data for rule in rules if rule.filter_type == KEYWORD and rule.whitelist]
+            if whitelist_keywords:
+                keyword_set = KeywordSet(whitelist_keywords)
+                self.tests.append((on_filename, keyword_set.containsAll))
+
+            blacklist_regexes = [rule.data for rule in rules if rule.filter_type == REGEX and not rule.whitelist]
+            for pattern, _ in mergeRegexes(blacklist_regexes):
+                self.tests.append((on_filename, lambda string, match=pattern.match: match(string) is None))
+
+            # Whitelist regexes must all match, which one combined pattern can't tell
+            for rule in rules:
+                if rule.filter_type == REGEX and rule.whitelist:
+                    if is_directory and not on_filename:
+                        # Directories leading to what it matches pass too
+                        self.tests.append((on_filename, directoryWhitelistTest(rule.data)))
+                        continue
+                    self.tests.append((on_filename,
+                                       lambda string, match=re.compile(rule.data).match: match(string) is not None))
+
+        # Metadata filters can't be batched, but they are only checked once the cheaper tests have passed
+        for rule in filters:
+            # A directory's own size and modification time say nothing about what is in it
+            if rule.filter_type in METADATA_FILTER_TYPES and not is_directory:
+                self.metadata_tests.append((metadataTest(rule), rule.whitelist))
+
+    def accepts(self, path):
+        name = None
+        for applies_to_filename, test in self.tests:
+            if applies_to_filename:
+                if name is None:
+                    name = os.path.basename(path)
+                if not test(name):
+                    return False
+            elif not test(path):
+                return False
+
+        if self.metadata_tests:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                return True
+            return all(test(stat) is whitelist for test, whitelist in self.metadata_tests)
+        return True
+
+
+class BatchFilter:
+    """
+    Filters prepared for evaluating over batches of paths.
+    """
+
+    def __init__(self, filters):
+        """
+        :param filters: List of Filter objects
+        """
+
+        self.filters = list(filters)
+        self._directory_group = _RuleGroup([rule for rule in self.filters if rule.item_type != FILES], True)
+        self._file_group = _RuleGroup([rule for rule in self.filters if rule.item_type != DIRECTORY], False)
+
+    def evaluate(self, paths, types=None):
+        """
+        :param paths: A list of paths
+        :param types: A list of (is directory, is file) tuples for the paths, e.g. from the scanner; if None, each
+        path is checked once
+        :return: A list of booleans, True for each path that satisfies all the filters
+        """
+
+        if types is None:
+            types = []
+            for path in paths:
+                is_directory = os.path.isdir(path)
+                types.append((is_directory, not is_directory and os.path.isfile(path)))
+
+        results = []
+        for path, (is_directory, is_file) in zip(paths, types):
+            if is_directory:
+                results.append(self._directory_group.accepts(path))
+            elif is_file:
+                results.append(self._file_group.accepts(path))
+            else:
+                # Items that are neither (e.g. missing paths) are not affected by any filter
+                results.append(True)
+        return results
+
+
+def applyFiltersBatch(filters, paths, types=None):
+    """
+    Checks which of a list of paths satisfy all the filters provided, giving the same results as calling
+    applyFilters on each path.
+
+    :param filters: List of filters to be applied
+    :param paths: A list of paths
+    :param types: A list of (is directory, is file) tuples for the paths; if None, each path is checked once
+    :return: A list of booleans, True for each path that satisfies all the filters
+    """
+
+    return BatchFilter(filters).evaluate(paths, types)
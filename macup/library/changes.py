@@ -0,0 +1,422 @@
+"""
+Change sources, which watch a source directory and record which paths changed into a journal, so the next backup
+only has to scan and copy those paths.
+
+A change source is a ChangeSource subclass; getChangeSource picks the best one for the platform. A macOS FSEvents
+backend can be added by subclassing ChangeSource and listing it in CHANGE_SOURCES.
+"""
+
+from abc import ABC, abstractmethod
+
+import argparse
+import contextlib
+import ctypes
+import ctypes.util
+import fcntl
+import json
+import os
+import select
+import struct
+import sys
+import threading
+import time
+
+from macup.library.config import getConfigDataPath, loadConfig
+from macup.library.scanner import scanTree
+
+DEFAULT_POLL_INTERVAL = 1.0
+
+# Journal markers
+_BACKUP_MARKER = "#backup"
+_START_MARKER = "#start"
+_WATCHING_MARKER = "#watching"  # Written by a reset while a watcher is running
+_STOP_MARKER = "#stop"
+
+
+class ChangeSource(ABC):
+    """
+    Base class of change sources. Subclasses must implement start, stop and poll.
+    """
+
+    def __init__(self, root):
+        """
+        :param root: The directory to watch
+        """
+
+        self.root = root
+
+    @classmethod
+    def isAvailable(cls):
+        """ :return: True if this kind of change source works on this platform """
+        return False
+
+    @abstractmethod
+    def start(self):
+        """ Starts watching; changes from then on are reported by poll """
+
+    @abstractmethod
+    def stop(self):
+        """ Stops watching and releases any resources """
+
+    @abstractmethod
+    def poll(self, timeout=0.0):
+        """
+        Waits up to timeout seconds for changes, then returns the paths that changed since the last poll. A changed
+        directory path means anything under it may have changed.
+
+        :param timeout: The longest time to wait, in seconds
+        :return: A set of paths
+        """
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+
+class PollingChangeSource(ChangeSource):
+    """
+    A portable change source that takes a snapshot of the metadata of every item and compares it with a fresh one on
+    each poll. It costs a full scan per poll, but works everywhere.
+    """
+
+    def __init__(self, root):
+        super().__init__(root)
+        self.snapshot = {}
+
+    @classmethod
+    def isAvailable(cls):
+        return True
+
+    def _takeSnapshot(self):
+        snapshot = {}
+        for entry in scanTree(self.root):
+            try:
+                stat = entry.stat()
+                snapshot[entry.path] = (entry.is_dir(), stat.st_size, stat.st_mtime_ns, stat.st_ino)
+            except OSError:
+                # Removed while scanning; the next poll reports it
+                pass
+        return snapshot
+
+    def start(self):
+        self.snapshot = self._takeSnapshot()
+
+    def stop(self):
+        self.snapshot = {}
+
+    def poll(self, timeout=0.0):
+        time.sleep(timeout)
+        snapshot = self._takeSnapshot()
+        dirty = snapshot.keys() ^ self.snapshot.keys()
+        dirty.update(path for path in snapshot.keys() & self.snapshot.keys() if snapshot[path] != self.snapshot[path])
+        self.snapshot = snapshot
+        return dirty
+
+
+class InotifyChangeSource(ChangeSource):
+    """
+    A Linux change source using inotify, with a watch on every directory under the root. New directories are watched
+    as they appear. If the kernel's event queue overflows, the whole root is reported as changed.
+    """
+
+    _IN_MODIFY = 0x2
+    _IN_ATTRIB = 0x4
+    _IN_CLOSE_WRITE = 0x8
+    _IN_MOVED_FROM = 0x40
+    _IN_MOVED_TO = 0x80
+    _IN_CREATE = 0x100
+    _IN_DELETE = 0x200
+    _IN_DELETE_SELF = 0x400
+    _IN_MOVE_SELF = 0x800
+    _IN_Q_OVERFLOW = 0x4000
+    _IN_IGNORED = 0x8000
+    _IN_ONLYDIR = 0x1000000
+    _IN_ISDIR = 0x40000000
+
+    _WATCH_MASK = (_IN_MODIFY | _IN_ATTRIB | _IN_CLOSE_WRITE | _IN_MOVED_FROM | _IN_MOVED_TO | _IN_CREATE |
+                   _IN_DELETE | _IN_DELETE_SELF | _IN_MOVE_SELF | _IN_ONLYDIR)
+
+    _EVENT_HEADER = struct.Struct("iIII")
+
+    def __init__(self, root):
+        super().__init__(root)
+        self.fd = None
+        self.watches = {}  # Watch descriptor -> directory path
+        self._libc = None
+
+    @classmethod
+    def isAvailable(cls):
+        return sys.platform.startswith("linux") and cls._loadLibc() is not None
+
+    @staticmethod
+    def _loadLibc():
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+            libc.inotify_init1, libc.inotify_add_watch, libc.inotify_rm_watch
+        except (OSError, AttributeError):
+            return None
+        return libc
+
+    def start(self):
+        self._libc = self._loadLibc()
+        if self._libc is None:
+            raise OSError("inotify is not available on this system")
+
+        self.fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        self._watchTree(self.root)
+
+    def stop(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+            self.watches = {}
+
+    def _watch(self, path):
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), self._WATCH_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, f"Could not watch {path}: {os.strerror(error)}")
+        self.watches[wd] = path
+
+    def _watchTree(self, path):
+        self._watch(path)
+        for entry in scanTree(path):
+            if entry.is_dir():
+                self._watch(entry.path)
+
+    def poll(self, timeout=0.0):
+        dirty = set()
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return dirty
+
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                break
+
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = self._EVENT_HEADER.unpack_from(data, offset)
+                offset += self._EVENT_HEADER.size
+                name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+                offset += length
+                self._handleEvent(wd, mask, name, dirty)
+
+        return dirty
+
+    def _handleEvent(self, wd, mask, name, dirty):
+        if mask & self._IN_Q_OVERFLOW:
+            # Events were lost, so anything could have changed
+            dirty.add(self.root)
+            return
+
+        directory = self.watches.get(wd)
+        if directory is None:
+            return
+        if mask & self._IN_IGNORED:
+            # The watch was removed, because the directory was deleted or moved away
+            del self.watches[wd]
+            return
+
+        path = os.path.join(directory, name) if name else directory
+        dirty.add(path)
+
+        if mask & self._IN_ISDIR and mask & (self._IN_CREATE | self._IN_MOVED_TO):
+            # Anything created in the new directory before it was watched was missed, but the whole directory is
+            # already dirty
+            try:
+                self._watchTree(path)
+            except OSError:
+                # Removed again straight away
+                pass
+
+
+CHANGE_SOURCES = [InotifyChangeSource, PollingChangeSource]
+
+
+def getChangeSource(root):
+    """
+    :param root: The directory to watch
+    :return: A change source for root, of the first kind in CHANGE_SOURCES available on this platform
+    """
+
+    for change_source in CHANGE_SOURCES:
+        if change_source.isAvailable():
+            return change_source(root)
+
+
+def getJournalPath(config_name, json_path):
+    """ Returns where the change journal of a configuration is kept: in a "journals" folder next to the json file """
+    return getConfigDataPath(config_name, json_path, "journals", ".journal")
+
+
+def collapsePaths(paths):
+    """
+    Removes every path that is inside another path in the collection.
+
+    :param paths: A collection of paths
+    :return: A sorted list of the remaining paths
+    """
+
+    collapsed = []
+    # Sorting by components puts every directory immediately before the paths inside it
+    for path in sorted(paths, key=lambda path_: path_.split(os.sep)):
+        if not collapsed or not path.startswith(collapsed[-1].rstrip(os.sep) + os.sep):
+            collapsed.append(path)
+    return collapsed
+
+
+class ChangeJournal:
+    """
+    An append-only text file of the paths that changed since the last backup. It also records when a watcher starts
+    and stops, so that a journal with gaps, when nothing was watching, is never trusted.
+
+    The watcher and the backup are usually different processes, so every write, and a backup's read and reset, hold
+    an exclusive flock on a lock file next to the journal.
+    """
+
+    def __init__(self, journal_path):
+        """
+        :param journal_path: Path of the journal file; it is created when first written to
+        """
+
+        self.journal_path = journal_path
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def _locked(self):
+        # flock only excludes other open files, so the thread lock still keeps this object's threads apart
+        with self._lock:
+            os.makedirs(os.path.dirname(os.path.abspath(self.journal_path)), exist_ok=True)
+            with open(self.journal_path + ".lock", "a") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                yield
+
+    def _append(self, lines):
+        with self._locked():
+            with open(self.journal_path, "a", encoding="utf-8") as f:
+                f.writelines(line + "\n" for line in lines)
+
+    def record(self, paths):
+        """ Records paths as changed """
+        if paths:
+            self._append("+" + json.dumps(path) for path in paths)
+
+    def markStarted(self):
+        """ Records that a watcher started, in this process """
+        self._append([f"{_START_MARKER} {os.getpid()}"])
+
+    def markStopped(self):
+        """ Records that the watcher stopped """
+        self._append([_STOP_MARKER])
+
+    def _readLines(self):
+        try:
+            with open(self.journal_path, "r", encoding="utf-8") as f:
+                return f.read().splitlines()
+        except FileNotFoundError:
+            return []
+
+    @staticmethod
+    def _isWatcherRunning(lines):
+        # The last marker tells whether a watcher is running, as long as its process is still alive
+        for line in reversed(lines):
+            if line.startswith(_STOP_MARKER):
+                return False
+            if line.startswith((_START_MARKER, _WATCHING_MARKER)):
+                pid = int(line.split()[1])
+                try:
+                    os.kill(pid, 0)
+                except ProcessLookupError:
+                    return False
+                except PermissionError:
+                    pass
+                return True
+        return False
+
+    def _parse(self, lines):
+        # A complete journal starts at a backup with a watcher already running, and the watcher has been running
+        # since. A watcher that only started after the backup may have missed changes made in between.
+        if lines[:1] != [_BACKUP_MARKER] or len(lines) < 2 or not lines[1].startswith(_WATCHING_MARKER):
+            return None
+        if any(line.startswith("#") for line in lines[2:]) or not self._isWatcherRunning(lines):
+            return None
+
+        return collapsePaths({json.loads(line[1:]) for line in lines[2:]})
+
+    def _reset(self, lines):
+        new_lines = [_BACKUP_MARKER]
+        if self._isWatcherRunning(lines):
+            marker = next(line for line in reversed(lines) if line.startswith((_START_MARKER, _WATCHING_MARKER)))
+            new_lines.append(f"{_WATCHING_MARKER} {marker.split()[1]}")
+        with open(self.journal_path, "w", encoding="utf-8") as f:
+            f.writelines(line + "\n" for line in new_lines)
+
+    def read(self):
+        """
+        :return: The changed paths, collapsed so none is inside another, or None if the journal can't be trusted
+        because nothing was watching for some of the time since the last backup
+        """
+
+        with self._locked():
+            return self._parse(self._readLines())
+
+    def reset(self):
+        """ Empties the journal after a backup, keeping note of a watcher that is still running """
+        with self._locked():
+            self._reset(self._readLines())
+
+    def readAndReset(self):
+        """
+        Reads the journal and empties it in one go, so no change recorded in between is lost, as it would be between
+        a read and a reset.
+
+        :return: What read returns
+        """
+
+        with self._locked():
+            lines = self._readLines()
+            self._reset(lines)
+            return self._parse(lines)
+
+
+def runWatcher(root, journal, stop_event=None, interval=DEFAULT_POLL_INTERVAL, change_source=None):
+    """
+    Watches root and records changes into the journal until stop_event is set.
+
+    :param root: The directory to watch
+    :param journal: A ChangeJournal
+    :param stop_event: A threading.Event that stops the watcher; it runs forever if None
+    :param interval: How often to check for changes, in seconds
+    :param change_source: The ChangeSource to use; picked by getChangeSource if None
+    """
+
+    change_source = getChangeSource(root) if change_source is None else change_source
+    with change_source:
+        journal.markStarted()
+        try:
+            while stop_event is None or not stop_event.is_set():
+                journal.record(change_source.poll(interval))
+        finally:
+            journal.markStopped()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Watch the source of a MacUp configuration for changes.")
+    parser.add_argument("config_name", help="The configuration to watch")
+    parser.add_argument("json_path", help="The json file the configuration is stored in")
+    args = parser.parse_args()
+
+    config = loadConfig(args.config_name, args.json_path)
+    try:
+        runWatcher(config.source_dir, ChangeJournal(getJournalPath(config.name, args.json_path)))
+    except KeyboardInterrupt:
+        pass
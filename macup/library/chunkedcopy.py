@@ -0,0 +1,215 @@
+"""
+Copying of large files in chunks, with progress reports and checkpoints, so an interrupted copy can carry on where it
+left off instead of starting again.
+
+The data is written to a partial file next to the target, which only replaces the target once it is complete. Every
+so often the partial file is synced to disk and a checkpoint is written beside it, recording how far the copy got
+and what the source looked like. A later copy of the same, unchanged source compares the last chunk before the
+checkpoint with the source, and if it matches, continues from there.
+"""
+
+import errno
+import json
+import os
+import stat
+
+from macup.library.constants import *
+
+LARGE_FILE_THRESHOLD = 256 * 1024 * 1024  # Files at least this big are copied in chunks
+DEFAULT_CHUNK_SIZE = 16 * 1024 * 1024
+DEFAULT_CHECKPOINT_INTERVAL = 256 * 1024 * 1024  # Bytes copied between checkpoints; each one syncs the partial file
+
+PARTIAL_SUFFIX = ".macup-partial"
+CHECKPOINT_SUFFIX = ".macup-checkpoint"
+
+CHUNKED = 'CHUNKED'  # The copy backend name reported for files copied in chunks
+
+_COMPARE_BUFFER_SIZE = 1024 * 1024
+_UNSUPPORTED_ERRORS = {errno.ENOSYS, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EXDEV, errno.EINVAL, errno.EBADF}
+
+
+def getPartialPath(target):
+    """ :return: The path the data of a target is written to until it is complete """
+    return target + PARTIAL_SUFFIX
+
+
+def getCheckpointPath(target):
+    """ :return: The path of the checkpoint of a target's partial copy """
+    return target + CHECKPOINT_SUFFIX
+
+
+def _sourceIdentity(source_stat):
+    return [source_stat.st_size, source_stat.st_mtime_ns, source_stat.st_ino]
+
+
+def _readCheckpoint(target, source, source_stat):
+    """ :return: The offset a copy can resume from, or 0 if it must start again """
+    try:
+        with open(getCheckpointPath(target), "r", encoding="utf-8") as f:
+            checkpoint = json.load(f)
+        partial_size = os.stat(getPartialPath(target)).st_size
+    except (OSError, ValueError):
+        return 0
+
+    if checkpoint.get("source") != source or checkpoint.get("identity") != _sourceIdentity(source_stat):
+        # The source has changed since, so the partial copy is of something else
+        return 0
+    offset = checkpoint.get("offset", 0)
+    if not isinstance(offset, int) or not 0 < offset <= min(partial_size, source_stat.st_size):
+        return 0
+    return offset
+
+
+def _writeCheckpoint(target, source, source_stat, offset):
+    # Written to a temporary file and renamed, so a crash can't leave half a checkpoint
+    checkpoint_path = getCheckpointPath(target)
+    with open(checkpoint_path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump({"source": source, "identity": _sourceIdentity(source_stat), "offset": offset}, f)
+    os.replace(checkpoint_path + ".tmp", checkpoint_path)
+
+
+def _rangesMatch(source_fd, partial_fd, start, end):
+    """ :return: True if the two files have the same bytes between start and end """
+    position = start
+    while position < end:
+        length = min(_COMPARE_BUFFER_SIZE, end - position)
+        if os.pread(source_fd, length, position) != os.pread(partial_fd, length, position):
+            return False
+        position += length
+    return True
+
+
+def _copyRange(source_fd, target_fd, offset, length, use_kernel):
+    """
+    Copies length bytes at offset from one file to the same offset in the other, in the kernel if use_kernel is
+    True and copy_file_range works.
+
+    :return: A tuple of the bytes copied (fewer than length at the end of the source), and whether the kernel can
+    still be used
+    """
+
+    copied = 0
+    if use_kernel:
+        try:
+            while copied < length:
+                sent = os.copy_file_range(source_fd, target_fd, length - copied, offset + copied, offset + copied)
+                if sent == 0:
+                    # Either the end of the source, or a filesystem where copy_file_range returns 0 without copying
+                    # anything; reading the rest tells which
+                    use_kernel = False
+                    break
+                copied += sent
+        except OSError as error:
+            if error.errno not in _UNSUPPORTED_ERRORS:
+                raise
+            use_kernel = False
+
+    while copied < length:
+        data = os.pread(source_fd, min(length - copied, _COMPARE_BUFFER_SIZE), offset + copied)
+        if not data:
+            break
+        written = 0
+        while written < len(data):
+            written += os.pwrite(target_fd, data[written:], offset + copied + written)
+        copied += len(data)
+    return copied, use_kernel
+
+
+def copyLargeFile(source_fd, source_stat, source, target, copy_mode, chunk_size=DEFAULT_CHUNK_SIZE,
+                  checkpoint_interval=DEFAULT_CHECKPOINT_INTERVAL, progress=None):
+    """
+    Copies a file in chunks through a partial file, resuming an earlier interrupted copy of it if there is one.
+
+    :param source_fd: A file descriptor of the source, open for reading
+    :param source_stat: The fstat result of source_fd
+    :param source: The source path
+    :param target: The target path
+    :param copy_mode: SKIP_EXISTING, OVERWRITE, UPDATE or CHECKSUM; with SKIP_EXISTING, an existing target is never
+    replaced, and with UPDATE, the copy gets the source's modification time
+    :param chunk_size: The number of bytes copied between progress reports
+    :param checkpoint_interval: The number of bytes copied between checkpoints
+    :param progress: A function called after each chunk with the source path, the bytes copied so far (including any
+    resumed from) and the total size
+    :return: A tuple of the number of bytes copied in total, the offset the copy resumed from (0 if it started
+    afresh), and whether the target was actually written; False if, with SKIP_EXISTING, it turned out to exist
+    """
+
+    size = source_stat.st_size
+    mode = stat.S_IMODE(source_stat.st_mode)
+    partial_path = getPartialPath(target)
+
+    resumed_from = offset = _readCheckpoint(target, source, source_stat)
+    # The owner can always write the partial file, so it can be resumed; it gets the source's mode once complete
+    partial_fd = os.open(partial_path, os.O_RDWR | os.O_CREAT | (0 if offset else os.O_TRUNC),
+                         mode | stat.S_IRUSR | stat.S_IWUSR)
+    try:
+        if offset:
+            # The checkpoint is only trusted if the last chunk before it really is the source's data
+            if _rangesMatch(source_fd, partial_fd, max(0, offset - chunk_size), offset):
+                os.ftruncate(partial_fd, offset)
+            else:
+                resumed_from = offset = 0
+                os.ftruncate(partial_fd, 0)
+
+        use_kernel = hasattr(os, "copy_file_range")
+        last_checkpoint = offset
+        while offset < size:
+            copied, use_kernel = _copyRange(source_fd, partial_fd, offset, min(chunk_size, size - offset), use_kernel)
+            if copied == 0:
+                break
+            offset += copied
+            if offset - last_checkpoint >= checkpoint_interval and offset < size:
+                os.fsync(partial_fd)
+                _writeCheckpoint(target, source, source_stat, offset)
+                last_checkpoint = offset
+            if progress is not None:
+                progress(source, offset, size)
+
+        if offset < size:
+            # The source shrank while it was being copied, or couldn't be read to the end; the target is left as it
+            # was, and the partial copy can be resumed if the source turns out not to have changed
+            os.fsync(partial_fd)
+            _writeCheckpoint(target, source, source_stat, offset)
+            raise OSError(errno.EIO, f"Only {offset} of the source's {size} bytes could be read")
+
+        os.fchmod(partial_fd, mode)
+        if copy_mode == UPDATE:
+            os.utime(partial_fd if os.utime in os.supports_fd else partial_path,
+                     ns=(source_stat.st_atime_ns, source_stat.st_mtime_ns))
+    finally:
+        os.close(partial_fd)
+
+    written = _finishPartial(partial_path, target, copy_mode)
+    try:
+        os.remove(getCheckpointPath(target))
+    except FileNotFoundError:
+        pass
+    return offset, resumed_from, written
+
+
+def _finishPartial(partial_path, target, copy_mode):
+    """
+    Moves a complete partial file into place.
+
+    :return: False if it wasn't moved, because the target exists and SKIP_EXISTING says not to replace it
+    """
+
+    if copy_mode != SKIP_EXISTING:
+        os.replace(partial_path, target)
+        return True
+
+    # A hard link fails if the target exists, so it can't replace a file created since the copy started
+    try:
+        os.link(partial_path, target)
+    except FileExistsError:
+        os.remove(partial_path)
+        return False
+    except OSError:
+        # The filesystem doesn't support hard links
+        if os.path.lexists(target):
+            os.remove(partial_path)
+            return False
+        os.replace(partial_path, target)
+        return True
+    os.remove(partial_path)
+    return True
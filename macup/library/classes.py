@@ -1,39 +1,39 @@
 import os
 from macup.library.constants import *
-from macup.library.filter import parseDictToFilter
+from macup.library.filter import metadataTest, parseDictToFilter
+from macup.library.scanner import scanTree
 
 class FileTree:
     """
     Stores important data about files or folders, and generates a file tree according to a filter provided.
     """
 
-    def __init__(self, path, filter_=None, do_recursion=True):
+    def __init__(self, path, filter_=None, do_recursion=True, is_directory=None):
         """
         :param path: The full path of a folder or file.
         :param filter_: A function that returns a boolean result if a path matches a certain criteria. All values are
         returned if left empty or passed None.
+        :param do_recursion: Whether to build the tree under this node, if it is a directory.
+        :param is_directory: Whether the path is a directory, if already known; it is checked if left as None.
         """
 
         self.path = os.path.abspath(path)
         self.name = os.path.basename(path)
-        self.is_directory = os.path.isdir(path)
+        self.is_directory = os.path.isdir(path) if is_directory is None else is_directory
         self.children = []
         self.filter = filter_
         if self.is_directory and do_recursion:
-            # If the file is a folder, create a list of FileTree objects of the files children.
-            # This is done by getting the names of files in the folder, and adding the path of the current folder.
-            # This results in the full path of each file in the folder.
-            child_paths = [os.path.join(path, child_name) for child_name in os.listdir(path)]
-
-            # By filtering the paths to be used according to a function, files can be whitelisted or blacklisted.
-            for child_path in child_paths:
-                # If filter_ is None, the clause shorts, so filter_ is not called
-                if filter_ is None or filter_(child_path):
-                    # By recursively calling the FileTree constructor, a file tree made of FileTree classes is built.
-                    self.children.append(FileTree(child_path, filter_))
+            # The tree is a materialized view of the scanner's output. The scanner yields every directory before its
+            # contents, so each item's parent node already exists by the time the item is reached.
+            nodes = {self.path: self}
+            for entry in scanTree(self.path, filter_):
+                node = FileTree(entry.path, filter_, do_recursion=False, is_directory=entry.is_dir())
+                nodes[os.path.dirname(entry.path)].children.append(node)
+                if node.is_directory:
+                    nodes[node.path] = node
 
     def __repr__(self):
-        return f"{self.__class__.__name__}(path={self.path}, filter_={self.filter.__name__ if self.filter else None})"
+        return f"{self.__class__.__name__}(path={self.path}, filter_={getattr(self.filter, '__name__', self.filter)})"
 
 
 class Filter:
@@ -45,16 +45,19 @@ class Filter:
         """
         :param name: The name of the filter
         :param filter_type: The type of the filter (a constant from "library.constants")
-        :param data: The data for the filter
-        :param application: Whether the filter applies to the entire path or just the filename (a constant)
-        :param item_type: Whether the filter is applied to just files, just directories, or both (a constant)
+        :param data: The data for the filter; for metadata filter types, a size (e.g. "500MB"), a date (e.g.
+        "2024-01-31") or an age (e.g. "30d")
+        :param application: Whether the filter applies to the entire path or just the filename (a constant); metadata
+        filters apply to the item itself, so ignore it
+        :param item_type: Whether the filter is applied to just files, just directories, or both (a constant);
+        metadata filters only apply to files, so can't be for just directories
         :param whitelist: True means the file is to be copied if it matches this filter
         """
 
         # Validate filter type
-        valid_filter_types = (REGEX, KEYWORD)
+        valid_filter_types = (REGEX, KEYWORD) + METADATA_FILTER_TYPES
         if filter_type not in valid_filter_types:
-            raise ValueError(f"application value must be one of {valid_filter_types}, but got '{filter_type}'.")
+            raise ValueError(f"filter_type value must be one of {valid_filter_types}, but got '{filter_type}'.")
 
         # Validate application
         valid_applications = (FILENAMES, PATHS)
@@ -65,6 +68,9 @@ class Filter:
         valid_item_types = (FILES, DIRECTORY, BOTH)
         if item_type not in valid_item_types:
             raise ValueError(f"item_type value must be one of {valid_item_types}, but got '{item_type}'.")
+        # A directory's own size and modification time say nothing about what is in it, so they aren't filtered on
+        if filter_type in METADATA_FILTER_TYPES and item_type == DIRECTORY:
+            raise ValueError(f"'{filter_type}' filters only apply to files, so item_type can't be '{DIRECTORY}'.")
 
         self.name = str(name)
         self.filter_type = filter_type
@@ -73,6 +79,10 @@ class Filter:
         self.item_type = item_type
         self.whitelist = bool(whitelist)
 
+        # Validate data of metadata filters, which has to be parsed
+        if filter_type in METADATA_FILTER_TYPES:
+            metadataTest(self)
+
     def __repr__(self):
         return f"Filter(name='{self.name}', filter_type='{self.filter_type}', data='{self.data}', " \
                f"application='{self.application}', item_type='{self.item_type}', whitelist='{self.whitelist}')"
@@ -83,19 +93,46 @@ class Configuration:
     A class to store configuration data from a json file.
     """
 
-    def __init__(self, name: str, source_dir: str, target_dir: str, filters, overwrite: bool):
+    def __init__(self, name: str, source_dir: str, target_dir: str, filters, overwrite: bool, copy_mode: str = None,
+                 mtime_tolerance: float = 0.0, storage: str = MIRROR, compression: str = NO_COMPRESSION,
+                 delta_updates: bool = False, delete_stale: bool = False, parallel_scan: bool = False):
         """
         :param name: Name of configuration
         :param source_dir: Directory to copy items from
         :param target_dir: Directory to copy items to
         :param filters: List of Filter objects or dicts representing filters
-        :param overwrite: Whether or not to overwrite already existing files
+        :param overwrite: Whether or not to overwrite already existing files; only used if copy_mode is None
+        :param copy_mode: What to do with files that already exist in the target (a constant from COPY_MODES)
+        :param mtime_tolerance: In UPDATE mode, how many seconds modification times may differ by and still count as
+        the same
+        :param storage: How files are laid out in the target (a constant from STORAGE_FORMATS)
+        :param compression: How files copied to the target are compressed (a constant from COMPRESSIONS)
+        :param delta_updates: Whether large files that changed have only their changed blocks written to the target
+        :param delete_stale: Whether items no longer in the source are deleted from the target, making it a mirror
+        :param parallel_scan: Whether several of the source's folders are listed at the same time, for slow or network
+        volumes
         """
 
+        # Validate copy mode
+        if copy_mode is None:
+            copy_mode = OVERWRITE if overwrite else SKIP_EXISTING
+        elif copy_mode not in COPY_MODES:
+            raise ValueError(f"copy_mode value must be one of {COPY_MODES}, but got '{copy_mode}'.")
+        if storage not in STORAGE_FORMATS:
+            raise ValueError(f"storage value must be one of {STORAGE_FORMATS}, but got '{storage}'.")
+        if compression not in COMPRESSIONS:
+            raise ValueError(f"compression value must be one of {COMPRESSIONS}, but got '{compression}'.")
+
         self.name = name
         self.source_dir = source_dir
         self.target_dir = target_dir
-        self.overwrite = overwrite
+        self.copy_mode = copy_mode
+        self.mtime_tolerance = float(mtime_tolerance)
+        self.storage = storage
+        self.compression = compression
+        self.delta_updates = bool(delta_updates)
+        self.delete_stale = bool(delete_stale)
+        self.parallel_scan = bool(parallel_scan)
 
         # Filters
         # If there are no filters
@@ -109,6 +146,18 @@ class Configuration:
         else:
             raise ValueError(f"Filters must be a list of objects or a list of dicts, not {type(filters[0])}")
 
+    @property
+    def overwrite(self):
+        """ Whether already existing files are overwritten; setting it chooses between OVERWRITE and SKIP_EXISTING """
+        return self.copy_mode == OVERWRITE
+
+    @overwrite.setter
+    def overwrite(self, overwrite):
+        self.copy_mode = OVERWRITE if overwrite else SKIP_EXISTING
+
     def __repr__(self):
         return f"Configuration(name='{self.name}', source_dir='{self.source_dir}', target_dir='{self.target_dir}', " \
-               f"keyword_filters={self.filters}, overwrite={self.overwrite})"
+               f"keyword_filters={self.filters}, copy_mode='{self.copy_mode}', " \
+               f"mtime_tolerance={self.mtime_tolerance}, storage='{self.storage}', compression='{self.compression}', " \
+               f"delta_updates={self.delta_updates}, delete_stale={self.delete_stale}, " \
+               f"parallel_scan={self.parallel_scan})"
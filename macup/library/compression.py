@@ -0,0 +1,224 @@
+"""
+Compression of files as they are copied to the target, and their decompression on restore.
+
+A file is compressed in blocks, each one compressed on its own into a complete gzip member, xz stream or bzip2
+stream, and written one after another. Files made of several members or streams are still ordinary .gz, .xz and .bz2
+files, so standard tools can decompress them, but the blocks can be compressed in parallel: zlib, lzma and bz2 let go
+of the GIL while they work. Files that wouldn't shrink, because of their type or because a sample of them doesn't, are
+copied as they are.
+
+Compressed copies are named after the original with a suffix like .macup.gz, so they can't be confused with files
+that were already compressed in the source.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+import bz2
+import gzip
+import hashlib
+import lzma
+import os
+import shutil
+import zlib
+
+from macup.library.constants import *
+
+COMPRESSED = 'COMPRESSED'  # The copy backend name reported for compressed files
+
+DEFAULT_BLOCK_SIZE = 4 * 1024 * 1024
+DEFAULT_COMPRESSION_WORKERS = 4
+DEFAULT_LEVELS = {ZLIB: 6, LZMA: 3, BZ2: 9}  # xz's own default of 6 is several times slower for little gain
+SUFFIXES = {ZLIB: ".macup.gz", LZMA: ".macup.xz", BZ2: ".macup.bz2"}
+
+# Types that are already compressed, so compressing them again would only waste time
+INCOMPRESSIBLE_EXTENSIONS = frozenset((
+    ".7z", ".aac", ".apk", ".avi", ".avif", ".br", ".bz2", ".cab", ".deb", ".dmg", ".docx", ".epub", ".flac", ".flv",
+    ".gif", ".gz", ".heic", ".jar", ".jpeg", ".jpg", ".lz", ".lz4", ".lzma", ".m4a", ".m4v", ".mkv", ".mov", ".mp3",
+    ".mp4", ".mpeg", ".mpg", ".odp", ".ods", ".odt", ".ogg", ".opus", ".png", ".pptx", ".rar", ".rpm", ".tbz2",
+    ".tgz", ".txz", ".webm", ".webp", ".whl", ".wma", ".wmv", ".xlsx", ".xz", ".zip", ".zst",
+))
+
+MIN_COMPRESSED_SIZE = 1024  # Smaller files are copied as they are; their savings wouldn't be worth it
+_SAMPLE_SIZE = 64 * 1024
+_SAMPLE_RATIO = 0.9  # A file is only compressed if a sample of it shrinks to less than this fraction of its size
+_READ_SIZE = 1024 * 1024
+
+
+def _compressBlock(compression, level, data):
+    """ :return: The data compressed into a complete member or stream of the format """
+    if compression == ZLIB:
+        # A window size of 16 + 15 gives a gzip header and trailer
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return compressor.compress(data) + compressor.flush()
+    if compression == LZMA:
+        return lzma.compress(data, format=lzma.FORMAT_XZ, preset=level)
+    return bz2.compress(data, level)
+
+
+def getStoredPath(target, compression):
+    """ :return: The path a file's compressed copy is stored at """
+    return target + SUFFIXES[compression]
+
+
+def isCompressedPath(path):
+    """ :return: The compression of a stored file, from its name, or None if it isn't compressed """
+    for compression, suffix in SUFFIXES.items():
+        if path.endswith(suffix):
+            return compression
+    return None
+
+
+class Compressor:
+    """
+    Compresses files into the target, sharing a pool of threads between all the files being copied at once. A file
+    smaller than a block is compressed on the calling thread; a bigger one has its blocks compressed on the pool,
+    with only a few waiting at a time, and written in order as they finish.
+    """
+
+    def __init__(self, compression, level=None, block_size=DEFAULT_BLOCK_SIZE, workers=DEFAULT_COMPRESSION_WORKERS):
+        """
+        :param compression: ZLIB, LZMA or BZ2
+        :param level: The compression level, or preset for LZMA; the format's one in DEFAULT_LEVELS if None
+        :param block_size: The size of the blocks compressed separately
+        :param workers: The number of threads compressing blocks of large files
+        """
+
+        if compression not in SUFFIXES:
+            raise ValueError(f"compression must be one of {tuple(SUFFIXES)}, but got '{compression}'.")
+        self.compression = compression
+        self.level = DEFAULT_LEVELS[compression] if level is None else level
+        self.suffix = SUFFIXES[compression]
+        self.block_size = block_size
+        self._workers = workers
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self._pool.shutdown(wait=True)
+
+    def shouldCompress(self, path, source_fd, size):
+        """
+        :param path: The source's path, whose extension is checked first
+        :param source_fd: A file descriptor of the source, open for reading, to take a sample from
+        :param size: The source's size
+        :return: True if the file looks like it would shrink
+        """
+
+        if size < MIN_COMPRESSED_SIZE or os.path.splitext(path)[1].lower() in INCOMPRESSIBLE_EXTENSIONS:
+            return False
+        # zlib's fastest level is enough to tell whether the data is random-looking
+        sample = os.pread(source_fd, _SAMPLE_SIZE, max(0, size // 2 - _SAMPLE_SIZE // 2))
+        return len(zlib.compress(sample, 1)) < len(sample) * _SAMPLE_RATIO
+
+    def compressFile(self, source_fd, target_fd):
+        """
+        Compresses the rest of a file from one file descriptor into another.
+
+        :return: A tuple of the number of bytes read and the number of bytes written
+        """
+
+        read = written = 0
+        data = os.read(source_fd, self.block_size)
+        if len(data) < self.block_size:
+            # Smaller than a block, so it isn't worth handing to another thread
+            compressed = _compressBlock(self.compression, self.level, data)
+            _writeAll(target_fd, compressed)
+            return len(data), len(compressed)
+
+        pending = []
+        while data:
+            pending.append(self._pool.submit(_compressBlock, self.compression, self.level, data))
+            read += len(data)
+            # Blocks are written in order, and only a few are kept waiting, so memory use stays flat
+            if len(pending) > self._workers:
+                compressed = pending.pop(0).result()
+                _writeAll(target_fd, compressed)
+                written += len(compressed)
+            data = os.read(source_fd, self.block_size)
+        for future in pending:
+            compressed = future.result()
+            _writeAll(target_fd, compressed)
+            written += len(compressed)
+        return read, written
+
+
+def _writeAll(fd, data):
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+
+def openStored(path):
+    """
+    Opens a file in the target for reading its original contents, decompressing it if it is compressed.
+
+    :param path: The path of the stored file, with its compression suffix if it has one
+    :return: A binary file object
+    """
+
+    compression = isCompressedPath(path)
+    if compression == ZLIB:
+        return gzip.open(path, "rb")
+    if compression == LZMA:
+        return lzma.open(path, "rb")
+    if compression == BZ2:
+        return bz2.open(path, "rb")
+    return open(path, "rb")
+
+
+def restoreFile(path, destination):
+    """
+    Restores a file from the target, decompressing it if it is compressed, with its mode and modification time.
+
+    :param path: The path of the stored file, with its compression suffix if it has one
+    :param destination: The path to restore it to, without the suffix
+    """
+
+    with openStored(path) as stored, open(destination, "wb") as f:
+        shutil.copyfileobj(stored, f, _READ_SIZE)
+    shutil.copystat(path, destination)
+
+
+def restoreTree(target_dir, destination):
+    """
+    Restores every file in a target directory, decompressing the ones that are compressed. MacUp's own metadata
+    folder is left out.
+
+    :param target_dir: The target directory
+    :param destination: The directory to restore into
+    :return: The number of files restored
+    """
+
+    restored = 0
+    for directory, directories, files in os.walk(target_dir):
+        if directory == target_dir and METADATA_DIR in directories:
+            directories.remove(METADATA_DIR)
+        restored_directory = os.path.join(destination, os.path.relpath(directory, target_dir))
+        os.makedirs(restored_directory, exist_ok=True)
+        for name in files:
+            compression = isCompressedPath(name)
+            restored_name = name[:-len(SUFFIXES[compression])] if compression is not None else name
+            restoreFile(os.path.join(directory, name), os.path.join(restored_directory, restored_name))
+            restored += 1
+    return restored
+
+
+def hashStored(path):
+    """
+    :param path: The path of a file in the target
+    :return: The BLAKE2b digest of the file's original contents, decompressing it if it is compressed, so it can be
+    compared with hashFile's digest of the source
+    """
+
+    digest = hashlib.blake2b()
+    with openStored(path) as stored:
+        while True:
+            data = stored.read(_READ_SIZE)
+            if not data:
+                return digest.digest()
+            digest.update(data)
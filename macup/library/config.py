@@ -1,10 +1,30 @@
 import json
+import os
+import re
 from macup.library.classes import Configuration
+from macup.library.constants import *
+from macup.library.filter import parseFilterToDict
 
 
 TEST_LOC = "/Users/calebhair/Documents/Projects/MacUp/macup/tests/jsonstorage.json"
 
 
+def getConfigDataPath(name, json_path, folder, extension):
+    """
+    Returns the path of a file holding data about a configuration (e.g. its scan index), kept in a folder next to
+    the json file.
+
+    :param name: The name of the configuration
+    :param json_path: The path to the json file the configuration is stored in
+    :param folder: The name of the folder for this kind of data
+    :param extension: The file extension, including the dot
+    :return: The path of the data file
+    """
+
+    safe_name = re.sub(r"[^\w.-]", "_", name)
+    return os.path.join(os.path.dirname(os.path.abspath(json_path)), folder, safe_name + extension)
+
+
 def loadConfigs(json_path):
     """
     Extracts configurations stored in a json file, returning a list of config objects.
@@ -17,8 +37,7 @@ def loadConfigs(json_path):
         json_configs = json.load(f)["configs"]
         configs = []
         for config in json_configs:
-            configs.append(Configuration(config["name"], config["source_dir"], config["target_dir"],
-                                         config["filters"], config["overwrite"]))
+            configs.append(parseDictToConfig(config))
     return configs
 
 
@@ -44,17 +63,7 @@ def parseConfigToDict(config):
         raise ValueError(f"Configuration must be a Configuration object, got {type(config)}")
 
     # Parse each filter
-    filter_dicts = []
-    for filter_ in config.filters:
-        filter_dict = {
-            "name": str(filter_.name),
-            "filter_type": str(filter_.filter_type),
-            "data": str(filter_.data),
-            "application": str(filter_.application),
-            "item_type": str(filter_.item_type),
-            "whitelist": bool(filter_.whitelist)
-        }
-        filter_dicts.append(filter_dict)
+    filter_dicts = [parseFilterToDict(filter_) for filter_ in config.filters]
 
     # Build configuration dict
     config_dict = {
@@ -62,7 +71,14 @@ def parseConfigToDict(config):
         "source_dir": str(config.source_dir),
         "target_dir": str(config.target_dir),
         "filters": filter_dicts,
-        "overwrite": bool(config.overwrite)
+        "overwrite": bool(config.overwrite),  # Kept for older versions, which don't know about copy modes
+        "copy_mode": str(config.copy_mode),
+        "mtime_tolerance": float(config.mtime_tolerance),
+        "storage": str(config.storage),
+        "compression": str(config.compression),
+        "delta_updates": bool(config.delta_updates),
+        "delete_stale": bool(config.delete_stale),
+        "parallel_scan": bool(config.parallel_scan)
     }
 
     return config_dict
@@ -79,8 +95,13 @@ def parseDictToConfig(dict_):
     if not isinstance(dict_, dict):
         raise ValueError(f"Configuration must be a dict, got {type(dict_)}")
 
+    # Configurations saved before copy modes, storage formats, compression, delta updates, mirroring and parallel
+    # scanning existed don't have them
     return Configuration(dict_["name"], dict_["source_dir"], dict_["target_dir"],
-                         dict_["filters"], dict_["overwrite"])
+                         dict_["filters"], dict_["overwrite"], dict_.get("copy_mode"),
+                         dict_.get("mtime_tolerance", 0.0), dict_.get("storage", MIRROR),
+                         dict_.get("compression", NO_COMPRESSION), dict_.get("delta_updates", False),
+                         dict_.get("delete_stale", False), dict_.get("parallel_scan", False))
 
 
 def saveConfig(config, json_path):
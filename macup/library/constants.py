@@ -5,3 +5,35 @@ PATHS = 'PATHS'
 FILENAMES = 'FILENAMES'
 REGEX = 'REGEX'
 KEYWORD = 'KEYWORD'
+
+SIZE_GREATER = 'SIZE_GREATER'
+SIZE_LESS = 'SIZE_LESS'
+MODIFIED_BEFORE = 'MODIFIED_BEFORE'
+MODIFIED_AFTER = 'MODIFIED_AFTER'
+OLDER_THAN = 'OLDER_THAN'
+NEWER_THAN = 'NEWER_THAN'
+METADATA_FILTER_TYPES = (SIZE_GREATER, SIZE_LESS, MODIFIED_BEFORE, MODIFIED_AFTER, OLDER_THAN, NEWER_THAN)
+
+# Copy modes: what to do with files that already exist in the target
+SKIP_EXISTING = 'SKIP_EXISTING'
+OVERWRITE = 'OVERWRITE'
+UPDATE = 'UPDATE'  # Copy only if the size or modification time differs
+CHECKSUM = 'CHECKSUM'  # Copy only if the size or contents differ
+COPY_MODES = (SKIP_EXISTING, OVERWRITE, UPDATE, CHECKSUM)
+FAT_MTIME_TOLERANCE = 2.0  # FAT and exFAT store modification times in 2 second steps
+
+METADATA_DIR = '.macup'  # Folder in the target directory holding MacUp's own data about the backup
+
+# Storage formats: how files are laid out in the target
+MIRROR = 'MIRROR'  # Every file is copied to the same path under the target
+PACKED = 'PACKED'  # Small files are packed into tar segments in the target's METADATA_DIR folder
+DEDUPLICATED = 'DEDUPLICATED'  # Files are chunked into a deduplicating store, with a snapshot for each backup
+SNAPSHOTS = 'SNAPSHOTS'  # Each backup is a dated folder, with unchanged files hard-linked from the one before
+STORAGE_FORMATS = (MIRROR, PACKED, DEDUPLICATED, SNAPSHOTS)
+
+# Compressions: how files copied to the target are compressed
+NO_COMPRESSION = 'NONE'
+ZLIB = 'ZLIB'  # gzip files
+LZMA = 'LZMA'  # xz files
+BZ2 = 'BZ2'  # bzip2 files
+COMPRESSIONS = (NO_COMPRESSION, ZLIB, LZMA, BZ2)
@@ -0,0 +1,169 @@
+"""
+Ways of copying a file's data from one file descriptor to another, from cheapest to most expensive: a reflink, which
+shares the data blocks instead of copying them; copy_file_range and sendfile, which copy in the kernel; and reading
+and writing in userspace, which works everywhere. What each pair of devices supports is learnt from the first copy
+between them, so later copies go straight to the first backend that works.
+"""
+
+import errno
+import os
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows, so reflinks aren't either
+    fcntl = None
+
+REFLINK = 'REFLINK'
+COPY_FILE_RANGE = 'COPY_FILE_RANGE'
+SENDFILE = 'SENDFILE'
+USERSPACE = 'USERSPACE'
+BACKENDS = (REFLINK, COPY_FILE_RANGE, SENDFILE, USERSPACE)
+
+_FICLONE = 0x40049409  # The Linux ioctl cloning a whole file, as used by "cp --reflink"
+_CHUNK_SIZE = 64 * 1024 * 1024  # Kernel copies are asked for in chunks, so a huge file can't overflow the count
+_USERSPACE_BUFFER_SIZE = 1024 * 1024
+
+# Errors meaning a backend doesn't work for these files, rather than that the copy itself went wrong
+_UNSUPPORTED_ERRORS = {errno.ENOSYS, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EXDEV, errno.EINVAL, errno.ENOTTY,
+                       errno.EBADF}
+
+
+class _Unsupported(Exception):
+    """ Raised by a backend that can't copy between these files, before it has written anything """
+
+
+# Each backend copies the whole file, returning the number of bytes copied. If a backend is unsupported, it raises
+# _Unsupported before anything is written, so the next backend can start from the beginning.
+#
+# The kernel copies can return 0 without copying anything on some filesystems (procfs, sysfs, some FUSE and
+# cross-filesystem copies) as well as at the end of the file. A 0 before any data counts as unsupported; a 0 before the
+# source's size is reached is checked by reading the rest in userspace, which finds the real end of the file.
+
+def _reflink(source_fd, target_fd, size):
+    try:
+        fcntl.ioctl(target_fd, _FICLONE, source_fd)
+    except OSError as error:
+        if error.errno in _UNSUPPORTED_ERRORS:
+            raise _Unsupported() from error
+        raise
+    return size
+
+
+def _copyFileRange(source_fd, target_fd, size):
+    copied = 0
+    while True:
+        try:
+            length = os.copy_file_range(source_fd, target_fd, _CHUNK_SIZE, copied, copied)
+        except OSError as error:
+            if copied == 0 and error.errno in _UNSUPPORTED_ERRORS:
+                raise _Unsupported() from error
+            raise
+        if length == 0:
+            if copied == 0 and size > 0:
+                raise _Unsupported()
+            if copied < size:
+                return _userspace(source_fd, target_fd, size, copied)
+            return copied
+        copied += length
+
+
+def _sendfile(source_fd, target_fd, size):
+    copied = 0
+    while True:
+        try:
+            length = os.sendfile(target_fd, source_fd, copied, _CHUNK_SIZE)
+        except OSError as error:
+            if copied == 0 and error.errno in _UNSUPPORTED_ERRORS:
+                raise _Unsupported() from error
+            raise
+        if length == 0:
+            if copied == 0 and size > 0:
+                raise _Unsupported()
+            if copied < size:
+                return _userspace(source_fd, target_fd, size, copied)
+            return copied
+        copied += length
+
+
+def _userspace(source_fd, target_fd, size, copied=0):
+    while True:
+        data = os.pread(source_fd, _USERSPACE_BUFFER_SIZE, copied)
+        if not data:
+            return copied
+        written = 0
+        while written < len(data):
+            written += os.pwrite(target_fd, data[written:], copied + written)
+        copied += len(data)
+
+
+_BACKEND_FUNCTIONS = {REFLINK: _reflink, COPY_FILE_RANGE: _copyFileRange, SENDFILE: _sendfile, USERSPACE: _userspace}
+
+
+def availableBackends():
+    """ :return: The backends this platform has the system calls for, cheapest first """
+    available = []
+    if fcntl is not None and os.uname().sysname == "Linux":
+        available.append(REFLINK)
+    if hasattr(os, "copy_file_range"):
+        available.append(COPY_FILE_RANGE)
+    if hasattr(os, "sendfile"):
+        available.append(SENDFILE)
+    available.append(USERSPACE)
+    return available
+
+
+class CopyBackends:
+    """
+    Copies data with the cheapest backend that works, remembering for each pair of source and target devices which
+    backends didn't, so they aren't tried again. It can be shared between threads.
+    """
+
+    def __init__(self, backends=None):
+        """
+        :param backends: The backends to try, in order; all the available ones if None. USERSPACE is always tried
+        last, even if not listed.
+        """
+
+        available = availableBackends()
+        if backends is None:
+            backends = available
+        else:
+            for backend in backends:
+                if backend not in BACKENDS:
+                    raise ValueError(f"backend must be one of {BACKENDS}, but got '{backend}'.")
+            backends = [backend for backend in backends if backend in available]
+        if USERSPACE not in backends:
+            backends = list(backends) + [USERSPACE]
+
+        self.backends = tuple(backends)
+        self._unsupported = {}  # (source device, target device) -> set of backends that didn't work
+        self._lock = threading.Lock()
+
+    def supported(self, source_device, target_device):
+        """ :return: The backends still thought to work between two devices, cheapest first """
+        unsupported = self._unsupported.get((source_device, target_device), ())
+        return [backend for backend in self.backends if backend not in unsupported]
+
+    def copy(self, source_fd, target_fd, size, source_device, target_device):
+        """
+        Copies all of the source's data to the start of the target, which should be empty.
+
+        :param source_fd: A file descriptor of the source, open for reading
+        :param target_fd: A file descriptor of the target, open for writing
+        :param size: The size of the source, from its stat
+        :param source_device: The device id (st_dev) of the source
+        :param target_device: The device id (st_dev) of the target's directory
+        :return: A tuple of the number of bytes copied, and the backend that copied them
+        """
+
+        for backend in self.supported(source_device, target_device):
+            try:
+                return _BACKEND_FUNCTIONS[backend](source_fd, target_fd, size), backend
+            except _Unsupported:
+                with self._lock:
+                    self._unsupported.setdefault((source_device, target_device), set()).add(backend)
+
+        # USERSPACE is always supported, so this can't be reached
+        raise OSError(errno.ENOTSUP, "No copy backend could copy the file")
@@ -0,0 +1,756 @@
+"""
+Concurrent file copying, with separate limits on how many copies read from one source device and write to one
+target device at the same time.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+from macup.library.constants import *
+
+import errno
+import os
+import stat
+import threading
+import time
+
+from macup.library.chunkedcopy import CHUNKED, DEFAULT_CHUNK_SIZE, LARGE_FILE_THRESHOLD, copyLargeFile
+from macup.library.compression import COMPRESSED, Compressor, DEFAULT_COMPRESSION_WORKERS, getStoredPath, \
+    hashStored
+from macup.library.copybackends import CopyBackends
+from macup.library.delta import DELTA, DELTA_THRESHOLD, canDeltaUpdate, deltaUpdate
+from macup.library.hashcache import hashFile
+
+# Each device takes half the pool's copies at a time, so a second device being copied to or from still gets threads.
+# tests/library/copyengine/benchmark.py measures the numbers of copies at a time on a given volume.
+DEFAULT_COPY_WORKERS = 8
+DEFAULT_HASH_WORKERS = 4
+DEFAULT_DEVICE_LIMIT = 4
+
+# Outcomes of copying a file
+COPIED = 'COPIED'
+LINKED = 'LINKED'  # Hard-linked from a previous snapshot, as it hadn't changed
+SKIPPED = 'SKIPPED'
+FAILED = 'FAILED'
+DELETED = 'DELETED'  # Deleted from the target when mirroring, as it is no longer in the source
+
+
+def getCopyMode(overwrite):
+    """
+    :param overwrite: A copy mode (a constant from COPY_MODES), or a boolean choosing between OVERWRITE and
+    SKIP_EXISTING
+    :return: The copy mode
+    """
+
+    if isinstance(overwrite, bool):
+        return OVERWRITE if overwrite else SKIP_EXISTING
+    if overwrite not in COPY_MODES:
+        raise ValueError(f"copy mode must be one of {COPY_MODES}, but got '{overwrite}'.")
+    return overwrite
+
+
+class CopyResult:
+    """
+    The outcome of copying one file.
+    """
+
+    __slots__ = ("source", "target", "status", "size", "error", "backend", "stored_size")
+
+    def __init__(self, source, target, status, size=0, error=None, backend=None, stored_size=None):
+        """
+        :param source: The file copied
+        :param target: Where it was copied to; for a compressed copy, this includes the compression suffix
+        :param status: COPIED, LINKED, SKIPPED, FAILED or DELETED
+        :param size: The number of bytes copied; for a delta update, only the bytes written
+        :param error: The exception that made the copy fail, if it did
+        :param backend: The copy backend that copied the data (a constant from copybackends), if it was copied
+        :param stored_size: The number of bytes written to the target, if the file was compressed
+        """
+
+        self.source = source
+        self.target = target
+        self.status = status
+        self.size = size
+        self.error = error
+        self.backend = backend
+        self.stored_size = stored_size
+
+    def __repr__(self):
+        return f"CopyResult(source='{self.source}', target='{self.target}', status='{self.status}', " \
+               f"size={self.size}, error={self.error!r}, backend={self.backend!r}, stored_size={self.stored_size})"
+
+
+class CopyReport:
+    """
+    Collects the results of many copies. Counts and totals are always kept, but only failed results are kept
+    individually unless asked for, so reporting on millions of files doesn't hold millions of results.
+    """
+
+    def __init__(self, keep_results=False):
+        """
+        :param keep_results: Whether to keep every result, rather than just the failures
+        """
+
+        self.counts = {COPIED: 0, LINKED: 0, SKIPPED: 0, FAILED: 0, DELETED: 0}
+        self.bytes_copied = 0
+        self.bytes_compressed = 0  # The original size of the files that were compressed
+        self.bytes_stored_compressed = 0  # Their size once compressed
+        self.backends = {}  # Copy backend -> number of files it copied
+        self.failures = []
+        self.results = [] if keep_results else None
+        self.started = time.monotonic()
+        self.finished = None  # Set when the copying is over
+        self._lock = threading.Lock()
+
+    def add(self, result):
+        """ Adds a CopyResult to the report; safe to call from several threads """
+        with self._lock:
+            self.counts[result.status] += 1
+            self.bytes_copied += result.size
+            if result.stored_size is not None:
+                self.bytes_compressed += result.size
+                self.bytes_stored_compressed += result.stored_size
+            if result.backend is not None:
+                self.backends[result.backend] = self.backends.get(result.backend, 0) + 1
+            if result.status == FAILED:
+                self.failures.append(result)
+            if self.results is not None:
+                self.results.append(result)
+
+    def merge(self, other):
+        """ Adds the results of another report to this one """
+        with self._lock:
+            for status, count in other.counts.items():
+                self.counts[status] += count
+            self.bytes_copied += other.bytes_copied
+            self.bytes_compressed += other.bytes_compressed
+            self.bytes_stored_compressed += other.bytes_stored_compressed
+            for backend, count in other.backends.items():
+                self.backends[backend] = self.backends.get(backend, 0) + count
+            self.failures += other.failures
+            if self.results is not None and other.results is not None:
+                self.results += other.results
+
+    @property
+    def succeeded(self):
+        """ True if no copy failed """
+        return not self.failures
+
+    @property
+    def elapsed(self):
+        """ The seconds from the report's creation until the copying finished, or until now if it hasn't """
+        return (time.monotonic() if self.finished is None else self.finished) - self.started
+
+    @property
+    def throughput(self):
+        """ The bytes copied per second """
+        elapsed = self.elapsed
+        return self.bytes_copied / elapsed if elapsed > 0 else 0.0
+
+    @property
+    def compression_ratio(self):
+        """ The original size of the compressed files over their compressed size, or None if none were compressed """
+        if not self.bytes_stored_compressed:
+            return None
+        return self.bytes_compressed / self.bytes_stored_compressed
+
+    def __repr__(self):
+        ratio = self.compression_ratio
+        return f"CopyReport(copied={self.counts[COPIED]}, linked={self.counts[LINKED]}, " \
+               f"skipped={self.counts[SKIPPED]}, failed={self.counts[FAILED]}, deleted={self.counts[DELETED]}, " \
+               f"bytes_copied={self.bytes_copied}, " \
+               f"backends={self.backends}, throughput={self.throughput / 1024 ** 2:.1f} MB/s" + \
+               ("" if ratio is None else f", compression_ratio={ratio:.2f}") + ")"
+
+
+class CopyStrategy:
+    """
+    A way of storing files in the target other than a plain copy, e.g. compressed, patched in place, or copied in
+    resumable chunks. The engine offers each file it has to copy to its strategies in turn, and copies it plainly if
+    none of them takes it, so a new way of storing files is a new strategy rather than more options of the engine.
+    """
+
+    def storedPath(self, target):
+        """
+        :param target: The path of a file's plain copy
+        :return: Where the strategy stores the file, if not at target, e.g. with a compression suffix; otherwise None.
+        A file stored there isn't byte for byte the source, so only its modification time is compared with the
+        source's.
+        """
+
+        return None
+
+    def hashStored(self, path):
+        """ :return: The digest of the original contents of a file at a path storedPath gave, as hashFile gives """
+        return hashFile(path)
+
+    def copyFile(self, source, source_fd, source_stat, target, copy_mode, progress=None):
+        """
+        Stores a file in the target, if the strategy applies to it.
+
+        :param source: The file's path
+        :param source_fd: A file descriptor of the file, open for reading at its start
+        :param source_stat: The fstat result of source_fd
+        :param target: The path of its plain copy
+        :param copy_mode: SKIP_EXISTING, OVERWRITE, UPDATE or CHECKSUM; the file has been found to need copying
+        :param progress: The engine's progress function, or None
+        :return: A CopyResult, or None if the strategy doesn't apply to the file
+        """
+
+        return None
+
+    def close(self):
+        """ Stops any threads of the strategy's own, once the engine has finished copying """
+        pass
+
+
+class CompressedCopies(CopyStrategy):
+    """
+    Compresses the files that look like they would shrink into the target with a suffix (see compression). The
+    blocks of large files are compressed on a pool of threads of its own. Compressed copies get the source's
+    modification time, which UPDATE mode compares alone, as their size is not the source's.
+    """
+
+    def __init__(self, compression, level=None, workers=DEFAULT_COMPRESSION_WORKERS):
+        """
+        :param compression: ZLIB, LZMA or BZ2
+        :param level: The compression level, or preset for LZMA; the format's one in DEFAULT_LEVELS if None
+        :param workers: The number of threads compressing blocks of large files
+        """
+
+        self.compressor = Compressor(compression, level, workers=workers)
+        self.compression = compression
+
+    def storedPath(self, target):
+        return getStoredPath(target, self.compression)
+
+    def hashStored(self, path):
+        return hashStored(path)
+
+    def copyFile(self, source, source_fd, source_stat, target, copy_mode, progress=None):
+        if not self.compressor.shouldCompress(source, source_fd, source_stat.st_size):
+            return None
+
+        # Created or overwritten as a plain copy is
+        stored_target = self.storedPath(target)
+        flags = os.O_WRONLY | os.O_CREAT | (os.O_EXCL if copy_mode == SKIP_EXISTING else os.O_TRUNC)
+        if copy_mode != SKIP_EXISTING:
+            _unlinkShared(stored_target)
+        try:
+            target_fd = os.open(stored_target, flags, stat.S_IMODE(source_stat.st_mode))
+        except FileExistsError:
+            return CopyResult(source, stored_target, SKIPPED)
+
+        try:
+            try:
+                size, stored_size = self.compressor.compressFile(source_fd, target_fd)
+                os.fchmod(target_fd, stat.S_IMODE(source_stat.st_mode))
+                os.utime(target_fd if os.utime in os.supports_fd else stored_target,
+                         ns=(source_stat.st_atime_ns, source_stat.st_mtime_ns))
+            finally:
+                os.close(target_fd)
+        except BaseException:
+            try:
+                os.remove(stored_target)
+            except OSError:
+                pass
+            raise
+
+        if progress is not None:
+            progress(source, size, size)
+        return CopyResult(source, stored_target, COPIED, size, backend=COMPRESSED, stored_size=stored_size)
+
+    def close(self):
+        self.compressor.close()
+
+
+class DeltaUpdates(CopyStrategy):
+    """
+    Patches large files whose target already exists in place rather than rewriting them, so only the blocks that
+    changed are written (see delta). A patched target that is interrupted is patched again next time.
+    """
+
+    def __init__(self, threshold=DELTA_THRESHOLD, signature_cache=None):
+        """
+        :param threshold: Files at least this many bytes are delta updated
+        :param signature_cache: A SignatureCache, so targets that haven't changed since they were patched needn't be
+        read to be compared
+        """
+
+        self.threshold = threshold
+        self.signature_cache = signature_cache
+
+    def copyFile(self, source, source_fd, source_stat, target, copy_mode, progress=None):
+        if copy_mode == SKIP_EXISTING or not canDeltaUpdate(source_stat, _regularStat(target), self.threshold):
+            return None
+        written = deltaUpdate(source_fd, source_stat, target, self.signature_cache,
+                              preserve_mtime=copy_mode == UPDATE, progress=progress, source=source)
+        return CopyResult(source, target, COPIED, written, backend=DELTA)
+
+
+class ChunkedCopies(CopyStrategy):
+    """
+    Copies large files in chunks through a partial file beside the target, so an interrupted copy is resumed rather
+    than started again (see chunkedcopy). The partial copy is kept if the copy fails.
+    """
+
+    def __init__(self, threshold=LARGE_FILE_THRESHOLD, chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        :param threshold: Files at least this many bytes are copied in chunks
+        :param chunk_size: The size of the chunks
+        """
+
+        self.threshold = threshold
+        self.chunk_size = chunk_size
+
+    def copyFile(self, source, source_fd, source_stat, target, copy_mode, progress=None):
+        if source_stat.st_size < self.threshold:
+            return None
+        if copy_mode == SKIP_EXISTING and os.path.lexists(target):
+            return CopyResult(source, target, SKIPPED)
+        size, _, written = copyLargeFile(source_fd, source_stat, source, target, copy_mode, self.chunk_size,
+                                         progress=progress)
+        if not written:
+            return CopyResult(source, target, SKIPPED)
+        return CopyResult(source, target, COPIED, size, backend=CHUNKED)
+
+
+class CopyEngine:
+    """
+    Copies files on a pool of threads. Besides the limit on threads, each source device and each target device has
+    its own limit on copies in progress, so a slow device can't tie up every thread while a fast one sits idle, and
+    a spinning disk isn't made to seek between too many files at once. Only a bounded number of copies can be
+    waiting at a time, so submitting blocks rather than queueing up a whole tree's worth of files.
+
+    In CHECKSUM mode, files are first compared on a separate pool of hashing threads, which hand the files that
+    differ on to the copying threads, so hashing some files overlaps with copying others.
+
+    Files can be stored other ways than as plain copies by strategies (see CopyStrategy), each tried in turn on the
+    files that need copying. A file is only ever stored one way, so a copy stored another way by an earlier backup is
+    removed once the new copy is written. By default, large files are copied in resumable chunks.
+
+    For snapshots, a file can be given the path of its copy in the previous snapshot, which is hard-linked to the
+    target instead of the file being copied if UPDATE or CHECKSUM mode finds it unchanged.
+
+    With a manifest, every file copied or found unchanged is recorded in it as the copies finish, as the target is
+    after the copy. UPDATE mode still compares each file with the target itself rather than the previous manifest, so
+    a file deleted or changed in the target behind MacUp's back is copied again. A target whose folder has gone
+    missing has it made again.
+    """
+
+    def __init__(self, workers=DEFAULT_COPY_WORKERS, source_device_limit=DEFAULT_DEVICE_LIMIT,
+                 target_device_limit=DEFAULT_DEVICE_LIMIT, keep_results=False, hash_cache=None,
+                 hash_workers=DEFAULT_HASH_WORKERS, backends=None, progress=None, strategies=None, manifest=None):
+        """
+        :param workers: The number of copying threads
+        :param source_device_limit: The most copies reading from one device at the same time
+        :param target_device_limit: The most copies writing to one device at the same time
+        :param keep_results: Whether the report keeps every result, rather than just the failures
+        :param hash_cache: A HashCache for CHECKSUM mode, so unchanged files aren't hashed again; without one, every
+        file compared is hashed
+        :param hash_workers: The number of hashing threads for CHECKSUM mode
+        :param backends: The copy backends to try, cheapest first (constants from copybackends); all the ones
+        available if None
+        :param progress: A function called with a source path, the bytes of it copied so far, and its size, after
+        each chunk of a large file and once each other file is copied; it is called from the copying threads
+        :param strategies: The CopyStrategy objects to try on each file, in order, before copying it plainly; a
+        ChunkedCopies with its defaults if None. They are closed with the engine.
+        :param manifest: A ManifestWriter to record the target's files in; the targets passed must be under its
+        target directory
+        """
+
+        self.source_device_limit = source_device_limit
+        self.target_device_limit = target_device_limit
+        self.report = CopyReport(keep_results)
+        self.hash_cache = hash_cache
+        self.copy_backends = CopyBackends(backends)
+        self.progress = progress
+        self.strategies = [ChunkedCopies()] if strategies is None else list(strategies)
+        self.manifest = manifest
+
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+        self._hash_workers = hash_workers
+        self._hash_pool = None  # Only started if CHECKSUM mode is used
+        self._pending = threading.BoundedSemaphore(workers * 4)
+        self._device_semaphores = {}  # (is target, device id) -> semaphore
+        self._directory_devices = {}  # directory -> device id
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close(cancel=exc_type is not None)
+
+    def _device(self, directory):
+        # Files in the same directory are on the same device, so it is only looked up once per directory
+        device = self._directory_devices.get(directory)
+        if device is None:
+            device = os.stat(directory).st_dev
+            self._directory_devices[directory] = device
+        return device
+
+    def _deviceSemaphore(self, is_target, device):
+        key = (is_target, device)
+        with self._lock:
+            semaphore = self._device_semaphores.get(key)
+            if semaphore is None:
+                limit = self.target_device_limit if is_target else self.source_device_limit
+                semaphore = self._device_semaphores[key] = threading.Semaphore(limit)
+        return semaphore
+
+    def submit(self, source, target, copy_mode, mtime_tolerance=0.0, link_dest=None):
+        """
+        Queues a file to be copied; blocks while too many copies are already waiting.
+
+        :param source: The file to copy
+        :param target: The path to copy it to; its directory must already exist
+        :param copy_mode: What to do if the target already exists: SKIP_EXISTING, OVERWRITE, UPDATE or CHECKSUM; True
+        and False mean OVERWRITE and SKIP_EXISTING
+        :param mtime_tolerance: In UPDATE mode, how many seconds modification times may differ by and still count as
+        the same, e.g. FAT_MTIME_TOLERANCE for a FAT or exFAT target
+        :param link_dest: The file's copy in a previous snapshot, hard-linked to the target instead of copying if the
+        copy mode (UPDATE or CHECKSUM) finds it unchanged
+        """
+
+        copy_mode = getCopyMode(copy_mode)
+        self._pending.acquire()
+        try:
+            if copy_mode == CHECKSUM:
+                with self._lock:
+                    if self._hash_pool is None:
+                        self._hash_pool = ThreadPoolExecutor(max_workers=self._hash_workers)
+                # The pending slot is released once the file is skipped, or by the copy it is handed on to
+                self._hash_pool.submit(self._compareThenCopy, source, target, link_dest)
+                return
+            future = self._pool.submit(self.copy, source, target, copy_mode, mtime_tolerance, link_dest)
+        except BaseException:
+            self._pending.release()
+            raise
+        future.add_done_callback(lambda _: self._pending.release())
+
+    def _addResult(self, result):
+        """ Adds a result to the report, and records what it leaves in the target in the manifest """
+        self.report.add(result)
+        if self.manifest is None:
+            return
+        if result.status == FAILED:
+            # Whatever is left of the target can't be vouched for
+            self.manifest.forget(result.target)
+        elif result.status in (COPIED, LINKED, SKIPPED):
+            try:
+                target_stat = os.stat(result.target)
+                digest = None if self.hash_cache is None else \
+                    self.hash_cache.lookup(result.source, os.stat(result.source))
+            except OSError:
+                # Gone since it was copied
+                self.manifest.forget(result.target)
+                return
+            self.manifest.record(result.target, target_stat, digest)
+
+    def _storedPaths(self, target):
+        """ :return: Pairs of each strategy that stores files elsewhere than their plain copy, and where it would """
+        stored_paths = []
+        for strategy in self.strategies:
+            stored_target = strategy.storedPath(target)
+            if stored_target is not None:
+                stored_paths.append((strategy, stored_target))
+        return stored_paths
+
+    def _digest(self, path, stat, hash_function=None):
+        # hashFile is looked up when called rather than bound as the default, so it can be replaced, e.g. to count calls
+        hash_function = hashFile if hash_function is None else hash_function
+        if self.hash_cache is None:
+            return hash_function(path)
+        return self.hash_cache.digest(path, stat, hash_function)
+
+    def _compareThenCopy(self, source, target, link_dest=None):
+        # Run on the hashing threads
+        try:
+            source_stat = os.stat(source)
+            try:
+                target_stat = os.stat(target)
+            except FileNotFoundError:
+                target_stat = None
+
+            if self.hash_cache is not None:
+                # Even a file that is going to be copied is hashed, so its copy's hash can be cached without reading
+                # the copy back
+                self._digest(source, source_stat)
+
+            # Files of different sizes differ, without hashing either
+            if (target_stat is not None and stat.S_ISREG(target_stat.st_mode) and
+                    target_stat.st_size == source_stat.st_size and
+                    self._digest(source, source_stat) == self._digest(target, target_stat)):
+                self._addResult(CopyResult(source, target, SKIPPED))
+                self._pending.release()
+                return
+
+            # A copy stored another way, e.g. compressed, is compared by its original contents
+            for strategy, stored_target in self._storedPaths(target):
+                stored_stat = _regularStat(stored_target)
+                if (stored_stat is not None and self._digest(source, source_stat) ==
+                        self._digest(stored_target, stored_stat, strategy.hashStored)):
+                    self._addResult(CopyResult(source, stored_target, SKIPPED))
+                    self._pending.release()
+                    return
+
+            linked = None if link_dest is None else self._linkSameContents(source, source_stat, link_dest, target)
+            if linked is not None:
+                self._addResult(CopyResult(source, linked, LINKED))
+                self._pending.release()
+                return
+        except Exception as error:
+            self._addResult(CopyResult(source, target, FAILED, error=error))
+            self._pending.release()
+            return
+
+        try:
+            future = self._pool.submit(self.copy, source, target, CHECKSUM)
+        except BaseException:
+            self._pending.release()
+            raise
+        future.add_done_callback(lambda _: self._pending.release())
+
+    def copy(self, source, target, copy_mode, mtime_tolerance=0.0, link_dest=None):
+        """
+        Copies one file straight away, on the calling thread, and adds the result to the report.
+
+        :param source: The file to copy
+        :param target: The path to copy it to; its directory must already exist
+        :param copy_mode: What to do if the target already exists: SKIP_EXISTING, OVERWRITE or UPDATE; True and False
+        mean OVERWRITE and SKIP_EXISTING. CHECKSUM overwrites it, as the files are only compared when submitted.
+        :param mtime_tolerance: In UPDATE mode, how many seconds modification times may differ by and still count as
+        the same
+        :param link_dest: In UPDATE mode, the file's copy in a previous snapshot, hard-linked to the target instead of
+        copying if its size and modification time match
+        :return: A CopyResult
+        """
+
+        try:
+            copy_mode = getCopyMode(copy_mode)
+            source_device = self._device(os.path.dirname(source))
+            target_folder = os.path.dirname(target)
+            try:
+                target_device = self._device(target_folder)
+            except FileNotFoundError:
+                # The target's folder is missing, e.g. deleted from the target since the previous manifest said it was
+                # there, so it is made here
+                os.makedirs(target_folder, exist_ok=True)
+                if self.manifest is not None:
+                    self.manifest.distrust()
+                target_device = self._device(target_folder)
+            with self._deviceSemaphore(False, source_device), self._deviceSemaphore(True, target_device):
+                result = self._copyFile(source, target, copy_mode, mtime_tolerance, source_device, target_device,
+                                        link_dest)
+            if result.status == COPIED:
+                # The file was stored one way, so copies stored other ways by earlier backups are out of date
+                for stale in [target] + [stored_target for _, stored_target in self._storedPaths(target)]:
+                    if stale != result.target and _regularStat(stale) is not None:
+                        os.remove(stale)
+                        if self.manifest is not None:
+                            self.manifest.forget(stale)
+            if copy_mode == CHECKSUM and self.hash_cache is not None and result.status == COPIED:
+                # The copy has the contents the source was hashed with, so it needn't be hashed itself next time
+                source_stat = os.stat(source)
+                source_digest = self.hash_cache.lookup(source, source_stat)
+                if source_digest is not None:
+                    self.hash_cache.store(result.target, os.stat(result.target), source_digest)
+        except Exception as error:
+            result = CopyResult(source, target, FAILED, error=error)
+
+        self._addResult(result)
+        return result
+
+    def _copyFile(self, source, target, copy_mode, mtime_tolerance, source_device, target_device, link_dest=None):
+        """
+        Copies a file's contents and permission bits, like shutil.copy, but with one open and fstat per file, and the
+        data copied by the cheapest of the copy backends that works between the two devices, unless one of the
+        strategies stores it. When skipping existing files, the target is created exclusively, so an existing file is
+        detected by the create itself rather than a separate check that could race. In UPDATE mode, the copy also gets
+        the source's modification time, so the next comparison finds them the same. In CHECKSUM mode, the files have
+        already been compared, so the target is overwritten. A target with other hard links is replaced rather than
+        written through. A partly written target is removed if the copy fails.
+        """
+
+        source_fd = os.open(source, os.O_RDONLY)
+        try:
+            source_stat = os.fstat(source_fd)
+            if copy_mode == UPDATE and _isUnchanged(source_stat, target, mtime_tolerance):
+                return CopyResult(source, target, SKIPPED)
+            stored_paths = self._storedPaths(target)
+            if copy_mode == UPDATE:
+                for _, stored_target in stored_paths:
+                    if _isUnchanged(source_stat, stored_target, mtime_tolerance, False):
+                        return CopyResult(source, stored_target, SKIPPED)
+
+            if link_dest is not None and copy_mode == UPDATE:
+                linked = self._linkUnchanged(source_stat, link_dest, target, mtime_tolerance)
+                if linked is not None:
+                    return CopyResult(source, linked, LINKED)
+
+            if copy_mode == SKIP_EXISTING and stored_paths and (
+                    os.path.lexists(target) or any(os.path.lexists(stored) for _, stored in stored_paths)):
+                return CopyResult(source, target, SKIPPED)
+
+            for strategy in self.strategies:
+                result = strategy.copyFile(source, source_fd, source_stat, target, copy_mode, self.progress)
+                if result is not None:
+                    return result
+
+            flags = os.O_WRONLY | os.O_CREAT | (os.O_EXCL if copy_mode == SKIP_EXISTING else os.O_TRUNC)
+            if copy_mode != SKIP_EXISTING:
+                _unlinkShared(target)
+            try:
+                target_fd = os.open(target, flags, stat.S_IMODE(source_stat.st_mode))
+            except FileExistsError:
+                return CopyResult(source, target, SKIPPED)
+
+            try:
+                try:
+                    size, backend = self.copy_backends.copy(source_fd, target_fd, source_stat.st_size, source_device,
+                                                            target_device)
+                    # The mode given to open only applies to new files, and is masked by the umask
+                    os.fchmod(target_fd, stat.S_IMODE(source_stat.st_mode))
+                    if copy_mode == UPDATE:
+                        os.utime(target_fd if os.utime in os.supports_fd else target,
+                                 ns=(source_stat.st_atime_ns, source_stat.st_mtime_ns))
+                finally:
+                    os.close(target_fd)
+            except BaseException:
+                try:
+                    os.remove(target)
+                except OSError:
+                    pass
+                raise
+        finally:
+            os.close(source_fd)
+
+        if self.progress is not None:
+            self.progress(source, size, size)
+        return CopyResult(source, target, COPIED, size, backend=backend)
+
+    def _linkCandidates(self, link_dest, target):
+        """
+        :return: Tuples of where a file could be in the previous snapshot, where it would be linked to, and the
+        strategy that stored it, or None for a plain copy
+        """
+
+        candidates = [(link_dest, target, None)]
+        for strategy, stored_target in self._storedPaths(target):
+            candidates.append((strategy.storedPath(link_dest), stored_target, strategy))
+        return candidates
+
+    def _linkUnchanged(self, source_stat, link_dest, target, mtime_tolerance):
+        """
+        Hard-links a file's copy in the previous snapshot to the target, if it has the source's size and modification
+        time (only the time, if it is compressed).
+
+        :return: The path linked to, or None if there was no unchanged copy to link
+        """
+
+        for previous, linked, strategy in self._linkCandidates(link_dest, target):
+            if _isUnchanged(source_stat, previous, mtime_tolerance, strategy is None) and \
+                    _hardLink(previous, linked):
+                return linked
+        return None
+
+    def _linkSameContents(self, source, source_stat, link_dest, target):
+        """
+        Hard-links a file's copy in the previous snapshot to the target, if it has the source's contents. Run on the
+        hashing threads.
+
+        :return: The path linked to, or None if there was no unchanged copy to link
+        """
+
+        source_digest = None
+        for previous, linked, strategy in self._linkCandidates(link_dest, target):
+            previous_stat = _regularStat(previous)
+            if previous_stat is None:
+                continue
+            if strategy is None and previous_stat.st_size != source_stat.st_size:
+                continue
+            if source_digest is None:
+                source_digest = self._digest(source, source_stat)
+            hash_function = None if strategy is None else strategy.hashStored
+            if source_digest != self._digest(previous, previous_stat, hash_function):
+                continue
+            if _hardLink(previous, linked):
+                if self.hash_cache is not None:
+                    # The link is the same file, with the same hash
+                    self.hash_cache.store(linked, os.stat(linked), source_digest)
+                return linked
+        return None
+
+    def close(self, cancel=False):
+        """
+        Waits for the queued copies to finish and stops the threads.
+
+        :param cancel: Whether to drop the copies that haven't started yet
+        :return: The CopyReport
+        """
+
+        # The hashing threads hand files on to the copying threads, so they have to finish first
+        if self._hash_pool is not None:
+            self._hash_pool.shutdown(wait=True, cancel_futures=cancel)
+        self._pool.shutdown(wait=True, cancel_futures=cancel)
+        for strategy in self.strategies:
+            strategy.close()
+        self.report.finished = time.monotonic()
+        return self.report
+
+
+def _hardLink(previous, target):
+    """
+    Hard-links a file to the target, replacing whatever is there.
+
+    :return: False if the filesystem can't link it, e.g. because it doesn't support hard links or the file has as
+    many as it can take, so it should be copied instead
+    """
+
+    try:
+        try:
+            os.link(previous, target)
+        except FileExistsError:
+            os.remove(target)
+            os.link(previous, target)
+    except OSError as error:
+        if error.errno in (errno.EMLINK, errno.EXDEV, errno.EPERM, errno.ENOTSUP, errno.EOPNOTSUPP):
+            return False
+        raise
+    return True
+
+
+def _unlinkShared(path):
+    """
+    Removes a file that has other hard links, e.g. one linked from a previous snapshot by an interrupted backup, so
+    overwriting it makes a new file rather than changing the data the other links share.
+    """
+
+    try:
+        path_stat = os.lstat(path)
+    except FileNotFoundError:
+        return
+    if stat.S_ISREG(path_stat.st_mode) and path_stat.st_nlink > 1:
+        os.remove(path)
+
+
+def _regularStat(path):
+    """ :return: The stat result of path if it is a regular file, or None if it isn't or doesn't exist """
+    try:
+        path_stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return path_stat if stat.S_ISREG(path_stat.st_mode) else None
+
+
+def _isUnchanged(source_stat, target, mtime_tolerance, compare_size=True):
+    """
+    :param compare_size: Whether the sizes must match too; not for a compressed target
+    :return: True if the target exists with the same size and modification time (give or take the tolerance)
+    """
+
+    target_stat = _regularStat(target)
+    if target_stat is None:
+        return False
+    return ((not compare_size or target_stat.st_size == source_stat.st_size) and
+            abs(target_stat.st_mtime_ns - source_stat.st_mtime_ns) <= mtime_tolerance * 10 ** 9)
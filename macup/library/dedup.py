@@ -0,0 +1,424 @@
+"""
+A deduplicating store for the target: files are cut into chunks at points chosen by their contents, and each chunk is
+stored once, however many files, runs or configurations it turns up in. Because the cut points depend only on the
+bytes near them, an edit to part of a file only changes the chunks around the edit, so near-identical files share
+most of their chunks.
+
+Chunks are appended to pack files in the target's METADATA_DIR folder, and an SQLite index records where each one is.
+Each backup is a snapshot, whose manifest lists every file with the digests of its chunks in order.
+"""
+
+import hashlib
+import os
+import re
+import sqlite3
+import time
+
+from macup.library.constants import *
+from macup.library.directories import DirectoryMaker
+
+DEFAULT_MIN_CHUNK_SIZE = 16 * 1024
+DEFAULT_AVERAGE_CHUNK_SIZE = 64 * 1024
+DEFAULT_MAX_CHUNK_SIZE = 256 * 1024
+DEFAULT_PACK_SIZE = 256 * 1024 * 1024  # A new pack file is started once the current one is this big
+
+DIGEST_SIZE = 32
+
+_READ_SIZE = 4 * 1024 * 1024
+_HASH_MASK = (1 << 64) - 1
+_HASH_MULTIPLIER = 0x9E3779B97F4A7C15
+_WINDOW_SIZE = 8  # The number of bytes ending at a candidate that decide whether a chunk ends there
+
+# Hashing at every byte in Python is slow, so chunks can only end after candidate bytes, which a regular expression
+# finds at C speed; only at those is the window hashed. The candidates are the byte values whose blake2b digest has
+# its low bits clear, about one in 32 of them, picked pseudo-randomly so text and binary data both have plenty. None
+# of this may ever change, or chunks would be cut in different places than before and stop deduplicating against the
+# ones already stored.
+_CANDIDATE_BITS = 5
+_CANDIDATES = re.compile(b"[" + re.escape(bytes(
+    b for b in range(256) if not hashlib.blake2b(bytes([b]), digest_size=8).digest()[0] & ((1 << _CANDIDATE_BITS) - 1)
+)) + b"]")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS chunks (
+    digest BLOB PRIMARY KEY,
+    pack TEXT NOT NULL,
+    offset INTEGER NOT NULL,
+    size INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS snapshots (
+    id INTEGER PRIMARY KEY,
+    source TEXT NOT NULL,
+    created REAL NOT NULL,
+    complete INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS files (
+    snapshot INTEGER NOT NULL,
+    path TEXT NOT NULL,
+    is_directory INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    mode INTEGER NOT NULL,
+    chunks BLOB,
+    PRIMARY KEY (snapshot, path)
+);
+"""
+
+
+def getDedupDirectory(target_dir):
+    """ :return: The folder in the target's metadata folder holding the pack files and their index """
+    return os.path.join(target_dir, METADATA_DIR, "dedup")
+
+
+def _masks(average_size):
+    """
+    :return: The masks a candidate's hash is tested against before and after the average size. The first has more
+    bits, so cuts are less likely; the second fewer, so they are more likely. This keeps chunk sizes close to the
+    average.
+    """
+
+    bits = average_size.bit_length() - 1 - _CANDIDATE_BITS
+    return (((1 << (bits + 2)) - 1) << (62 - bits)), (((1 << (bits - 2)) - 1) << (66 - bits))
+
+
+def findCut(data, start, end, min_size, average_size, max_size, masks=None):
+    """
+    Finds where the chunk starting at start ends. A chunk ends after a candidate byte whose window (it and the bytes
+    before it) hashes to a value matching the mask, so cut points move with the data when bytes are inserted or
+    removed before them.
+
+    :param data: The bytes being chunked
+    :param start: Where the chunk starts in data
+    :param end: Where the data available ends; if there are fewer than max_size bytes left, this is taken as the end
+    of the file
+    :param masks: The result of _masks(average_size), if already worked out
+    :return: The chunk's length
+    """
+
+    available = end - start
+    if available <= min_size:
+        return available
+    mask_small, mask_large = masks or _masks(average_size)
+
+    # Cut points are never looked for before the minimum size, which also saves looking at those bytes at all
+    normal = start + min(average_size, available)
+    limit = start + min(max_size, available)
+    for match in _CANDIDATES.finditer(data, start + min_size, limit):
+        i = match.start() + 1
+        h = (int.from_bytes(data[i - _WINDOW_SIZE:i], "little") * _HASH_MULTIPLIER) & _HASH_MASK
+        if not h & (mask_small if i <= normal else mask_large):
+            return i - start
+    return limit - start
+
+
+def iterChunks(file, min_size=DEFAULT_MIN_CHUNK_SIZE, average_size=DEFAULT_AVERAGE_CHUNK_SIZE,
+               max_size=DEFAULT_MAX_CHUNK_SIZE):
+    """
+    Cuts a file into content-defined chunks, reading it a few megabytes at a time.
+
+    :param file: A binary file object
+    :param average_size: The size chunks tend towards; must be a power of two
+    :return: A generator of the chunks, as bytes
+    """
+
+    masks = _masks(average_size)
+    buffer = b""
+    end_of_file = False
+    while not end_of_file or buffer:
+        if not end_of_file and len(buffer) < max_size:
+            data = file.read(_READ_SIZE)
+            end_of_file = not data
+            buffer += data
+            continue
+
+        position = 0
+        # Cuts are only made while a whole maximum sized chunk is available, unless the file has ended
+        while len(buffer) - position >= max_size or (end_of_file and position < len(buffer)):
+            length = findCut(buffer, position, len(buffer), min_size, average_size, max_size, masks)
+            yield buffer[position:position + length]
+            position += length
+        buffer = buffer[position:]
+
+
+def chunkDigest(chunk):
+    return hashlib.blake2b(chunk, digest_size=DIGEST_SIZE).digest()
+
+
+def _splitDigests(chunks):
+    return [chunks[i:i + DIGEST_SIZE] for i in range(0, len(chunks), DIGEST_SIZE)]
+
+
+class SnapshotWriter:
+    """
+    Backs a source up into a target's deduplicating store as a new snapshot. Files whose size and modification time
+    match the source's previous snapshot keep their chunk lists without being read; the rest are chunked, and only
+    chunks the store doesn't already have are written. The snapshot is only marked complete when the writer is
+    closed without an error, so a failed backup doesn't become the base of the next one.
+
+    It has the same interface as a PackWriter, so backup can hand it files the same way. Not thread safe.
+    """
+
+    backend = DEDUPLICATED  # The copy backend name reported for stored files
+
+    def __init__(self, target_dir, source_dir, min_size=DEFAULT_MIN_CHUNK_SIZE,
+                 average_size=DEFAULT_AVERAGE_CHUNK_SIZE, max_size=DEFAULT_MAX_CHUNK_SIZE,
+                 pack_size=DEFAULT_PACK_SIZE):
+        """
+        :param target_dir: The target directory
+        :param source_dir: The directory being backed up; its previous snapshot is found by this
+        :param min_size: The smallest a chunk can be, other than the last of a file
+        :param average_size: The size chunks tend towards; must be a power of two
+        :param max_size: The largest a chunk can be
+        :param pack_size: The size at which a pack file is closed and a new one started
+        """
+
+        if average_size & (average_size - 1) or not _WINDOW_SIZE <= min_size < average_size < max_size \
+                or average_size < 1 << (_CANDIDATE_BITS + 3):
+            raise ValueError("average_size must be a power of two of at least 256, between min_size and max_size")
+
+        self.dedup_dir = getDedupDirectory(target_dir)
+        os.makedirs(self.dedup_dir, exist_ok=True)
+        self.min_size = min_size
+        self.average_size = average_size
+        self.max_size = max_size
+        self.pack_size = pack_size
+        self.logical_bytes = 0  # The size of all the files in the snapshot
+        self.stored_bytes = 0  # The size of the chunks this snapshot added to the store
+
+        self.connection = sqlite3.connect(os.path.join(self.dedup_dir, "index.sqlite"))
+        self.connection.executescript(_SCHEMA)
+        source_dir = os.path.abspath(source_dir)
+        row = self.connection.execute("SELECT max(id) FROM snapshots WHERE source = ? AND complete = 1",
+                                      (source_dir,)).fetchone()
+        self.previous_snapshot = row[0]
+        self.snapshot = self.connection.execute("INSERT INTO snapshots (source, created) VALUES (?, ?)",
+                                                (source_dir, time.time())).lastrowid
+
+        self._pack = None
+        self._pack_name = None
+        self._pack_offset = 0
+        self._run_name = time.strftime("%Y%m%d-%H%M%S")
+        self._pack_count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close(complete=exc_type is None)
+
+    def close(self, complete=True):
+        """
+        :param complete: Whether the snapshot holds the whole backup, so the next one can be based on it
+        """
+
+        self._closePack()
+        if complete:
+            self.connection.execute("UPDATE snapshots SET complete = 1 WHERE id = ?", (self.snapshot,))
+        self.connection.commit()
+        self.connection.close()
+
+    def _closePack(self):
+        if self._pack is not None:
+            # The chunks must be on disk before the index that points at them is committed
+            self._pack.flush()
+            os.fsync(self._pack.fileno())
+            self._pack.close()
+            self._pack = None
+
+    def _openPack(self):
+        while True:
+            self._pack_count += 1
+            name = f"pack-{self._run_name}-{self._pack_count:04}.pack"
+            path = os.path.join(self.dedup_dir, name)
+            if not os.path.exists(path):
+                break
+        self._pack = open(path, "xb")
+        self._pack_name = name
+        self._pack_offset = 0
+
+    def _storeChunk(self, chunk, digest):
+        """ Writes a chunk to the current pack file, unless the store already has it """
+        if self.connection.execute("SELECT 1 FROM chunks WHERE digest = ?", (digest,)).fetchone() is not None:
+            return 0
+        if self._pack is None or self._pack_offset >= self.pack_size:
+            self._closePack()
+            self._openPack()
+        self._pack.write(chunk)
+        self.connection.execute("INSERT INTO chunks (digest, pack, offset, size) VALUES (?, ?, ?, ?)",
+                                (digest, self._pack_name, self._pack_offset, len(chunk)))
+        self._pack_offset += len(chunk)
+        self.stored_bytes += len(chunk)
+        return len(chunk)
+
+    def shouldPack(self, stat):
+        """ Every file goes into the store, whatever its size """
+        return True
+
+    def addDirectory(self, relative_path, stat):
+        """ Records a directory in the snapshot, so it is recreated on restore even if it is empty """
+        self.connection.execute(
+            "INSERT OR REPLACE INTO files (snapshot, path, is_directory, size, mtime_ns, mode) "
+            "VALUES (?, ?, 1, 0, ?, ?)",
+            (self.snapshot, relative_path, stat.st_mtime_ns, stat.st_mode))
+
+    def packFile(self, source, relative_path, stat, copy_mode, mtime_tolerance=0.0):
+        """
+        Adds a file to the snapshot. With SKIP_EXISTING, a file in the previous snapshot keeps its chunks from there,
+        and with UPDATE, so does one whose size and modification time match. Otherwise the file is chunked; with
+        CHECKSUM this is the comparison, as only chunks whose contents are new are written.
+
+        :param source: The path of the file
+        :param relative_path: The path to restore it to, relative to the restore's destination
+        :param stat: A stat result of the file
+        :param copy_mode: SKIP_EXISTING, OVERWRITE, UPDATE or CHECKSUM
+        :param mtime_tolerance: In UPDATE mode, how many seconds modification times may differ by and still count as
+        the same
+        :return: The number of bytes written to the store, or None if the file was kept from the previous snapshot
+        """
+
+        if self.previous_snapshot is not None and copy_mode in (SKIP_EXISTING, UPDATE):
+            row = self.connection.execute(
+                "SELECT size, mtime_ns, mode, chunks FROM files WHERE snapshot = ? AND path = ? AND is_directory = 0",
+                (self.previous_snapshot, relative_path)).fetchone()
+            if row is not None and (copy_mode == SKIP_EXISTING or (
+                    row[0] == stat.st_size and abs(row[1] - stat.st_mtime_ns) <= mtime_tolerance * 10 ** 9)):
+                self._addFileRow(relative_path, row[0], row[1], row[2], row[3])
+                return None
+
+        digests = []
+        written = size = 0
+        with open(source, "rb") as f:
+            stat = os.fstat(f.fileno())
+            for chunk in iterChunks(f, self.min_size, self.average_size, self.max_size):
+                digest = chunkDigest(chunk)
+                written += self._storeChunk(chunk, digest)
+                digests.append(digest)
+                size += len(chunk)
+        self._addFileRow(relative_path, size, stat.st_mtime_ns, stat.st_mode, b"".join(digests))
+        return written
+
+    def _addFileRow(self, relative_path, size, mtime_ns, mode, chunks):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO files (snapshot, path, is_directory, size, mtime_ns, mode, chunks) "
+            "VALUES (?, ?, 0, ?, ?, ?, ?)", (self.snapshot, relative_path, size, mtime_ns, mode, chunks))
+        self.logical_bytes += size
+
+
+class SnapshotReader:
+    """
+    Reads files back out of a target's deduplicating store.
+    """
+
+    def __init__(self, target_dir):
+        """
+        :param target_dir: The target directory a SnapshotWriter wrote to
+        """
+
+        self.dedup_dir = getDedupDirectory(target_dir)
+        self.connection = sqlite3.connect(os.path.join(self.dedup_dir, "index.sqlite"))
+        self.connection.executescript(_SCHEMA)
+        self._packs = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        for pack in self._packs.values():
+            pack.close()
+        self._packs.clear()
+        self.connection.close()
+
+    def snapshots(self, source_dir=None):
+        """
+        :param source_dir: Only list the snapshots of this source, if given
+        :return: A list of (snapshot id, source, creation time) tuples of the complete snapshots, oldest first
+        """
+
+        if source_dir is None:
+            rows = self.connection.execute("SELECT id, source, created FROM snapshots WHERE complete = 1 ORDER BY id")
+        else:
+            rows = self.connection.execute(
+                "SELECT id, source, created FROM snapshots WHERE complete = 1 AND source = ? ORDER BY id",
+                (os.path.abspath(source_dir),))
+        return rows.fetchall()
+
+    def latest(self, source_dir):
+        """ :return: The id of a source's most recent complete snapshot, or None if it has none """
+        snapshots = self.snapshots(source_dir)
+        return snapshots[-1][0] if snapshots else None
+
+    def paths(self, snapshot, prefix=""):
+        """ :return: The relative paths of the files and directories in a snapshot under a prefix, parents first """
+        rows = self.connection.execute(
+            "SELECT path FROM files WHERE snapshot = ? AND path >= ? AND path < ? ORDER BY path",
+            (snapshot, prefix, prefix + "\U0010ffff"))
+        return [row[0] for row in rows]
+
+    def _readChunk(self, digest):
+        row = self.connection.execute("SELECT pack, offset, size FROM chunks WHERE digest = ?", (digest,)).fetchone()
+        if row is None:
+            raise FileNotFoundError(f"The chunk {digest.hex()} is missing from the store")
+        pack_name, offset, size = row
+        pack = self._packs.get(pack_name)
+        if pack is None:
+            pack = self._packs[pack_name] = open(os.path.join(self.dedup_dir, pack_name), "rb")
+        pack.seek(offset)
+        chunk = pack.read(size)
+        if chunkDigest(chunk) != digest:
+            raise ValueError(f"The chunk {digest.hex()} in {pack_name} is corrupt")
+        return chunk
+
+    def _fileRow(self, snapshot, relative_path):
+        row = self.connection.execute(
+            "SELECT chunks FROM files WHERE snapshot = ? AND path = ? AND is_directory = 0",
+            (snapshot, relative_path)).fetchone()
+        if row is None:
+            raise FileNotFoundError(f"{relative_path} is not in snapshot {snapshot}")
+        return row[0]
+
+    def read(self, snapshot, relative_path):
+        """ :return: The contents of a file in a snapshot """
+        return b"".join(self._readChunk(digest) for digest in _splitDigests(self._fileRow(snapshot, relative_path)))
+
+    def restore(self, snapshot, destination, prefix=""):
+        """
+        Restores the files and directories of a snapshot, with their modes and modification times. Each chunk is
+        checked against its digest as it is read.
+
+        :param snapshot: The id of the snapshot, e.g. from latest
+        :param destination: The directory to restore into; the files' relative paths are kept under it
+        :param prefix: Only restore paths starting with this, e.g. a folder's relative path followed by a separator
+        :return: The number of files restored
+        """
+
+        rows = self.connection.execute(
+            "SELECT path, is_directory, mtime_ns, mode, chunks FROM files "
+            "WHERE snapshot = ? AND path >= ? AND path < ? ORDER BY path",
+            (snapshot, prefix, prefix + "\U0010ffff")).fetchall()
+
+        directories = [row for row in rows if row[1]]
+        directory_maker = DirectoryMaker()
+        directory_maker.makeAll(os.path.join(destination, row[0]) for row in directories)
+
+        restored = 0
+        for path, is_directory, mtime_ns, mode, chunks in rows:
+            if is_directory:
+                continue
+            file_path = os.path.join(destination, path)
+            directory_maker.make(os.path.dirname(file_path))
+            with open(file_path, "wb") as f:
+                for digest in _splitDigests(chunks):
+                    f.write(self._readChunk(digest))
+            os.chmod(file_path, mode & 0o7777)
+            os.utime(file_path, ns=(mtime_ns, mtime_ns))
+            restored += 1
+
+        # Directory times are set last, as adding files to them changes them
+        for path, _, mtime_ns, mode, _ in reversed(directories):
+            directory = os.path.join(destination, path)
+            os.chmod(directory, mode & 0o7777)
+            os.utime(directory, ns=(mtime_ns, mtime_ns))
+        return restored
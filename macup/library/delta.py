@@ -0,0 +1,189 @@
+"""
+Delta updates of large files: instead of rewriting the whole target when the source has changed, only the blocks that
+differ are written, in place. A database or disk image with a few changed pages has a few blocks written rather than
+all of it.
+
+Each block of the source is compared with the block at the same offset in the target. The target's blocks are
+compared by their digests where a signature cache has them, so an unchanged target isn't even read; otherwise they
+are read and compared directly. Once a target is patched, its new signatures are cached for next time.
+"""
+
+import hashlib
+import os
+import sqlite3
+import stat
+import threading
+
+from macup.library.constants import *
+
+DELTA_THRESHOLD = 64 * 1024 * 1024  # Files at least this big are delta updated
+DEFAULT_BLOCK_SIZE = 64 * 1024
+
+DELTA = 'DELTA'  # The copy backend name reported for delta updated files
+
+_DIGEST_SIZE = 16
+_PROGRESS_INTERVAL = 16 * 1024 * 1024
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS signatures (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    inode INTEGER NOT NULL,
+    block_size INTEGER NOT NULL,
+    digests BLOB NOT NULL
+);
+"""
+
+
+def getSignatureCachePath(target_dir):
+    """ :return: The path of the signature cache of a backup, in the target's metadata folder """
+    return os.path.join(target_dir, METADATA_DIR, "signatures.sqlite")
+
+
+def blockDigest(data):
+    return hashlib.blake2b(data, digest_size=_DIGEST_SIZE).digest()
+
+
+class SignatureCache:
+    """
+    An SQLite file of the block digests of files in the target, each stored with the size, mtime and inode the file
+    had when its blocks were hashed. Signatures are only trusted while all three still match. It can be shared between
+    threads.
+    """
+
+    def __init__(self, cache_path):
+        """
+        :param cache_path: Path of the cache file; it is created if it doesn't exist
+        """
+
+        if cache_path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok=True)
+        self.connection = sqlite3.connect(cache_path, check_same_thread=False)
+        self.connection.executescript(_SCHEMA)
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        with self._lock:
+            self.connection.commit()
+            self.connection.close()
+
+    def lookup(self, path, stat, block_size):
+        """
+        :return: The digests of a file's blocks, or None if they aren't cached for its current metadata and the block
+        size
+        """
+
+        with self._lock:
+            row = self.connection.execute(
+                "SELECT size, mtime_ns, inode, block_size, digests FROM signatures WHERE path = ?", (path,)).fetchone()
+        if row is None or row[:4] != (stat.st_size, stat.st_mtime_ns, stat.st_ino, block_size):
+            return None
+        digests = row[4]
+        return [digests[i:i + _DIGEST_SIZE] for i in range(0, len(digests), _DIGEST_SIZE)]
+
+    def store(self, path, stat, block_size, digests):
+        with self._lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO signatures (path, size, mtime_ns, inode, block_size, digests) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (path, stat.st_size, stat.st_mtime_ns, stat.st_ino, block_size, b"".join(digests)))
+            self.connection.commit()
+
+    def forget(self, path):
+        with self._lock:
+            self.connection.execute("DELETE FROM signatures WHERE path = ?", (path,))
+            self.connection.commit()
+
+
+def canDeltaUpdate(source_stat, target_stat, threshold=DELTA_THRESHOLD):
+    """
+    :param source_stat: A stat result of the source
+    :param target_stat: A stat result of the target, or None if it doesn't exist
+    :return: True if the source is big enough to be worth it, and the target can be patched: a regular file with no
+    other hard links, which patching would change too
+    """
+
+    return (source_stat.st_size >= threshold and target_stat is not None and stat.S_ISREG(target_stat.st_mode) and
+            target_stat.st_nlink == 1)
+
+
+def deltaUpdate(source_fd, source_stat, target, signature_cache=None, block_size=DEFAULT_BLOCK_SIZE,
+                preserve_mtime=False, progress=None, source=None):
+    """
+    Patches a target to match the source, writing only the blocks that differ. The target is changed in place, so if
+    it is interrupted the target is part old and part new; its modification time is only set at the end, so an
+    UPDATE mode backup still finds it out of date.
+
+    :param source_fd: A file descriptor of the source, open for reading
+    :param source_stat: The fstat result of source_fd
+    :param target: The path of the existing target
+    :param signature_cache: A SignatureCache, so the target's blocks needn't be read to be compared
+    :param block_size: The size of the blocks compared and written
+    :param preserve_mtime: Whether the target gets the source's modification time
+    :param progress: A function called every so often with the source path, the bytes compared so far and the total
+    :param source: The source path, passed to progress
+    :return: The number of bytes written
+    """
+
+    size = source_stat.st_size
+    target_fd = os.open(target, os.O_RDWR)
+    try:
+        target_stat = os.fstat(target_fd)
+        digests = None
+        if signature_cache is not None:
+            digests = signature_cache.lookup(target, target_stat, block_size)
+            # The target is about to change, so its signatures are out of date even if this doesn't finish
+            signature_cache.forget(target)
+
+        written = 0
+        new_digests = []
+        offset = 0
+        last_progress = 0
+        while offset < size:
+            data = os.pread(source_fd, min(block_size, size - offset), offset)
+            if not data:
+                # The source shrank while it was being read
+                break
+            block = offset // block_size
+            if digests is not None and block < len(digests):
+                digest = blockDigest(data)
+                same = digest == digests[block]
+            else:
+                digest = None
+                same = os.pread(target_fd, len(data), offset) == data
+            if not same:
+                view = memoryview(data)
+                position = offset
+                while view:
+                    length = os.pwrite(target_fd, view, position)
+                    view = view[length:]
+                    position += length
+                written += len(data)
+            if signature_cache is not None:
+                new_digests.append(digest if digest is not None else blockDigest(data))
+            offset += len(data)
+            if progress is not None and offset - last_progress >= _PROGRESS_INTERVAL:
+                progress(source, offset, size)
+                last_progress = offset
+
+        if target_stat.st_size != offset:
+            os.ftruncate(target_fd, offset)
+        os.fchmod(target_fd, stat.S_IMODE(source_stat.st_mode))
+        if preserve_mtime:
+            os.utime(target_fd if os.utime in os.supports_fd else target,
+                     ns=(source_stat.st_atime_ns, source_stat.st_mtime_ns))
+        if signature_cache is not None:
+            signature_cache.store(target, os.fstat(target_fd), block_size, new_digests)
+    finally:
+        os.close(target_fd)
+
+    if progress is not None:
+        progress(source, offset, size)
+    return written
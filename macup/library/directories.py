@@ -0,0 +1,103 @@
+"""
+Creation of directories in the target, each with a single os.mkdir.
+
+os.makedirs(exist_ok=True) checks every ancestor of the directory it is given, so making a whole tree of directories
+with it stats each one again for every directory under it. A DirectoryMaker remembers the directories it has made or
+found, so a directory whose parent is known to exist is made with one mkdir and no stat at all, and one that is known
+to exist already, from a previous run's index of the target, costs no syscall. If the index turns out to be wrong,
+because a directory it has is missing from the target, the directory's parents are checked after all.
+"""
+
+import os
+
+
+def topologicalOrder(directories):
+    """
+    :param directories: An iterable of directory paths
+    :return: The directories sorted so every directory comes after its parent, and siblings' contents stay together
+    """
+
+    return sorted(directories, key=lambda directory: os.path.normpath(directory).split(os.sep))
+
+
+class DirectoryMaker:
+    """
+    Makes directories and their missing parents, remembering every directory it has made or found to exist, so each
+    is made, or found, once. Directories are best made parents first, as the scanner yields them, so each is made
+    with a single mkdir. Not safe to share between threads.
+    """
+
+    def __init__(self, known=None):
+        """
+        :param known: A container of directory paths known to exist in the target, e.g. from an index of the target,
+        which are then taken as existing without being checked
+        """
+
+        self.known = known
+        self._existing = set()
+        self._trusted = set()  # Directories taken as existing because known has them
+        self.made = 0  # The number of directories made, rather than found
+        self.missing_known = 0  # The number of directories known has that turned out to be missing, and were made
+
+    def _exists(self, directory, trust_known):
+        if directory in self._existing:
+            return True
+        if trust_known and self.known is not None:
+            if directory in self._trusted:
+                return True
+            if directory in self.known:
+                self._trusted.add(directory)
+                return True
+        return False
+
+    def _mkdir(self, directory):
+        try:
+            os.mkdir(directory)
+        except FileExistsError:
+            # Only stat'ed when it already exists, to make sure it is a directory
+            if not os.path.isdir(directory):
+                raise
+        else:
+            self.made += 1
+            if directory in self._trusted:
+                self._trusted.discard(directory)
+                self.missing_known += 1
+        self._existing.add(directory)
+
+    def make(self, directory):
+        """
+        Makes a directory, and any of its parents that don't exist yet.
+
+        :param directory: The directory's path
+        :raise FileExistsError: If something other than a directory is in the way
+        """
+
+        try:
+            self._make(directory, True)
+        except FileNotFoundError:
+            if not self._trusted:
+                raise
+            # A parent taken as existing because known has it is missing, so the parents are checked this time
+            self._make(directory, False)
+
+    def _make(self, directory, trust_known):
+        # The directory is made straight away, and only if its parent turns out to be missing are the parents walked
+        # up, so a tree made from the top down costs one mkdir per directory
+        missing = []
+        while not self._exists(directory, trust_known):
+            try:
+                self._mkdir(directory)
+                break
+            except FileNotFoundError:
+                parent = os.path.dirname(directory)
+                if not parent or parent == directory:
+                    raise
+                missing.append(directory)
+                directory = parent
+        for path in reversed(missing):
+            self._mkdir(path)
+
+    def makeAll(self, directories):
+        """ Makes every directory in an iterable, in topological order """
+        for directory in topologicalOrder(directories):
+            self.make(directory)
@@ -4,81 +4,459 @@
 
 from macup.library.constants import *
 
+from collections import OrderedDict
+from datetime import datetime
 import os
 import re
+import time
 
+_REGEX_SPECIAL_CHARS = set(".^$*+?{}[]\\|()")
 
-def applyFilters(filters, path):
-    """
-    Checks whether a certain path satisfies all the filters provided.
+_SIZE_UNITS = {"": 1, "B": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+_SIZE_REGEX = re.compile(r"\s*(\d+(?:\.\d+)?)\s*([KMGT]?)(?:I?B)?\s*", re.IGNORECASE)
+_DURATION_UNITS = {"s": 1, "m": 60, "h": 60 * 60, "d": 24 * 60 * 60, "w": 7 * 24 * 60 * 60}
+_DURATION_REGEX = re.compile(r"\s*(\d+(?:\.\d+)?)\s*([smhdw])\s*", re.IGNORECASE)
 
-    :param filters: List of filters to be applied
-    :param path: A path for the filters to be applied on
-    :return: True if the node path satisfies each filter, False otherwise
+
+class CompiledFilter:
+    """
+    A list of filters prepared once for applying to many items: regexes are compiled, and the rules are split by the
+    item type they apply to, so checking an item only runs the rules that apply to it, stopping at the first one
+    that rejects it. Calling the object checks an item, so it can be passed anywhere a filter function is expected.
     """
 
-    def handleFilter(filter_, path_):
+    def __init__(self, filters):
         """
-        Handles the logic of the filter and applies it to the item path provided.
+        :param filters: List of Filter objects
+        """
+
+        self.filters = list(filters)
+        self._directory_rules = self._compileRules([rule for rule in self.filters if rule.item_type != FILES], True)
+        self._file_rules = self._compileRules([rule for rule in self.filters if rule.item_type != DIRECTORY], False)
+        self._prune_tests = analyseFilters(self.filters)
 
-        :param filter_: A filter object
-        :param path_: The path to be analysed
-        :return: Whether this item should be copied according to the filter
+    @staticmethod
+    def _compileRules(filters, is_directory):
+        """
+        :return: A list of (subject, test function, whitelist) tuples, cheapest tests first. The subject is FILENAMES
+        or PATHS for tests of a string, or None for metadata tests, which are given the item's stat result.
         """
 
-        # Decide whether to apply the filter to the filename or the full path
-        if filter_.application == FILENAMES:
-            str_to_use = os.path.basename(path_)
+        keyword_rules, regex_rules, metadata_rules = [], [], []
+        now = time.time()
+        for filter_ in filters:
+            if filter_.filter_type in METADATA_FILTER_TYPES:
+                if is_directory:
+                    # A directory's own size and modification time say nothing about what is in it
+                    continue
+                metadata_rules.append((None, metadataTest(filter_, now), filter_.whitelist))
+            elif filter_.filter_type == REGEX:
+                if is_directory and filter_.whitelist and filter_.application == PATHS:
+                    test = directoryWhitelistTest(filter_.data)
+                else:
+                    test = lambda string, match_=re.compile(filter_.data).match: match_(string) is not None
+                regex_rules.append((filter_.application, test, filter_.whitelist))
+            else:  # Type must be KEYWORD
+                keyword = filter_.data
+                keyword_rules.append((filter_.application,
+                                      lambda string, keyword_=keyword: keyword_ in string, filter_.whitelist))
+        return keyword_rules + regex_rules + metadata_rules
+
+    def __call__(self, item):
+        """
+        :param item: A path, or an entry from the scanner; an entry's type and stat result are used as is, while a
+        path is checked
+        :return: True if the item satisfies all the filters, False otherwise
+        """
+
+        if isinstance(item, str):
+            is_directory = os.path.isdir(item)
+            return self.matches(item, is_directory, not is_directory and os.path.isfile(item))
+        is_directory = item.is_dir()
+        return self.matches(item.path, is_directory, not is_directory and item.is_file(), item.stat)
+
+    def matches(self, path, is_directory, is_file, stat=None):
+        """
+        Checks whether an item of a known type satisfies all the filters. Items that are neither directories nor files
+        (e.g. missing paths) are not affected by any filter.
+
+        :param path: The item's path
+        :param is_directory: Whether the item is a directory
+        :param is_file: Whether the item is a file
+        :param stat: A function returning the item's stat result, e.g. an entry's stat method, only called if a
+        metadata filter needs it; the path is stat'ed if None
+        :return: True if the item satisfies all the filters, False otherwise
+        """
+
+        if is_directory:
+            rules = self._directory_rules
+        elif is_file:
+            rules = self._file_rules
         else:
-            str_to_use = path_
+            return True
 
-        # Decide whether the filter should be applied to the item according to whether it is a file or directory
-        if (filter_.item_type != FILES and os.path.isdir(path_)) \
-                or (filter_.item_type != DIRECTORY and os.path.isfile(path_)):
-            # The filter applies to directories and the item is a dir OR
-            # the filter applies to files and the item is a file OR the filter checks both:
+        name = stat_result = None
+        for subject, test, whitelist in rules:
+            if subject == FILENAMES:
+                if name is None:
+                    name = os.path.basename(path)
+                string = name
+            elif subject == PATHS:
+                string = path
+            else:
+                if stat_result is None:
+                    try:
+                        stat_result = stat() if stat is not None else os.stat(path)
+                    except OSError:
+                        # Removed since it was found, so it isn't affected by any filter, like a missing path
+                        return True
+                string = stat_result
 
             # If the item matches the filter and a whitelist is used, the result is true; the item should be copied
             # If the item doesn't match the filter and a blacklist is used, the result is also true, so copy
-            # Else, the item should not be copied.
             # In other words, if the result is equal to the whitelist state, copy the item.
-            # Whitelist allows items that match the filter, and blacklist allow items that don't match the filter.
+            if test(string) is not whitelist:
+                return False
 
-            # Different filter logic here
-            if filter_.filter_type == REGEX:
-                # Regex filter
-                match = bool(re.match(filter_.data, str_to_use))
-                result = match is filter_.whitelist  # Apply whitelist
-            else:  # Type must be KEYWORD
-                # Keyword filter
-                kw_in_str = filter_.data in str_to_use
-                result = kw_in_str is filter_.whitelist  # Apply whitelist
+        return True
+
+    def canContainMatches(self, directory):
+        """
+        Checks whether any item under a directory, file or directory, could satisfy the filters, judging by the
+        directory's path alone. If not, there is no need to look inside it.
+
+        :param directory: A directory path, as the scanner produces it
+        :return: False if no item under the directory can be accepted, True if one might be
+        """
+
+        directory_prefix = directory.rstrip(os.sep) + os.sep
+        return not any(test(directory_prefix) for test in self._prune_tests)
+
+    def __repr__(self):
+        return f"CompiledFilter(filters={self.filters})"
+
+
+def parseSize(data):
+    """
+    :param data: A size, as a number of bytes optionally followed by a unit, e.g. "500", "500MB", "1.5G" or "2 GiB";
+    units are powers of 1024
+    :return: The size in bytes
+    """
+
+    match = _SIZE_REGEX.fullmatch(data)
+    if match is None:
+        raise ValueError(f"'{data}' is not a size, e.g. '500MB' or '2G'.")
+    return int(float(match.group(1)) * _SIZE_UNITS[match.group(2).upper()])
+
+
+def parseDate(data):
+    """
+    :param data: A date in ISO format, with an optional time, e.g. "2024-01-31" or "2024-01-31 18:30"; without a
+    timezone, it is taken as local time
+    :return: The date as a timestamp
+    """
+
+    try:
+        return datetime.fromisoformat(data.strip()).timestamp()
+    except ValueError:
+        raise ValueError(f"'{data}' is not a date, e.g. '2024-01-31' or '2024-01-31 18:30'.") from None
+
+
+def parseDuration(data):
+    """
+    :param data: A duration, as a number followed by s, m, h, d or w (seconds, minutes, hours, days or weeks), e.g.
+    "30d"
+    :return: The duration in seconds
+    """
+
+    match = _DURATION_REGEX.fullmatch(data)
+    if match is None:
+        raise ValueError(f"'{data}' is not a duration, e.g. '30d' or '12h'.")
+    return float(match.group(1)) * _DURATION_UNITS[match.group(2).lower()]
+
+
+def metadataTest(filter_, now=None):
+    """
+    Builds the test of a metadata filter (a type in METADATA_FILTER_TYPES), which checks an item's stat result, so it
+    can use the stat the scanner already made.
+
+    :param filter_: A Filter object of a metadata type
+    :param now: The time ages are measured from; the current time if None
+    :return: A function taking a stat result, and returning True if the item matches the filter
+    """
+
+    filter_type = filter_.filter_type
+    if filter_type == SIZE_GREATER:
+        size = parseSize(filter_.data)
+        return lambda stat: stat.st_size > size
+    if filter_type == SIZE_LESS:
+        size = parseSize(filter_.data)
+        return lambda stat: stat.st_size < size
+    if filter_type == MODIFIED_BEFORE:
+        date = parseDate(filter_.data)
+        return lambda stat: stat.st_mtime < date
+    if filter_type == MODIFIED_AFTER:
+        date = parseDate(filter_.data)
+        return lambda stat: stat.st_mtime > date
+
+    cutoff = (time.time() if now is None else now) - parseDuration(filter_.data)
+    if filter_type == OLDER_THAN:
+        return lambda stat: stat.st_mtime < cutoff
+    if filter_type == NEWER_THAN:
+        return lambda stat: stat.st_mtime > cutoff
+    raise ValueError(f"'{filter_type}' is not a metadata filter type.")
+
+
+def _splitLiteralPrefix(pattern):
+    """
+    Finds the literal text any string matched by a regex (with re.match) must start with.
+
+    :param pattern: A regex pattern
+    :return: A tuple of the literal prefix, and the rest of the pattern after it
+    """
+
+    if _hasTopLevelAlternation(pattern):
+        # Any branch could match, so nothing is certain
+        return "", pattern
+
+    prefix = []
+    i = 1 if pattern.startswith("^") else 0  # re.match is anchored anyway
+    while i < len(pattern):
+        char = pattern[i]
+        if char == "\\" and i + 1 < len(pattern) and not pattern[i + 1].isalnum():
+            literal, length = pattern[i + 1], 2
+        elif char in _REGEX_SPECIAL_CHARS:
+            break
         else:
-            # The regex does not apply to this item
-            result = True
+            literal, length = char, 1
 
-        return result
+        quantifier = pattern[i + length:i + length + 1]
+        if quantifier in ("*", "?", "{"):
+            # The literal is optional (or its count is unknown), so the prefix ends before it
+            break
+        prefix.append(literal)
+        i += length
+        if quantifier == "+":
+            # The literal is there at least once, but what follows is unknown
+            break
+
+    return "".join(prefix), pattern[i:]
+
+
+def directoryWhitelistTest(pattern):
+    """
+    Builds the test of a whitelist regex applying to directories' paths. Directories that don't match it are still
+    accepted if they lead to its literal prefix, or are under the prefix where the rest of it starts with .*, as
+    items inside them could match; otherwise the scanner would never reach anything the regex matches, e.g. under
+    /Users/me/Documents for /Users/me/Documents/Projects/.*/src/.
+
+    :param pattern: A regex pattern
+    :return: A function taking a directory path and returning True if the directory passes the whitelist
+    """
+
+    match = re.compile(pattern).match
+    prefix, rest = _splitLiteralPrefix(pattern)
+    if not prefix:
+        return lambda path: match(path) is not None
+    anything_under = rest.startswith(".*")
 
-    results = []
-    for f in filters:
-        results.append(handleFilter(f, path))
+    def test(path):
+        if match(path) is not None:
+            return True
+        directory_prefix = path.rstrip(os.sep) + os.sep
+        return prefix.startswith(directory_prefix) or (anything_under and directory_prefix.startswith(prefix))
 
-    return all(results)
+    return test
+
+
+def _hasTopLevelAlternation(pattern):
+    """ :return: True if the pattern has a | that isn't inside a group or a character set """
+    depth = 0
+    in_set = escaped = False
+    for char in pattern:
+        if escaped:
+            escaped = False
+        elif char == "\\":
+            escaped = True
+        elif in_set:
+            in_set = char != "]"
+        elif char == "[":
+            in_set = True
+        elif char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+        elif char == "|" and depth == 0:
+            return True
+    return False
+
+
+def analyseFilters(filters):
+    """
+    Works out, from the filters applying to whole paths, tests that prove every item under a directory will be
+    rejected, using only the directory's path:
+     - a whitelist regex must match from the start, so its literal prefix must be compatible with the directory;
+     - a blacklist regex that is only a literal (optionally followed by .*) rejects everything under a directory
+       starting with it;
+     - a blacklist keyword in the directory's path is in the path of everything under it.
+    Directories under the directory are items too, so a filter that only applies to files proves nothing on its own:
+    it takes one that also rejects every directory beneath. The scanner doesn't list directories the filters reject,
+    so what a test saves is listing a directory that passes but holds nothing that does, e.g. Library for a blacklist
+    of Library/; a whitelist of files and folders keeps the scan to the folders leading to what it matches by itself
+    (see directoryWhitelistTest).
+
+    :param filters: List of Filter objects
+    :return: A list of functions, each taking a directory path ending in a separator and returning True if the
+    directory cannot contain any accepted item
+    """
+
+    tests, file_tests, directory_tests = [], [], []
+    for filter_ in filters:
+        if filter_.application != PATHS:
+            # Filenames under a directory could be anything
+            continue
+
+        test = None
+        if filter_.filter_type == REGEX:
+            prefix, rest = _splitLiteralPrefix(filter_.data)
+            if filter_.whitelist and prefix:
+                # Items under the directory start with its path, and must also start with the prefix
+                test = lambda directory, prefix_=prefix: not (directory.startswith(prefix_) or
+                                                              prefix_.startswith(directory))
+            elif not filter_.whitelist and prefix and rest in ("", ".*"):
+                test = lambda directory, prefix_=prefix: directory.startswith(prefix_)
+        elif filter_.filter_type == KEYWORD and not filter_.whitelist:
+            test = lambda directory, keyword=filter_.data: keyword in directory
+
+        if test is None:
+            continue
+        if filter_.item_type == FILES:
+            file_tests.append(test)
+        elif filter_.item_type == DIRECTORY:
+            directory_tests.append(test)
+        else:
+            tests.append(test)
+
+    if file_tests and directory_tests:
+        # Files rejected by one filter, and directories by another
+        tests.append(lambda directory: any(test(directory) for test in file_tests) and
+                     any(test(directory) for test in directory_tests))
+    return tests
+
+
+def applyFilters(filters, path):
+    """
+    Checks whether a certain path satisfies all the filters provided.
+
+    :param filters: List of filters to be applied
+    :param path: A path for the filters to be applied on
+    :return: True if the node path satisfies each filter, False otherwise
+    """
+
+    return CompiledFilter(filters)(path)
 
 
 def buildFilter(filters):
     """
-    Builds the filter function to be passed to the FileTree constructors;
+    Builds the filter function to be passed to the FileTree constructors and the scanner;
      the filter function has to have one parameter.
 
     :param filters: List of filters
-    :return: The filter function, which takes one argument, suitable for the FileTree constructor
+    :return: A CompiledFilter, which takes one argument (a path or a scanner entry), suitable for the FileTree
+    constructor
+    """
+
+    return CompiledFilter(filters)
+
+
+def filtersFingerprint(filters):
+    """
+    :param filters: List of Filter objects
+    :return: A hashable value identifying the contents of the filters; it changes whenever any filter is changed
     """
 
-    def filter_(path):
-        return applyFilters(filters, path)
+    return tuple((filter_.name, filter_.filter_type, filter_.data, filter_.application, filter_.item_type,
+                  filter_.whitelist) for filter_ in filters)
+
+
+class FilterCache:
+    """
+    Remembers the results of applying filters to paths, for the filter testing parts of the UI, which apply the
+    filters again on every change. Results are keyed by the filters' fingerprint, so changing a filter never returns
+    a stale result. Whether a path is a file or directory is also remembered for a few seconds, so slow (e.g.
+    network) paths aren't checked again on every keystroke. The least recently used entries are dropped first.
+    Results of metadata filters are never remembered, as they change with the item's size and age.
+    """
+
+    def __init__(self, max_size=1024, type_lifetime=5.0):
+        """
+        :param max_size: The most results (and item types) to remember
+        :param type_lifetime: How long to trust a remembered item type, in seconds
+        """
+
+        self.max_size = max_size
+        self.type_lifetime = type_lifetime
+        self._results = OrderedDict()  # (fingerprint, path, item type) -> result
+        self._compiled = OrderedDict()  # fingerprint -> CompiledFilter
+        self._types = OrderedDict()  # path -> (time checked, is directory, is file)
+
+    @staticmethod
+    def _remember(cache, key, value, max_size):
+        cache[key] = value
+        cache.move_to_end(key)
+        if len(cache) > max_size:
+            cache.popitem(last=False)
+
+    def itemType(self, path):
+        """ :return: A tuple of whether the path is a directory, and whether it is a file """
+        cached = self._types.get(path)
+        if cached is not None and time.monotonic() - cached[0] < self.type_lifetime:
+            self._types.move_to_end(path)
+            return cached[1:]
+
+        is_directory = os.path.isdir(path)
+        item_type = (is_directory, not is_directory and os.path.isfile(path))
+        self._remember(self._types, path, (time.monotonic(),) + item_type, self.max_size)
+        return item_type
+
+    def apply(self, filters, path):
+        """
+        Checks whether a path satisfies all the filters, like applyFilters, reusing earlier results where possible.
+
+        :param filters: List of filters to be applied
+        :param path: A path for the filters to be applied on
+        :return: True if the path satisfies each filter, False otherwise
+        """
+
+        item_type = self.itemType(path)
+        if any(filter_.filter_type in METADATA_FILTER_TYPES for filter_ in filters):
+            # The result depends on the item's current size and age, so it can't be remembered
+            return CompiledFilter(filters).matches(path, *item_type)
+
+        fingerprint = filtersFingerprint(filters)
+        key = (fingerprint, path, item_type)
+        if key in self._results:
+            self._results.move_to_end(key)
+            return self._results[key]
+
+        compiled = self._compiled.get(fingerprint)
+        if compiled is None:
+            compiled = CompiledFilter(filters)
+        self._remember(self._compiled, fingerprint, compiled, 16)
+
+        result = compiled.matches(path, *item_type)
+        self._remember(self._results, key, result, self.max_size)
+        return result
+
+    def forgetPath(self, path):
+        """ Forgets the remembered type of a path, e.g. when the user has just selected it """
+        self._types.pop(path, None)
 
-    return filter_
+    def invalidate(self):
+        """ Forgets everything """
+        self._results.clear()
+        self._compiled.clear()
+        self._types.clear()
 
 
 # todo untested
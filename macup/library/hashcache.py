@@ -0,0 +1,131 @@
+"""
+Persistent cache of file content hashes, so files whose metadata hasn't changed are never hashed again.
+"""
+
+import hashlib
+import os
+import sqlite3
+import threading
+
+from macup.library.constants import *
+
+_HASH_BUFFER_SIZE = 1024 * 1024
+_COMMIT_EVERY = 1000  # Stores between commits, so an interrupted backup keeps most of its hashes
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS hashes (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    inode INTEGER NOT NULL,
+    digest BLOB NOT NULL
+);
+"""
+
+
+def getHashCachePath(target_dir):
+    """
+    Returns where the hash cache of a backup is kept: in the target's metadata folder, so it stays with the files
+    it describes.
+
+    :param target_dir: The target directory
+    :return: The path of the cache file
+    """
+
+    return os.path.join(target_dir, METADATA_DIR, "hashes.sqlite")
+
+
+def hashFile(path):
+    """
+    :param path: A file path
+    :return: The BLAKE2b digest of the file's contents
+    """
+
+    digest = hashlib.blake2b()
+    with open(path, "rb") as f:
+        buffer = bytearray(_HASH_BUFFER_SIZE)
+        view = memoryview(buffer)
+        while True:
+            length = f.readinto(buffer)
+            if not length:
+                return digest.digest()
+            digest.update(view[:length])
+
+
+class HashCache:
+    """
+    An SQLite file of content hashes, each stored with the size, mtime and inode the file had when it was hashed. A
+    hash is only trusted while all three still match. It can be shared between threads.
+    """
+
+    def __init__(self, cache_path):
+        """
+        :param cache_path: Path of the cache file; it is created if it doesn't exist
+        """
+
+        if cache_path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok=True)
+        self.cache_path = cache_path
+        self.connection = sqlite3.connect(cache_path, check_same_thread=False)
+        self.connection.executescript(_SCHEMA)
+        self._lock = threading.Lock()
+        self._uncommitted = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        with self._lock:
+            self.connection.commit()
+            self.connection.close()
+
+    def lookup(self, path, stat):
+        """
+        :param path: A file path
+        :param stat: A fresh stat result of the file
+        :return: The cached digest of the file, or None if it isn't cached or the file has changed since
+        """
+
+        with self._lock:
+            row = self.connection.execute("SELECT size, mtime_ns, inode, digest FROM hashes WHERE path = ?",
+                                          (path,)).fetchone()
+        if row is not None and row[:3] == (stat.st_size, stat.st_mtime_ns, stat.st_ino):
+            return row[3]
+        return None
+
+    def store(self, path, stat, digest):
+        """
+        :param path: A file path
+        :param stat: The stat result of the file, taken before it was hashed
+        :param digest: The digest of the file's contents
+        """
+
+        with self._lock:
+            self.connection.execute("INSERT OR REPLACE INTO hashes (path, size, mtime_ns, inode, digest) "
+                                    "VALUES (?, ?, ?, ?, ?)",
+                                    (path, stat.st_size, stat.st_mtime_ns, stat.st_ino, digest))
+            self._uncommitted += 1
+            if self._uncommitted >= _COMMIT_EVERY:
+                self.connection.commit()
+                self._uncommitted = 0
+
+    def digest(self, path, stat=None, hash_function=hashFile):
+        """
+        Returns the digest of a file, hashing it only if the cache has no hash for its current metadata.
+
+        :param path: A file path
+        :param stat: A fresh stat result of the file; it is stat'ed if None
+        :param hash_function: The function hashing the file if it has to be, given its path; e.g. hashStored, which
+        hashes a compressed file's original contents
+        :return: The digest of the file's contents
+        """
+
+        stat = os.stat(path) if stat is None else stat
+        digest = self.lookup(path, stat)
+        if digest is None:
+            digest = hash_function(path)
+            self.store(path, stat, digest)
+        return digest
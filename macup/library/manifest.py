@@ -0,0 +1,377 @@
+"""
+Per-run manifests of a MIRROR target: an SQLite file written by every backup, listing each item in the target with its
+size, modification time, mode and, where it was hashed, its digest, in a table indexed by path.
+
+A manifest is written as the backup goes, in batches, rather than built in memory. When the backup finishes, the items
+it didn't look at, such as those outside the paths a change journal listed, are carried forward from the previous
+manifest, so every manifest describes the whole target. The next backup takes the folders it lists as existing rather
+than making them again, and verification and restores are driven by it rather than by walking the target. Files are
+still compared with the target itself, so one deleted or changed there behind MacUp's back is copied again.
+
+A manifest is only trusted once its backup has finished: until then it is named as incomplete, and an interrupted
+backup's manifest is removed.
+
+A folder deleted from the target behind MacUp's back is noticed when the backup makes something in it. If the manifest
+turns out to be wrong like that, the new manifest is checked item by item against the target when it is finished,
+leaving out what isn't there, including items carried forward that the backup didn't look at. verifyManifest checks
+every item.
+"""
+
+import os
+import sqlite3
+import stat
+import threading
+import time
+
+from macup.library.compression import hashStored, isCompressedPath, restoreFile, SUFFIXES
+from macup.library.constants import *
+from macup.library.directories import DirectoryMaker
+
+MANIFESTS_KEPT = 5  # The most recent manifests kept; older ones are removed once a new one is finished
+_BATCH_SIZE = 1000
+_INCOMPLETE_SUFFIX = ".incomplete"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    is_directory INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    mode INTEGER NOT NULL,
+    digest BLOB
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS forgotten (
+    path TEXT PRIMARY KEY
+) WITHOUT ROWID;
+"""
+
+# Problems verifyManifest can find
+MISSING = 'MISSING'
+SIZE_DIFFERS = 'SIZE_DIFFERS'
+MTIME_DIFFERS = 'MTIME_DIFFERS'
+DIGEST_DIFFERS = 'DIGEST_DIFFERS'
+
+
+def getManifestDirectory(target_dir):
+    """ :return: The folder a target's manifests are kept in, in its metadata folder """
+    return os.path.join(target_dir, METADATA_DIR, "manifests")
+
+
+def listManifests(target_dir):
+    """ :return: The paths of a target's finished manifests, oldest first """
+    manifest_dir = getManifestDirectory(target_dir)
+    try:
+        names = os.listdir(manifest_dir)
+    except FileNotFoundError:
+        return []
+    return [os.path.join(manifest_dir, name) for name in sorted(names)
+            if name.startswith("manifest-") and name.endswith(".sqlite")]
+
+
+def latestManifest(target_dir):
+    """ :return: The path of a target's most recent finished manifest, or None if it has none """
+    manifests = listManifests(target_dir)
+    return manifests[-1] if manifests else None
+
+
+class ManifestReader:
+    """
+    Looks items up in a manifest by their path in the target. It can be shared between threads.
+    """
+
+    def __init__(self, target_dir, manifest_path=None):
+        """
+        :param target_dir: The target directory the manifest describes
+        :param manifest_path: The manifest to read; the target's latest if None
+        :raise FileNotFoundError: If the target has no manifest
+        """
+
+        self.target_dir = target_dir
+        self.manifest_path = latestManifest(target_dir) if manifest_path is None else manifest_path
+        if self.manifest_path is None:
+            raise FileNotFoundError(f"{target_dir} has no manifest")
+        # Opened read-only, so it is never changed or created by mistake
+        self.connection = sqlite3.connect(f"file:{self.manifest_path}?mode=ro", uri=True, check_same_thread=False)
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        with self._lock:
+            self.connection.close()
+
+    def lookup(self, path):
+        """
+        :param path: An item's path in the target
+        :return: A tuple of whether it is a directory, its size, modification time in nanoseconds, mode and digest
+        (None if it wasn't hashed), or None if it isn't in the manifest
+        """
+
+        with self._lock:
+            return self.connection.execute(
+                "SELECT is_directory, size, mtime_ns, mode, digest FROM files WHERE path = ?",
+                (os.path.relpath(path, self.target_dir),)).fetchone()
+
+    def items(self, prefix=""):
+        """
+        :param prefix: Only yield paths starting with this, e.g. a folder's relative path followed by a separator
+        :return: A generator of tuples of relative path, is_directory, size, mtime_ns, mode and digest, sorted by path
+        """
+
+        with self._lock:
+            cursor = self.connection.execute(
+                "SELECT path, is_directory, size, mtime_ns, mode, digest FROM files "
+                "WHERE path >= ? AND path < ? ORDER BY path", (prefix, prefix + "\U0010ffff"))
+            rows = cursor.fetchmany(_BATCH_SIZE)
+        while rows:
+            yield from rows
+            with self._lock:
+                rows = cursor.fetchmany(_BATCH_SIZE)
+
+    def knownDirectories(self):
+        """ :return: A container of the directories in the manifest, by their path, for a DirectoryMaker """
+        return _KnownDirectories(self)
+
+
+class _KnownDirectories:
+    def __init__(self, reader):
+        self.reader = reader
+
+    def __contains__(self, directory):
+        row = self.reader.lookup(directory)
+        return row is not None and bool(row[0])
+
+
+class ManifestWriter:
+    """
+    Writes a backup's manifest, as the items in it are copied or found unchanged. It can be shared between threads.
+    Used as a context manager, the manifest is finished on leaving, or removed if an exception was raised.
+    """
+
+    def __init__(self, target_dir):
+        """
+        :param target_dir: The target directory; the manifest is made in its metadata folder
+        """
+
+        self.target_dir = target_dir
+        manifest_dir = getManifestDirectory(target_dir)
+        os.makedirs(manifest_dir, exist_ok=True)
+        previous = latestManifest(target_dir)
+        self.previous = None if previous is None else ManifestReader(target_dir, previous)
+
+        # Named after when it was started in UTC, to the nanosecond, so names sort in the order the backups ran
+        now = time.time_ns()
+        name = f"manifest-{time.strftime('%Y%m%d-%H%M%S', time.gmtime(now // 10 ** 9))}-{now % 10 ** 9:09d}.sqlite"
+        self.manifest_path = os.path.join(manifest_dir, name)
+        self._incomplete_path = self.manifest_path + _INCOMPLETE_SUFFIX
+        self.connection = sqlite3.connect(self._incomplete_path, check_same_thread=False)
+        self.connection.executescript(_SCHEMA)
+        self._batch = []
+        self._lock = threading.Lock()
+        self.trusted = True  # Whether the previous manifest is still believed about the target
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.finish()
+        else:
+            self.abandon()
+
+    def distrust(self):
+        """
+        Notes that the previous manifest has turned out to be wrong about the target, e.g. a folder it has is missing,
+        so this manifest is checked against the target when it is finished.
+        """
+
+        self.trusted = False
+
+    def _relativePath(self, path):
+        return os.path.relpath(path, self.target_dir)
+
+    def _flush(self):
+        # Called with the lock held
+        if self._batch:
+            self.connection.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)", self._batch)
+            self.connection.commit()
+            self._batch = []
+
+    def record(self, path, stat_, digest=None):
+        """
+        Records a file as it is in the target.
+
+        :param path: The file's path in the target
+        :param stat_: Its stat result
+        :param digest: The digest of its original contents, as hashFile gives, if it is known
+        """
+
+        row = (self._relativePath(path), 0, stat_.st_size, stat_.st_mtime_ns, stat_.st_mode, digest)
+        with self._lock:
+            self._batch.append(row)
+            if len(self._batch) >= _BATCH_SIZE:
+                self._flush()
+
+    def addDirectory(self, path, stat_):
+        """
+        Records a directory in the target.
+
+        :param path: The directory's path in the target
+        :param stat_: The stat result of its source, whose mode and modification time a restore gives it
+        """
+
+        row = (self._relativePath(path), 1, 0, stat_.st_mtime_ns, stat_.st_mode, None)
+        with self._lock:
+            self._batch.append(row)
+            if len(self._batch) >= _BATCH_SIZE:
+                self._flush()
+
+    def forget(self, path):
+        """
+        Leaves an item, and anything under it, out of the manifest even if the previous one has it, e.g. because it
+        was deleted or failed to copy.
+        """
+
+        relative_path = self._relativePath(path)
+        with self._lock:
+            self._flush()
+            self.connection.execute("INSERT OR IGNORE INTO forgotten VALUES (?)", (relative_path,))
+            self.connection.execute("DELETE FROM files WHERE path = ?", (relative_path,))
+            self.connection.commit()
+
+    def _leaveOutMissing(self):
+        # Called with the lock held. Read a batch at a time, in path order, deleting as it goes.
+        last_path = ""
+        while True:
+            rows = self.connection.execute(
+                "SELECT path, is_directory, size, mtime_ns FROM files WHERE path > ? ORDER BY path LIMIT ?",
+                (last_path, _BATCH_SIZE)).fetchall()
+            if not rows:
+                break
+            last_path = rows[-1][0]
+            self.connection.executemany(
+                "DELETE FROM files WHERE path = ?",
+                [(path,) for path, is_directory, size, mtime_ns in rows
+                 if _checkItem(os.path.join(self.target_dir, path), is_directory, size, mtime_ns) is not None])
+        self.connection.commit()
+
+    def finish(self):
+        """
+        Carries forward the previous manifest's items that this backup didn't record or forget, then names the
+        manifest as finished and removes the oldest ones beyond MANIFESTS_KEPT. If the previous manifest was
+        distrusted, items that don't match the target are left out.
+        """
+
+        with self._lock:
+            self._flush()
+            if self.previous is not None:
+                self.connection.execute("ATTACH DATABASE ? AS previous", (self.previous.manifest_path,))
+                self.connection.execute("CREATE TEMP TABLE carried AS SELECT * FROM previous.files")
+                # Forgotten folders take everything under them with them; '0' comes straight after the separator
+                for (path,) in self.connection.execute("SELECT path FROM forgotten").fetchall():
+                    self.connection.execute("DELETE FROM carried WHERE path = ? OR (path > ? AND path < ?)",
+                                            (path, path + os.sep, path + chr(ord(os.sep) + 1)))
+                self.connection.execute("INSERT OR IGNORE INTO files SELECT * FROM carried")
+                self.connection.execute("DROP TABLE carried")
+                self.connection.commit()
+                self.connection.execute("DETACH DATABASE previous")
+                self.previous.close()
+            if not self.trusted:
+                self._leaveOutMissing()
+            self.connection.execute("DROP TABLE forgotten")
+            self.connection.commit()
+            self.connection.execute("VACUUM")
+            self.connection.close()
+            os.replace(self._incomplete_path, self.manifest_path)
+
+        for old_manifest in listManifests(self.target_dir)[:-MANIFESTS_KEPT]:
+            os.remove(old_manifest)
+
+    def abandon(self):
+        """ Removes the unfinished manifest, e.g. because the backup failed """
+        with self._lock:
+            self.connection.close()
+            if self.previous is not None:
+                self.previous.close()
+            os.remove(self._incomplete_path)
+
+
+def _checkItem(path, is_directory, size, mtime_ns):
+    """
+    :return: What is wrong with an item in the target, as its manifest describes it: MISSING, SIZE_DIFFERS or
+    MTIME_DIFFERS; or None if it matches. Only a directory's type is checked, as its time is its source's.
+    """
+
+    try:
+        path_stat = os.stat(path)
+    except FileNotFoundError:
+        return MISSING
+    if is_directory:
+        return None if stat.S_ISDIR(path_stat.st_mode) else MISSING
+    if not stat.S_ISREG(path_stat.st_mode):
+        return MISSING
+    if path_stat.st_size != size:
+        return SIZE_DIFFERS
+    if path_stat.st_mtime_ns != mtime_ns:
+        return MTIME_DIFFERS
+    return None
+
+
+def verifyManifest(target_dir, manifest_path=None, check_digests=False):
+    """
+    Checks the target against its manifest, item by item, without walking the target.
+
+    :param target_dir: The target directory
+    :param manifest_path: The manifest to check against; the target's latest if None
+    :param check_digests: Whether to hash the files that have a digest in the manifest, rather than only comparing
+    sizes and modification times
+    :return: A generator of tuples of each path in the target that doesn't match and what is wrong: MISSING,
+    SIZE_DIFFERS, MTIME_DIFFERS or DIGEST_DIFFERS
+    """
+
+    with ManifestReader(target_dir, manifest_path) as reader:
+        for path, is_directory, size, mtime_ns, mode, digest in reader.items():
+            full_path = os.path.join(target_dir, path)
+            problem = _checkItem(full_path, is_directory, size, mtime_ns)
+            if problem is not None:
+                yield path, problem
+            elif check_digests and digest is not None and hashStored(full_path) != digest:
+                yield path, DIGEST_DIFFERS
+
+
+def restoreFromManifest(target_dir, destination, prefix="", manifest_path=None):
+    """
+    Restores the items in a target's manifest, decompressing compressed copies, without walking the target.
+
+    :param target_dir: The target directory
+    :param destination: The directory to restore into; the items' relative paths are kept under it
+    :param prefix: Only restore paths starting with this, e.g. a folder's relative path followed by a separator
+    :param manifest_path: The manifest to restore from; the target's latest if None
+    :return: The number of files restored
+    """
+
+    directory_maker = DirectoryMaker()
+    directories = []
+    restored = 0
+    with ManifestReader(target_dir, manifest_path) as reader:
+        # Sorted by path, so each folder comes before its contents
+        for path, is_directory, size, mtime_ns, mode, digest in reader.items(prefix):
+            compression = isCompressedPath(path)
+            restored_path = os.path.join(destination, path[:-len(SUFFIXES[compression])] if compression else path)
+            if is_directory:
+                directory_maker.make(restored_path)
+                directories.append((restored_path, mtime_ns, mode))
+                continue
+            directory_maker.make(os.path.dirname(restored_path))
+            restoreFile(os.path.join(target_dir, path), restored_path)
+            restored += 1
+
+    # Folder times are set last, as adding files to them changes them
+    for directory, mtime_ns, mode in reversed(directories):
+        os.chmod(directory, stat.S_IMODE(mode))
+        os.utime(directory, ns=(mtime_ns, mtime_ns))
+    return restored
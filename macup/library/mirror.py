@@ -0,0 +1,256 @@
+"""
+Mirroring: making the target an exact copy of the source, by deleting what is in the target but no longer in the
+source, or no longer passes the filters.
+
+The source and target are each listed in sorted order, one directory at a time, and the two listings are merged like
+sorted files, so working out what to add, update and delete takes memory for the directories being listed rather
+than for the whole tree. A directory that is only in the target is deleted whole, without listing what is inside it.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+import os
+import shutil
+import sys
+import threading
+
+from macup.library.chunkedcopy import CHECKPOINT_SUFFIX, PARTIAL_SUFFIX
+from macup.library.compression import SUFFIXES
+from macup.library.constants import *
+from macup.library.copyengine import DELETED, FAILED, CopyResult
+from macup.library.filter import buildFilter
+from macup.library.scanner import passesFilter, shouldDescend
+
+DEFAULT_DELETE_WORKERS = 8
+
+# Actions in a mirror plan
+ADD = 'ADD'
+CHANGE = 'CHANGE'
+DELETE = 'DELETE'
+_PRINTED_ACTIONS = {ADD: "add", CHANGE: "update", DELETE: "delete"}
+
+# Files MacUp makes next to a file's copy, which belong to that file: its compressed copy and a large file's partial
+# copy and checkpoint
+_STORED_SUFFIXES = tuple(SUFFIXES.values()) + (PARTIAL_SUFFIX, CHECKPOINT_SUFFIX)
+
+
+class PlanItem:
+    """
+    One difference between the source and the target.
+    """
+
+    __slots__ = ("action", "path", "is_directory", "size")
+
+    def __init__(self, action, path, is_directory, size=0):
+        """
+        :param action: ADD, CHANGE or DELETE
+        :param path: The item's path relative to the source, or for DELETE, relative to the target
+        :param is_directory: Whether the item is a directory
+        :param size: The size of the file to be copied, or deleted
+        """
+
+        self.action = action
+        self.path = path
+        self.is_directory = is_directory
+        self.size = size
+
+    def __repr__(self):
+        return f"PlanItem(action='{self.action}', path='{self.path}', is_directory={self.is_directory}, " \
+               f"size={self.size})"
+
+
+def _sourceName(name):
+    """ :return: The name of the source file a file in the target belongs to """
+    for suffix in _STORED_SUFFIXES:
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
+    return name
+
+
+def _isDirectory(entry, is_target):
+    # Symlinks in the target are never followed, so a link to a folder is deleted rather than the folder's contents
+    return entry.is_dir(follow_symlinks=False) if is_target else entry.is_dir()
+
+
+def _sortedListing(root, filter_=None, is_target=False):
+    """
+    Lists a tree depth first, with each directory's items sorted by name, so the whole listing is sorted by the tuple
+    of each path's parts. Send True to the generator after it yields a directory to not descend into it.
+
+    :param filter_: A filter for the source's items, as for scanTree
+    :param is_target: Whether this is the target, whose files are listed under the name of the source file they
+    belong to, symlinks are never followed, and METADATA_DIR is left out
+    :return: A generator of tuples of the path's parts and the os.DirEntry
+    """
+
+    def sortedChildren(directory, parts):
+        try:
+            with os.scandir(directory) as entries:
+                if is_target:
+                    children = [(_sourceName(entry.name), entry) for entry in entries
+                                if parts or entry.name != METADATA_DIR]
+                else:
+                    children = [(entry.name, entry) for entry in entries if passesFilter(filter_, entry)]
+        except FileNotFoundError:
+            # Deleted since its parent was listed
+            return iter(())
+        children.sort(key=lambda child: child[0])
+        return iter([(parts + (name,), entry) for name, entry in children])
+
+    # A stack of iterators, rather than recursion, so deep trees cannot hit the recursion limit
+    stack = [sortedChildren(root, ())]
+    while stack:
+        child = next(stack[-1], None)
+        if child is None:
+            stack.pop()
+            continue
+        parts, entry = child
+        skip = yield child
+        if skip:
+            # The send that passed skip gets the next item, so this yield's value goes to the next next()
+            yield None
+        if _isDirectory(entry, is_target) and not skip and (is_target or shouldDescend(filter_, entry)):
+            stack.append(sortedChildren(entry.path, parts))
+
+
+def _advance(listing, skip=False):
+    """ :return: The next item of a sorted listing, or None once it is over """
+    try:
+        if skip:
+            listing.send(True)
+        return next(listing)
+    except StopIteration:
+        return None
+
+
+def planMirror(src_dir, target_dir, filters=(), mtime_tolerance=0.0):
+    """
+    Works out what mirroring the source to the target would do, by a sorted merge of their listings. Files are
+    compared by size and modification time, as UPDATE mode does; only the time for a compressed copy.
+
+    :param src_dir: Directory to copy items from
+    :param target_dir: Directory to copy items to
+    :param filters: List of Filter objects; items that don't pass are deleted from the target
+    :param mtime_tolerance: How many seconds modification times may differ by and still count as the same
+    :return: A generator of PlanItems, in the order of the sorted listings, each directory before its contents. A
+    directory to delete is not followed by its contents. An item whose type changed, such as a file that became a
+    directory, is deleted and then added.
+    """
+
+    source = _sortedListing(src_dir, buildFilter(filters))
+    target = _sortedListing(target_dir, is_target=True)
+    source_item, target_item = _advance(source), _advance(target)
+    tolerance_ns = mtime_tolerance * 10 ** 9
+
+    while source_item is not None or target_item is not None:
+        if target_item is None or (source_item is not None and source_item[0] < target_item[0]):
+            parts, entry = source_item
+            is_directory = entry.is_dir()
+            yield PlanItem(ADD, os.sep.join(parts), is_directory, 0 if is_directory else entry.stat().st_size)
+            source_item = _advance(source)
+            continue
+
+        if source_item is None or target_item[0] < source_item[0]:
+            parts, entry = target_item
+            is_directory = _isDirectory(entry, True)
+            yield PlanItem(DELETE, os.path.relpath(entry.path, target_dir), is_directory,
+                           0 if is_directory else entry.stat(follow_symlinks=False).st_size)
+            target_item = _advance(target, skip=is_directory)
+            continue
+
+        # The same name in both: the source item and every target file belonging to it
+        parts, source_entry = source_item
+        source_is_directory = source_entry.is_dir()
+        source_stat = None if source_is_directory else source_entry.stat()
+        changed = added = False
+        while target_item is not None and target_item[0] == parts:
+            _, target_entry = target_item
+            target_is_directory = _isDirectory(target_entry, True)
+            if target_is_directory != source_is_directory:
+                yield PlanItem(DELETE, os.path.relpath(target_entry.path, target_dir), target_is_directory)
+                target_item = _advance(target, skip=target_is_directory)
+                if not added:
+                    yield PlanItem(ADD, os.sep.join(parts), source_is_directory,
+                                   0 if source_is_directory else source_stat.st_size)
+                    added = True
+                continue
+            if not source_is_directory and target_entry.name.endswith((PARTIAL_SUFFIX, CHECKPOINT_SUFFIX)):
+                # An interrupted copy of a file that is still in the source, to be resumed
+                changed = True
+            elif not source_is_directory:
+                target_stat = target_entry.stat(follow_symlinks=False)
+                compressed = target_entry.name != parts[-1]
+                changed |= ((not compressed and target_stat.st_size != source_stat.st_size) or
+                            abs(target_stat.st_mtime_ns - source_stat.st_mtime_ns) > tolerance_ns)
+            target_item = _advance(target)
+        if changed and not added:
+            yield PlanItem(CHANGE, os.sep.join(parts), False, source_stat.st_size)
+        source_item = _advance(source)
+
+
+def printPlan(plan, file=None, deletions=True):
+    """
+    Prints a mirror plan, one line per item, and a summary, for a dry run.
+
+    :param plan: An iterable of PlanItems, e.g. from planMirror
+    :param file: Where to print to; stdout if None
+    :param deletions: Whether to include the deletions
+    :return: A dictionary of each action to the number of items with it
+    """
+
+    file = sys.stdout if file is None else file
+    counts = {ADD: 0, CHANGE: 0, DELETE: 0}
+    sizes = {ADD: 0, CHANGE: 0, DELETE: 0}
+    for item in plan:
+        if item.action == DELETE and not deletions:
+            continue
+        counts[item.action] += 1
+        sizes[item.action] += item.size
+        print(f"{_PRINTED_ACTIONS[item.action]:<6} {item.path}{os.sep if item.is_directory else ''}", file=file)
+    print(f"{counts[ADD]} to add ({sizes[ADD]} bytes), {counts[CHANGE]} to update ({sizes[CHANGE]} bytes), "
+          f"{counts[DELETE]} to delete ({sizes[DELETE]} bytes)", file=file)
+    return counts
+
+
+def _delete(path, is_directory):
+    if is_directory:
+        shutil.rmtree(path)
+    else:
+        os.remove(path)
+
+
+def deleteStale(target_dir, plan, report, workers=DEFAULT_DELETE_WORKERS, manifest=None):
+    """
+    Deletes the items a mirror plan deletes from the target, several at a time; a directory is deleted whole. Only so
+    many deletions wait at a time, so the plan is streamed rather than read up front.
+
+    :param target_dir: The target directory
+    :param plan: An iterable of PlanItems, e.g. from planMirror; items other than deletions are ignored
+    :param report: The CopyReport to add a DELETED or FAILED result for each item to
+    :param workers: The number of threads deleting at the same time
+    :param manifest: A ManifestWriter of the target, which the deleted items are left out of
+    """
+
+    pending = threading.BoundedSemaphore(workers * 4)
+
+    def delete(path, is_directory):
+        try:
+            try:
+                _delete(path, is_directory)
+            except FileNotFoundError:
+                # Already gone, but the previous manifest may still have it
+                pass
+            result = CopyResult(path, path, DELETED)
+            if manifest is not None:
+                manifest.forget(path)
+        except Exception as error:
+            result = CopyResult(path, path, FAILED, error=error)
+        report.add(result)
+        pending.release()
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for item in plan:
+            if item.action != DELETE:
+                continue
+            pending.acquire()
+            pool.submit(delete, os.path.join(target_dir, item.path), item.is_directory)
@@ -0,0 +1,271 @@
+"""
+Packing of small files into tar segments on the target, so a tree of many tiny files is written as a few large
+sequential files. An SQLite index records where each file's data is, so single files can be restored without reading
+the segments through.
+
+Segments are only ever appended to by the run that creates them. A file that changes is packed again into a new
+segment and the index moved to the new copy; the old copy stays in its segment until the segments are compacted.
+"""
+
+import hashlib
+import os
+import sqlite3
+import tarfile
+import time
+
+from macup.library.constants import *
+from macup.library.directories import DirectoryMaker
+
+SMALL_FILE_THRESHOLD = 64 * 1024  # Files smaller than this are packed
+DEFAULT_SEGMENT_SIZE = 256 * 1024 * 1024  # A new segment is started once the current one is this big
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    is_directory INTEGER NOT NULL,
+    segment TEXT,
+    offset INTEGER,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    mode INTEGER NOT NULL,
+    digest BLOB
+);
+"""
+
+
+def getPackDirectory(target_dir):
+    """ :return: The folder in the target's metadata folder holding the segments and their index """
+    return os.path.join(target_dir, METADATA_DIR, "packs")
+
+
+class PackWriter:
+    """
+    Packs files into tar segments in a target's pack folder, indexing each one. Not thread safe; files are packed
+    one after another, which is what makes the writes sequential.
+    """
+
+    backend = PACKED  # The copy backend name reported for packed files
+
+    def __init__(self, target_dir, threshold=SMALL_FILE_THRESHOLD, segment_size=DEFAULT_SEGMENT_SIZE):
+        """
+        :param target_dir: The target directory
+        :param threshold: Files smaller than this many bytes are packed; bigger ones are left to be copied
+        :param segment_size: The size at which a segment is closed and a new one started
+        """
+
+        self.pack_dir = getPackDirectory(target_dir)
+        os.makedirs(self.pack_dir, exist_ok=True)
+        self.threshold = threshold
+        self.segment_size = segment_size
+        self.connection = sqlite3.connect(os.path.join(self.pack_dir, "index.sqlite"))
+        self.connection.executescript(_SCHEMA)
+
+        self._segment = None
+        self._segment_file = None  # tarfile doesn't close a file object it is given
+        self._segment_name = None
+        # Segments made in the same second are told apart by a counter
+        self._run_name = time.strftime("%Y%m%d-%H%M%S")
+        self._segment_count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self._closeSegment()
+        self.connection.commit()
+        self.connection.close()
+
+    def _closeSegment(self):
+        if self._segment is not None:
+            self._segment.close()
+            self._segment = None
+            # Synced before the index that points into it is committed
+            self._segment_file.flush()
+            os.fsync(self._segment_file.fileno())
+            self._segment_file.close()
+            self._segment_file = None
+
+    def _openSegment(self):
+        while True:
+            self._segment_count += 1
+            name = f"segment-{self._run_name}-{self._segment_count:04}.tar"
+            path = os.path.join(self.pack_dir, name)
+            if not os.path.exists(path):
+                break
+        # Opened exclusively, as segments are never written to by more than one run
+        self._segment_file = open(path, "xb")
+        self._segment = tarfile.open(fileobj=self._segment_file, mode="w", format=tarfile.PAX_FORMAT)
+        self._segment_name = name
+
+    def shouldPack(self, stat):
+        """ :return: True if a file with this stat result is small enough to be packed """
+        return stat.st_size < self.threshold
+
+    def _isUnchanged(self, relative_path, stat, copy_mode, mtime_tolerance, source):
+        """ :return: True if the packed copy of a file can be kept, by the rules of the copy mode """
+        row = self.connection.execute("SELECT size, mtime_ns, digest FROM files WHERE path = ? AND is_directory = 0",
+                                      (relative_path,)).fetchone()
+        if row is None or copy_mode == OVERWRITE:
+            return False
+        if copy_mode == SKIP_EXISTING:
+            return True
+        if copy_mode == UPDATE:
+            return row[0] == stat.st_size and abs(row[1] - stat.st_mtime_ns) <= mtime_tolerance * 10 ** 9
+        # CHECKSUM
+        if row[0] != stat.st_size:
+            return False
+        with open(source, "rb") as f:
+            return hashlib.blake2b(f.read()).digest() == row[2]
+
+    def addDirectory(self, relative_path, stat):
+        """ Records a directory, so it is recreated on restore even if nothing is packed inside it """
+        self.connection.execute(
+            "INSERT OR REPLACE INTO files (path, is_directory, size, mtime_ns, mode) VALUES (?, 1, 0, ?, ?)",
+            (relative_path, stat.st_mtime_ns, stat.st_mode))
+
+    def packFile(self, source, relative_path, stat, copy_mode, mtime_tolerance=0.0):
+        """
+        Packs a file into the current segment, unless it is already packed and the copy mode says to keep it.
+
+        :param source: The path of the file to pack
+        :param relative_path: The path to restore it to, relative to the restore's destination
+        :param stat: A stat result of the file
+        :param copy_mode: SKIP_EXISTING, OVERWRITE, UPDATE or CHECKSUM
+        :param mtime_tolerance: In UPDATE mode, how many seconds modification times may differ by and still count as
+        the same
+        :return: The number of bytes packed, or None if the packed copy was kept
+        """
+
+        if self._isUnchanged(relative_path, stat, copy_mode, mtime_tolerance, source):
+            return None
+
+        with open(source, "rb") as f:
+            stat = os.fstat(f.fileno())
+            data = f.read()
+
+        if self._segment is None or self._segment.offset >= self.segment_size:
+            self._closeSegment()
+            self._openSegment()
+
+        info = tarfile.TarInfo(relative_path)
+        info.size = len(data)
+        info.mtime = stat.st_mtime
+        info.mode = stat.st_mode & 0o7777
+        self._segment.addfile(info, _BytesReader(data))
+        # tarfile only fills in offset_data when reading, but the data is padded out to whole blocks after the header
+        padded_size = -(-len(data) // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+        offset = self._segment.offset - padded_size
+
+        self.connection.execute(
+            "INSERT OR REPLACE INTO files (path, is_directory, segment, offset, size, mtime_ns, mode, digest) "
+            "VALUES (?, 0, ?, ?, ?, ?, ?, ?)",
+            (relative_path, self._segment_name, offset, len(data), stat.st_mtime_ns, stat.st_mode,
+             hashlib.blake2b(data).digest()))
+        return len(data)
+
+
+class _BytesReader:
+    """ The least tarfile needs to read a member's data from bytes already in memory """
+
+    def __init__(self, data):
+        self.data = memoryview(data)
+        self.position = 0
+
+    def read(self, size=-1):
+        end = len(self.data) if size is None or size < 0 else self.position + size
+        chunk = self.data[self.position:end]
+        self.position += len(chunk)
+        return bytes(chunk)
+
+
+class PackReader:
+    """
+    Reads files back out of a target's segments, seeking straight to each file's data using the index.
+    """
+
+    def __init__(self, target_dir):
+        """
+        :param target_dir: The target directory a PackWriter wrote to
+        """
+
+        self.pack_dir = getPackDirectory(target_dir)
+        self.connection = sqlite3.connect(os.path.join(self.pack_dir, "index.sqlite"))
+        self.connection.executescript(_SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def paths(self, prefix=""):
+        """ :return: The relative paths of the packed files and directories under a prefix, parents first """
+        rows = self.connection.execute("SELECT path FROM files WHERE path >= ? AND path < ? ORDER BY path",
+                                       (prefix, prefix + "\U0010ffff"))
+        return [row[0] for row in rows]
+
+    def read(self, relative_path):
+        """ :return: The contents of a packed file """
+        row = self.connection.execute("SELECT segment, offset, size FROM files WHERE path = ? AND is_directory = 0",
+                                      (relative_path,)).fetchone()
+        if row is None:
+            raise FileNotFoundError(f"{relative_path} is not packed")
+        segment, offset, size = row
+        with open(os.path.join(self.pack_dir, segment), "rb") as f:
+            f.seek(offset)
+            return f.read(size)
+
+    def restore(self, destination, prefix=""):
+        """
+        Restores packed files and directories, with their modes and modification times.
+
+        :param destination: The directory to restore into; the files' relative paths are kept under it
+        :param prefix: Only restore paths starting with this, e.g. a folder's relative path followed by a separator
+        :return: The number of files restored
+        """
+
+        rows = self.connection.execute(
+            "SELECT path, is_directory, segment, offset, size, mtime_ns, mode FROM files "
+            "WHERE path >= ? AND path < ? ORDER BY segment, offset", (prefix, prefix + "\U0010ffff")).fetchall()
+
+        # Directories first, so files can go into them; their times are set last, as adding files changes them
+        directories = [row for row in rows if row[1]]
+        directory_maker = DirectoryMaker()
+        directory_maker.makeAll(os.path.join(destination, row[0]) for row in directories)
+
+        restored = 0
+        open_segment = open_segment_name = None
+        try:
+            # Sorted by segment and offset, so each segment is read through once, in order
+            for path, is_directory, segment, offset, size, mtime_ns, mode in rows:
+                if is_directory:
+                    continue
+                if segment != open_segment_name:
+                    if open_segment is not None:
+                        open_segment.close()
+                    open_segment = open(os.path.join(self.pack_dir, segment), "rb")
+                    open_segment_name = segment
+                open_segment.seek(offset)
+
+                file_path = os.path.join(destination, path)
+                directory_maker.make(os.path.dirname(file_path))
+                with open(file_path, "wb") as f:
+                    f.write(open_segment.read(size))
+                os.chmod(file_path, mode & 0o7777)
+                os.utime(file_path, ns=(mtime_ns, mtime_ns))
+                restored += 1
+        finally:
+            if open_segment is not None:
+                open_segment.close()
+
+        for path, _, _, _, _, mtime_ns, mode in reversed(directories):
+            directory = os.path.join(destination, path)
+            os.chmod(directory, mode & 0o7777)
+            os.utime(directory, ns=(mtime_ns, mtime_ns))
+        return restored
@@ -0,0 +1,322 @@
+"""
+Persistent index of the last scan of a source directory, so later scans only re-list directories that changed.
+"""
+
+import argparse
+import os
+import sqlite3
+import time
+
+from macup.library.config import getConfigDataPath
+from macup.library.scanner import passesFilter, shouldDescend
+
+# A directory modified this recently may change again within the same mtime tick, so its listing isn't trusted
+_MTIME_SETTLE_NS = 2 * 10 ** 9
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS items (
+    path TEXT PRIMARY KEY,
+    parent TEXT NOT NULL,
+    name TEXT NOT NULL,
+    is_directory INTEGER NOT NULL,
+    size INTEGER,
+    mtime_ns INTEGER,
+    inode INTEGER,
+    mode INTEGER,
+    listed_mtime_ns INTEGER
+);
+CREATE INDEX IF NOT EXISTS items_parent ON items (parent);
+"""
+
+
+def getIndexPath(config_name, json_path):
+    """
+    Returns where the scan index of a configuration is kept: in an "indexes" folder next to the json file.
+
+    :param config_name: The name of the configuration
+    :param json_path: The path to the json file the configuration is stored in
+    :return: The path of the index file
+    """
+
+    return getConfigDataPath(config_name, json_path, "indexes", ".sqlite")
+
+
+class IndexedStat:
+    """
+    A stat result made from what a ScanIndex stores of an item: its mode, inode, size and modification time. Any other
+    field is read from a fresh stat of the item, the first time one is asked for.
+    """
+
+    __slots__ = ("path", "st_mode", "st_ino", "st_size", "st_mtime_ns", "_disk_stat")
+
+    def __init__(self, path, mode, inode, size, mtime_ns):
+        self.path = path
+        self.st_mode = mode
+        self.st_ino = inode
+        self.st_size = size
+        self.st_mtime_ns = mtime_ns
+        self._disk_stat = None
+
+    @property
+    def st_mtime(self):
+        return self.st_mtime_ns / 10 ** 9
+
+    def __getattr__(self, name):
+        # Only called for the fields the index doesn't store
+        if not name.startswith("st_"):
+            raise AttributeError(name)
+        if self._disk_stat is None:
+            self._disk_stat = os.stat(self.path)
+        return getattr(self._disk_stat, name)
+
+    def __repr__(self):
+        return f"IndexedStat(path='{self.path}', st_mode={self.st_mode}, st_ino={self.st_ino}, " \
+               f"st_size={self.st_size}, st_mtime_ns={self.st_mtime_ns})"
+
+
+class IndexedEntry:
+    """
+    An item read back from a ScanIndex, with the same interface as os.DirEntry. The type, and what stat() gives, come
+    from the index, so an indexed rescan doesn't stat the items again. Editing a file in place doesn't change its
+    directory's mtime, so a file's size and modification time can be older than the file's own until its directory
+    next changes; the copy engine compares files by its own fstat, so what is copied never depends on them.
+    """
+
+    __slots__ = ("path", "name", "_is_directory", "_inode", "_size", "_mtime_ns", "_mode", "_stat")
+
+    def __init__(self, path, name, is_directory, inode, size=None, mtime_ns=None, mode=None):
+        self.path = path
+        self.name = name
+        self._is_directory = bool(is_directory)
+        self._inode = inode
+        self._size = size
+        self._mtime_ns = mtime_ns
+        self._mode = mode
+        self._stat = None
+
+    def is_dir(self):
+        return self._is_directory
+
+    def is_file(self):
+        return not self._is_directory
+
+    def inode(self):
+        return self._inode
+
+    def stat(self, follow_symlinks=True):
+        if not follow_symlinks:
+            # The index holds what stat gave, following symlinks
+            return os.lstat(self.path)
+        if self._stat is None:
+            if self._mtime_ns is None or self._mode is None:
+                # It couldn't be stat'ed when it was listed
+                self._stat = os.stat(self.path)
+            else:
+                self._stat = IndexedStat(self.path, self._mode, self._inode, self._size, self._mtime_ns)
+        return self._stat
+
+    def __repr__(self):
+        return f"IndexedEntry(path='{self.path}')"
+
+
+class ScanIndex:
+    """
+    An SQLite file recording every item seen by the last scans: path, type, size, mtime, inode and mode, plus, for
+    each directory that was listed, its mtime at the time. A directory whose mtime and inode still match can have its
+    listing read back from the index instead of the disk.
+    """
+
+    def __init__(self, index_path):
+        """
+        :param index_path: Path of the index file; it is created if it doesn't exist
+        """
+
+        os.makedirs(os.path.dirname(os.path.abspath(index_path)), exist_ok=True)
+        self.index_path = index_path
+        self.connection = sqlite3.connect(index_path)
+        self.connection.executescript(_SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def commit(self):
+        self.connection.commit()
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+    def clear(self):
+        """ Forgets everything in the index """
+        self.connection.execute("DELETE FROM items")
+
+    def isListingCurrent(self, path, stat):
+        """
+        :param path: A directory path
+        :param stat: A fresh stat result of the directory
+        :return: True if the index holds a listing of the directory taken at its current mtime
+        """
+
+        row = self.connection.execute("SELECT listed_mtime_ns, inode FROM items WHERE path = ?", (path,)).fetchone()
+        return row is not None and row[0] == stat.st_mtime_ns and row[1] == stat.st_ino
+
+    def children(self, path):
+        """ :return: The indexed items directly inside a directory, as IndexedEntry objects """
+        rows = self.connection.execute(
+            "SELECT path, name, is_directory, inode, size, mtime_ns, mode FROM items WHERE parent = ?", (path,))
+        return [IndexedEntry(*row) for row in rows]
+
+    def recordListing(self, path, stat, entries):
+        """
+        Replaces the indexed contents of a directory with a fresh listing of it.
+
+        :param path: The directory listed
+        :param stat: The stat result of the directory, taken before it was listed
+        :param entries: os.DirEntry objects of everything in the directory
+        """
+
+        old_types = dict(self.connection.execute("SELECT path, is_directory FROM items WHERE parent = ?", (path,)))
+
+        rows = []
+        for entry in entries:
+            try:
+                entry_stat = entry.stat()
+                size, mtime_ns, mode = entry_stat.st_size, entry_stat.st_mtime_ns, entry_stat.st_mode
+            except OSError:
+                size = mtime_ns = mode = None
+            is_directory = entry.is_dir()
+            rows.append((entry.path, path, entry.name, int(is_directory), size, mtime_ns, entry.inode(), mode))
+
+            # Anything indexed under an item that stopped being a directory is gone
+            if old_types.pop(entry.path, is_directory) != is_directory:
+                self._forgetDescendants(entry.path)
+
+        # The listed_mtime_ns of child directories is kept, as their own listings are still valid
+        self.connection.executemany(
+            "INSERT INTO items (path, parent, name, is_directory, size, mtime_ns, inode, mode) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT (path) DO UPDATE SET "
+            "is_directory = excluded.is_directory, size = excluded.size, mtime_ns = excluded.mtime_ns, "
+            "inode = excluded.inode, mode = excluded.mode", rows)
+
+        # Whatever is left in old_types no longer exists
+        for removed_path in old_types:
+            self.connection.execute("DELETE FROM items WHERE path = ?", (removed_path,))
+            self._forgetDescendants(removed_path)
+
+        listed_mtime_ns = stat.st_mtime_ns if time.time_ns() - stat.st_mtime_ns > _MTIME_SETTLE_NS else None
+        self.connection.execute(
+            "INSERT INTO items (path, parent, name, is_directory, size, mtime_ns, inode, mode, listed_mtime_ns) "
+            "VALUES (?, ?, ?, 1, ?, ?, ?, ?, ?) ON CONFLICT (path) DO UPDATE SET "
+            "mtime_ns = excluded.mtime_ns, inode = excluded.inode, listed_mtime_ns = excluded.listed_mtime_ns",
+            (path, os.path.dirname(path), os.path.basename(path), stat.st_size, stat.st_mtime_ns, stat.st_ino,
+             stat.st_mode, listed_mtime_ns))
+
+    def _forgetDescendants(self, path):
+        # Everything under path sorts between "path/" and "path0", as "0" is the character after "/"
+        self.connection.execute("DELETE FROM items WHERE path > ? AND path < ?",
+                                (path + os.sep, path + chr(ord(os.sep) + 1)))
+
+
+def indexedScanTree(path, index, filter_=None):
+    """
+    Works like scanTree, but reads the listing of any directory that hasn't changed since the last scan from the
+    index, costing one stat instead of a listing. Directories that changed are listed and their listing recorded.
+    Items in unchanged directories are yielded as IndexedEntry objects, others as os.DirEntry objects.
+
+    :param path: The directory to scan
+    :param index: A ScanIndex
+    :param filter_: A filter function, as accepted by scanTree
+    :return: A generator of entries
+    """
+
+    stack = [path]
+    try:
+        while stack:
+            directory = stack.pop()
+            stat = os.stat(directory)
+            if index.isListingCurrent(directory, stat):
+                children = index.children(directory)
+            else:
+                with os.scandir(directory) as entries:
+                    children = list(entries)
+                index.recordListing(directory, stat, children)
+
+            for child in children:
+                if passesFilter(filter_, child):
+                    yield child
+                    if child.is_dir() and shouldDescend(filter_, child):
+                        stack.append(child.path)
+    finally:
+        index.commit()
+
+
+def rebuildIndex(src_dir, index_path):
+    """
+    Throws away the index and rebuilds it from a full scan of the source.
+
+    :param src_dir: The source directory
+    :param index_path: Path of the index file
+    :return: The number of items indexed
+    """
+
+    with ScanIndex(index_path) as index:
+        index.clear()
+        return sum(1 for _ in indexedScanTree(src_dir, index))
+
+
+def verifyIndex(src_dir, index_path):
+    """
+    Compares every listing the index would trust, i.e. of a directory whose mtime hasn't changed, with the disk,
+    without changing the index. Listings of directories that have changed are not checked, as they would be re-listed.
+
+    :param src_dir: The source directory
+    :param index_path: Path of the index file
+    :return: A list of (path, problem) tuples; empty if the index matches the disk
+    """
+
+    problems = []
+    with ScanIndex(index_path) as index:
+        stack = [src_dir]
+        while stack:
+            directory = stack.pop()
+            indexed = {entry.path: entry for entry in index.children(directory)}
+            try:
+                current = index.isListingCurrent(directory, os.stat(directory))
+                with os.scandir(directory) as entries:
+                    actual = {entry.path: entry for entry in entries}
+            except OSError as error:
+                problems.append((directory, f"cannot be listed: {error}"))
+                continue
+
+            if current:
+                for missing_path in indexed.keys() - actual.keys():
+                    problems.append((missing_path, "is indexed but no longer exists"))
+                for new_path in actual.keys() - indexed.keys():
+                    problems.append((new_path, "exists but is not indexed"))
+
+            for item_path in indexed.keys() & actual.keys():
+                if indexed[item_path].is_dir() != actual[item_path].is_dir():
+                    problems.append((item_path, "has changed type"))
+                elif indexed[item_path].is_dir():
+                    stack.append(item_path)
+
+    return problems
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rebuild or verify a MacUp scan index.")
+    parser.add_argument("action", choices=("rebuild", "verify"))
+    parser.add_argument("src_dir", help="The source directory the index belongs to")
+    parser.add_argument("index_path", help="The index file")
+    args = parser.parse_args()
+
+    if args.action == "rebuild":
+        print(f"Indexed {rebuildIndex(args.src_dir, args.index_path)} items.")
+    else:
+        found_problems = verifyIndex(args.src_dir, args.index_path)
+        for problem_path, problem in found_problems:
+            print(f"{problem_path} {problem}")
+        print("Index is consistent." if not found_problems else f"{len(found_problems)} problems found.")
@@ -0,0 +1,209 @@
+"""
+Streaming directory scanner, built on os.scandir.
+"""
+
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import os
+import queue
+import stat
+import threading
+
+from macup.library.filter import CompiledFilter
+
+DEFAULT_SCAN_WORKERS = 8
+SCAN_AHEAD = 16384  # The most entries scanned ahead of a slower consumer
+_SCAN_AHEAD_BATCH = 256
+_STOP_CHECK_INTERVAL = 0.1
+
+
+class PathEntry:
+    """
+    An entry for an item known only by its path, with the same interface as os.DirEntry. stat() is called at most
+    once, and only when needed.
+    """
+
+    __slots__ = ("path", "name", "_stat")
+
+    def __init__(self, path):
+        self.path = path
+        self.name = os.path.basename(path)
+        self._stat = None
+
+    def stat(self):
+        if self._stat is None:
+            self._stat = os.stat(self.path)
+        return self._stat
+
+    def is_dir(self):
+        try:
+            return stat.S_ISDIR(self.stat().st_mode)
+        except OSError:
+            return False
+
+    def is_file(self):
+        try:
+            return stat.S_ISREG(self.stat().st_mode)
+        except OSError:
+            return False
+
+    def inode(self):
+        return self.stat().st_ino
+
+    def __repr__(self):
+        return f"PathEntry(path='{self.path}')"
+
+
+def passesFilter(filter_, entry):
+    """
+    Applies a filter to an entry. A CompiledFilter is given the entry itself, so it can use the type the scanner
+    already knows instead of checking the path again; any other filter function is given the path.
+
+    :param filter_: A filter function, or None to accept everything
+    :param entry: An entry from the scanner
+    :return: Whether the entry passes the filter
+    """
+
+    if filter_ is None:
+        return True
+    if isinstance(filter_, CompiledFilter):
+        return filter_(entry)
+    return filter_(entry.path)
+
+
+def shouldDescend(filter_, entry):
+    """
+    :param filter_: A filter function, or None
+    :param entry: An entry of a directory that passed the filter
+    :return: False if the filter proves nothing inside the directory can be accepted, so it needn't be listed
+    """
+
+    return not isinstance(filter_, CompiledFilter) or filter_.canContainMatches(entry.path)
+
+
+def scanTree(path, filter_=None, workers=1):
+    """
+    Walks the directory tree under path, yielding an os.DirEntry for every item found as soon as it is listed.
+    Directories are always yielded before anything inside them, so consumers can create a directory and then fill it.
+    The entries cache the results of is_dir() and stat(), so calling them does not cost another syscall where the
+    operating system already provided the information while listing.
+
+    :param path: The directory to scan
+    :param filter_: A function that returns a boolean result if a path matches a certain criteria. All items are
+    yielded if left empty or passed None; directories that do not pass are neither yielded nor descended into. A
+    CompiledFilter can also rule out whole subtrees, in which case the directory is yielded but not descended into.
+    :param workers: The number of threads listing directories at the same time; more than 1 helps on slow disks and
+    network volumes, where each listing mostly waits on the device. The order of siblings may then vary between runs.
+    :return: A generator of os.DirEntry objects
+    """
+
+    if workers > 1:
+        return _parallelScanTree(path, filter_, workers)
+    return _serialScanTree(path, filter_)
+
+
+def _serialScanTree(path, filter_):
+    # An explicit stack is used rather than recursion, so deep trees cannot hit the recursion limit
+    stack = [path]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if passesFilter(filter_, entry):
+                    yield entry
+                    if entry.is_dir() and shouldDescend(filter_, entry):
+                        stack.append(entry.path)
+
+
+def _listDirectory(path, filter_):
+    """
+    Lists and filters a single directory; run on the worker threads. is_dir() is called here so that any stat it
+    needs happens in parallel too, and the result is cached on the entry for the consumer.
+    """
+
+    listed = []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if passesFilter(filter_, entry):
+                entry.is_dir()
+                listed.append(entry)
+    return listed
+
+
+def _parallelScanTree(path, filter_, workers):
+    pool = ThreadPoolExecutor(max_workers=workers)
+    try:
+        pending = {pool.submit(_listDirectory, path, filter_)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                for entry in future.result():
+                    # The directory is yielded before its listing is even requested, so parents still come first
+                    yield entry
+                    if entry.is_dir() and shouldDescend(filter_, entry):
+                        pending.add(pool.submit(_listDirectory, entry.path, filter_))
+    finally:
+        # If the consumer stops early, don't list the rest of the tree
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+def scanAhead(entries, max_ahead=SCAN_AHEAD):
+    """
+    Runs a scan on a thread of its own, so it carries on while the consumer is busy, e.g. waiting for copies, rather
+    than only when the next entry is asked for. It only gets so far ahead, so however big the tree, the entries
+    waiting never take more than a bounded amount of memory. Entries are handed over in batches, but straight away
+    while the consumer is waiting for them.
+
+    :param entries: An iterable of entries, such as scanTree's generator; it is iterated on the scanning thread
+    :param max_ahead: The most entries scanned but not yet consumed, give or take a batch
+    :return: A generator of the same entries, in the same order; an exception raised by the scan is raised from it.
+    If the consumer stops early, the scan is stopped too.
+    """
+
+    batches = queue.Queue(max(1, max_ahead // _SCAN_AHEAD_BATCH))
+    stop = threading.Event()
+
+    def put(item):
+        # Gives up if the consumer has gone, so the thread can't block forever
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=_STOP_CHECK_INTERVAL)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def scan():
+        iterator = iter(entries)
+        try:
+            batch = []
+            for entry in iterator:
+                batch.append(entry)
+                # A consumer with nothing to do gets entries at once; a busy one gets them in batches
+                if len(batch) >= _SCAN_AHEAD_BATCH or batches.empty():
+                    if not put(batch):
+                        return
+                    batch = []
+            if batch and not put(batch):
+                return
+            put(None)
+        except BaseException as error:
+            put(error)
+        finally:
+            # A generator has to be closed by the thread running it
+            close = getattr(iterator, "close", None)
+            if close is not None:
+                close()
+
+    thread = threading.Thread(target=scan, name="scanAhead", daemon=True)
+    thread.start()
+    try:
+        while True:
+            batch = batches.get()
+            if batch is None:
+                return
+            if isinstance(batch, BaseException):
+                raise batch
+            yield from batch
+    finally:
+        stop.set()
+        thread.join()
@@ -0,0 +1,103 @@
+"""
+Snapshot folders in the target: each backup is made into a new folder named after when it started, and files that
+haven't changed since the previous snapshot are hard-linked from it instead of being copied. Every snapshot is a
+complete copy of the source as it was, but unchanged files share their data with the snapshots before.
+
+A snapshot is made under a name marking it incomplete, and only renamed once the backup has finished, so an
+interrupted backup is never mistaken for the previous snapshot. The next backup carries on in the incomplete folder
+instead, keeping whatever was already copied into it.
+"""
+
+import os
+import time
+
+from macup.library.constants import *
+
+SNAPSHOT_NAME_FORMAT = "%Y-%m-%d_%H-%M-%S"
+INCOMPLETE_SUFFIX = ".incomplete"
+
+
+def _snapshotKey(name):
+    """
+    :return: What a snapshot's name sorts by: the time it was started, and the counter added to tell snapshots started
+    in the same second apart; or None if the name isn't a snapshot's
+    """
+
+    time_part, _, count = name.partition("+")
+    try:
+        started = time.strptime(time_part, SNAPSHOT_NAME_FORMAT)
+    except ValueError:
+        return None
+    if count and not count.isdigit():
+        return None
+    return started, int(count or 1)
+
+
+def listSnapshots(target_dir):
+    """
+    :param target_dir: The target directory
+    :return: The names of the complete snapshots in the target, oldest first
+    """
+
+    try:
+        names = os.listdir(target_dir)
+    except FileNotFoundError:
+        return []
+    snapshots = [name for name in names
+                 if _snapshotKey(name) is not None and os.path.isdir(os.path.join(target_dir, name))]
+    return sorted(snapshots, key=_snapshotKey)
+
+
+def latestSnapshot(target_dir):
+    """ :return: The path of the most recent complete snapshot in the target, or None if there are none """
+    snapshots = listSnapshots(target_dir)
+    return os.path.join(target_dir, snapshots[-1]) if snapshots else None
+
+
+class SnapshotFolder:
+    """
+    The folder a backup makes a snapshot in. Used as a context manager, the snapshot is marked complete on leaving
+    unless an exception was raised.
+    """
+
+    def __init__(self, target_dir):
+        """
+        :param target_dir: The target directory, holding the snapshots
+        """
+
+        self.target_dir = target_dir
+        self.previous = latestSnapshot(target_dir)
+
+        incomplete = sorted((name[:-len(INCOMPLETE_SUFFIX)] for name in os.listdir(target_dir)
+                             if name.endswith(INCOMPLETE_SUFFIX) and _snapshotKey(name[:-len(INCOMPLETE_SUFFIX)])),
+                            key=_snapshotKey)
+        if incomplete:
+            # An interrupted backup's snapshot is carried on with, so its copies aren't made again
+            self.name = incomplete[-1]
+        else:
+            self.name = time.strftime(SNAPSHOT_NAME_FORMAT)
+            count = 1
+            while os.path.lexists(os.path.join(target_dir, self.name)):
+                count += 1
+                self.name = f"{time.strftime(SNAPSHOT_NAME_FORMAT)}+{count}"
+        self.path = os.path.join(target_dir, self.name + INCOMPLETE_SUFFIX)
+        os.makedirs(self.path, exist_ok=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.finish()
+
+    def linkDest(self, item_path, source_dir):
+        """ :return: The path of a source item in the previous snapshot, or None if there is no previous snapshot """
+        if self.previous is None:
+            return None
+        return os.path.join(self.previous, os.path.relpath(item_path, source_dir))
+
+    def finish(self):
+        """ Marks the snapshot complete, so the next backup links from it """
+        final_path = os.path.join(self.target_dir, self.name)
+        os.rename(self.path, final_path)
+        self.path = final_path
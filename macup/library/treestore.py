@@ -0,0 +1,215 @@
+"""
+Compact, array-backed representation of a scanned file tree, for sources too large to hold as FileTree objects.
+"""
+
+from array import array
+
+import os
+
+from macup.library.constants import *
+from macup.library.scanner import scanTree
+
+ROOT = -1  # Parent index of items directly inside the root directory
+
+_IS_DIRECTORY = 1
+
+# Most distinct names to intern; names met after this are stored again each time, so a tree of unique names costs
+# little more than storing every name
+NAME_LOOKUP_LIMIT = 4096
+
+
+class StoredEntry:
+    """
+    A lightweight view of one item in a TreeStore, with the same interface as the scanner's entries. Views are made
+    on demand and hold no data of their own, other than their path once it has been built.
+    """
+
+    __slots__ = ("store", "index", "_path")
+
+    def __init__(self, store, index, path=None):
+        self.store = store
+        self.index = index
+        self._path = path
+
+    @property
+    def path(self):
+        if self._path is None:
+            self._path = self.store.path(self.index)
+        return self._path
+
+    @property
+    def name(self):
+        return self.store.name(self.index)
+
+    def is_dir(self):
+        return self.store.isDirectory(self.index)
+
+    def is_file(self):
+        return not self.store.isDirectory(self.index)
+
+    def __repr__(self):
+        return f"StoredEntry(path='{self.path}')"
+
+
+class TreeStore:
+    """
+    Stores a file tree in flat arrays, one slot per item: the item's name (relative to its directory), the index of
+    its parent directory, a type flag, its size and its modification time. Names are interned, since the same names
+    (.DS_Store, Info.plist, numbered documents...) recur throughout a tree, so most items only hold the number of
+    their name; see NAME_LOOKUP_LIMIT. Full paths are only rebuilt when they are asked for. Items are stored in
+    scanner order, so every directory comes before its contents.
+    """
+
+    def __init__(self, root):
+        """
+        :param root: The directory the tree is rooted at; it is not stored as an item itself
+        """
+
+        self.root = os.path.abspath(root)
+        # Distinct names are stored once, back to back as bytes; name n is _names[_name_offsets[n]:_name_offsets[n + 1]]
+        self._names = bytearray()
+        self._name_offsets = array("I", [0])
+        # Numbers of interned names, up to NAME_LOOKUP_LIMIT of them
+        self._name_numbers = {}
+        self._name_ids = array("I")
+        self._parents = array("i")
+        self._flags = bytearray()
+        self._sizes = array("q")
+        self._mtimes = array("d")
+
+    @classmethod
+    def fromScan(cls, path, filter_=None, workers=1):
+        """
+        Builds a TreeStore from the scanner's output.
+
+        :param path: The directory to scan
+        :param filter_: A filter function, as accepted by scanTree
+        :param workers: Number of scanning threads, as accepted by scanTree
+        :return: The TreeStore
+        """
+
+        return cls.fromEntries(path, scanTree(os.path.abspath(path), filter_, workers))
+
+    @classmethod
+    def fromEntries(cls, path, entries):
+        """
+        Builds a TreeStore from entries in scanner order, e.g. from the scanner or an indexed scan.
+
+        :param path: The directory the entries were scanned from
+        :param entries: An iterable of entries, each directory coming before its contents
+        :return: The TreeStore
+        """
+
+        store = cls(path)
+        # Only directories need to be looked up to find parents, so only they are kept in a dict, and only while
+        # building
+        dir_indices = {store.root: ROOT}
+        for entry in entries:
+            is_directory = entry.is_dir()
+            try:
+                stat = entry.stat()
+                size, mtime = stat.st_size, stat.st_mtime
+            except OSError:
+                # E.g. a broken symbolic link; the copy will report the problem later
+                size, mtime = -1, 0.0
+
+            path = os.path.abspath(entry.path)
+            index = store.add(dir_indices[os.path.dirname(path)], entry.name, is_directory, size, mtime)
+            if is_directory:
+                dir_indices[path] = index
+
+        return store
+
+    def add(self, parent, name, is_directory, size, mtime):
+        """
+        Adds an item to the store; its parent must already have been added.
+
+        :param parent: Index of the parent directory, or ROOT
+        :param name: The item's name
+        :param is_directory: Whether the item is a directory
+        :param size: Size of the item in bytes
+        :param mtime: Modification time of the item
+        :return: The index of the new item
+        """
+
+        number = self._name_numbers.get(name)
+        if number is None:
+            number = len(self._name_offsets) - 1
+            if len(self._name_numbers) < NAME_LOOKUP_LIMIT:
+                self._name_numbers[name] = number
+            self._names += os.fsencode(name)
+            self._name_offsets.append(len(self._names))
+
+        self._name_ids.append(number)
+        self._parents.append(parent)
+        self._flags.append(_IS_DIRECTORY if is_directory else 0)
+        self._sizes.append(size)
+        self._mtimes.append(mtime)
+        return len(self._parents) - 1
+
+    def __len__(self):
+        return len(self._parents)
+
+    def __iter__(self):
+        """ Yields a StoredEntry for every item, so a TreeStore can be used wherever scanner output is expected """
+        for index, path in enumerate(self.paths()):
+            yield StoredEntry(self, index, path)
+
+    def _name(self, number):
+        return os.fsdecode(bytes(self._names[self._name_offsets[number]:self._name_offsets[number + 1]]))
+
+    def name(self, index):
+        return self._name(self._name_ids[index])
+
+    def parent(self, index):
+        return self._parents[index]
+
+    def isDirectory(self, index):
+        return bool(self._flags[index] & _IS_DIRECTORY)
+
+    def size(self, index):
+        return self._sizes[index]
+
+    def mtime(self, index):
+        return self._mtimes[index]
+
+    def path(self, index):
+        """ Rebuilds the full path of an item by following its parents up to the root """
+        names = []
+        while index != ROOT:
+            names.append(self.name(index))
+            index = self._parents[index]
+        return os.path.join(self.root, *reversed(names))
+
+    def paths(self, type_=None):
+        """
+        Yields the full paths of the items of a type, in store order. Directory paths are remembered as they are met,
+        so each path costs one join rather than a walk up to the root.
+
+        :param type_: FILES, DIRECTORY, or None for both
+        :return: A generator of paths
+        """
+
+        if type_ not in (FILES, DIRECTORY, None):
+            raise ValueError(f"type_ must be '{DIRECTORY}', '{FILES}' or None, not '{type_}'")
+
+        dir_paths = {ROOT: self.root}
+        for index in range(len(self)):
+            path = os.path.join(dir_paths[self._parents[index]], self.name(index))
+            is_directory = self.isDirectory(index)
+            if is_directory:
+                dir_paths[index] = path
+            if type_ is None or is_directory == (type_ == DIRECTORY):
+                yield path
+
+    def totals(self):
+        """ :return: The number of files in the store and their total size in bytes """
+        count = total = 0
+        for index in range(len(self)):
+            if not self.isDirectory(index):
+                count += 1
+                total += max(self._sizes[index], 0)
+        return count, total
+
+    def __repr__(self):
+        return f"TreeStore(root='{self.root}', items={len(self)})"
@@ -1,6 +1,7 @@
 import os
 
 from PyQt6 import QtWidgets
+from PyQt6.QtCore import QTimer
 from PyQt6.QtWidgets import QMessageBox
 
 import macup.library.config as cfglib
@@ -8,7 +9,15 @@ import macup.library.constants as consts
 
 from macup.ui.mainwindow import Ui_MainWindow
 from macup.library.ui.addconfig import AddConfigDialogUI
-from macup.library.ui.modifyfilterdialog import ModifyFilterDialogUI
+from macup.library.filter import FilterCache
+from macup.library.ui.modifyfilterdialog import ModifyFilterDialogUI, filter_type_order, test_filter_delay
+
+# The copy modes in the order of the copy mode combobox
+copy_mode_order = (consts.SKIP_EXISTING, consts.OVERWRITE, consts.UPDATE, consts.CHECKSUM)
+# The storage formats in the order of the storage combobox
+storage_order = (consts.MIRROR, consts.PACKED, consts.DEDUPLICATED, consts.SNAPSHOTS)
+# The compressions in the order of the compression combobox
+compression_order = (consts.NO_COMPRESSION, consts.ZLIB, consts.LZMA, consts.BZ2)
 
 window_title = "MacUp"
 
@@ -23,6 +32,7 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow):
         self.selected_config_log = []
         self.unsavedChanges = False
         self.loaded_cfg = None  # This is set by populateCfgBox
+        self.filter_cache = FilterCache()  # Shared with filter dialogs, so item types are remembered between them
         self.configs = []  # Set by populateCfgBox in next line
         self.populateCfgBox()
 
@@ -39,8 +49,14 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow):
         self.editfilter_btn.clicked.connect(self.openEditFilterDialog_byBtn)
         self.delfilter_btn.clicked.connect(self.deleteSelectedFilter)
 
+        # Typing a path only tests the filters once typing pauses
+        self.test_filter_timer = QTimer(self)
+        self.test_filter_timer.setSingleShot(True)
+        self.test_filter_timer.setInterval(test_filter_delay)
+        self.test_filter_timer.timeout.connect(self.applyFiltersToTest)
+
         self.testfilter_btn.clicked.connect(self.openTestingItemFileDialog)
-        self.testfilter_lnedit.textChanged.connect(self.applyFiltersToTest)
+        self.testfilter_lnedit.textChanged.connect(self.test_filter_timer.start)
 
         self.backup_btn.clicked.connect(self.startBackup)
 
@@ -48,7 +64,15 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow):
         # textEdited must be used - textChanged causes problems when switching between configs
         self.src_line.textEdited.connect(self.noteUnsavedChanges)
         self.target_line.textEdited.connect(self.noteUnsavedChanges)
-        self.overwrite_check.stateChanged.connect(self.noteUnsavedChanges)
+        self.copymode_combobox.currentIndexChanged.connect(self.noteUnsavedChanges)
+        self.copymode_combobox.currentIndexChanged.connect(self.whenCopyModeCBoxChanged)
+        self.fattolerance_check.stateChanged.connect(self.noteUnsavedChanges)
+        self.storage_combobox.currentIndexChanged.connect(self.noteUnsavedChanges)
+        self.compression_combobox.currentIndexChanged.connect(self.noteUnsavedChanges)
+        self.delta_check.stateChanged.connect(self.noteUnsavedChanges)
+        self.deletestale_check.stateChanged.connect(self.noteUnsavedChanges)
+        self.parallelscan_check.stateChanged.connect(self.noteUnsavedChanges)
+        self.storage_combobox.currentIndexChanged.connect(self.whenStorageCBoxChanged)
 
     def openAddCfg(self):
         """ Opens the Add configuration UI """
@@ -122,7 +146,13 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow):
         # The loaded_cfg attribute is modified directly when filters are edited, i.e., filters are directly changed
         # when they are edited
 
-        self.loaded_cfg.overwrite = self.overwrite_check.isChecked()
+        self.loaded_cfg.copy_mode = copy_mode_order[self.copymode_combobox.currentIndex()]
+        self.loaded_cfg.mtime_tolerance = consts.FAT_MTIME_TOLERANCE if self.fattolerance_check.isChecked() else 0.0
+        self.loaded_cfg.storage = storage_order[self.storage_combobox.currentIndex()]
+        self.loaded_cfg.compression = compression_order[self.compression_combobox.currentIndex()]
+        self.loaded_cfg.delta_updates = self.delta_check.isChecked()
+        self.loaded_cfg.delete_stale = self.deletestale_check.isChecked() and self.loaded_cfg.storage == consts.MIRROR
+        self.loaded_cfg.parallel_scan = self.parallelscan_check.isChecked()
 
         cfglib.saveConfig(self.loaded_cfg, self.data_path)
         self.noteSavedChanges()
@@ -141,10 +171,39 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow):
         self.filter_listwidget.clear()
         self.filter_listwidget.addItems([filter_.name for filter_ in self.loaded_cfg.filters])
 
-        self.overwrite_check.setChecked(self.loaded_cfg.overwrite)
+        self.copymode_combobox.setCurrentIndex(copy_mode_order.index(self.loaded_cfg.copy_mode))
+        self.fattolerance_check.setChecked(self.loaded_cfg.mtime_tolerance >= consts.FAT_MTIME_TOLERANCE)
+        self.whenCopyModeCBoxChanged()
+        self.storage_combobox.setCurrentIndex(storage_order.index(self.loaded_cfg.storage))
+        self.compression_combobox.setCurrentIndex(compression_order.index(self.loaded_cfg.compression))
+        self.delta_check.setChecked(self.loaded_cfg.delta_updates)
+        self.deletestale_check.setChecked(self.loaded_cfg.delete_stale)
+        self.parallelscan_check.setChecked(self.loaded_cfg.parallel_scan)
+        self.whenStorageCBoxChanged()
 
         self.cfgselect_combobox.setCurrentIndex(self.cfgselect_combobox.findText(self.loaded_cfg.name))
 
+    def whenCopyModeCBoxChanged(self):
+        """ The timestamp tolerance only matters when comparing modification times """
+        self.fattolerance_check.setEnabled(copy_mode_order[self.copymode_combobox.currentIndex()] == consts.UPDATE)
+
+    def whenStorageCBoxChanged(self):
+        """ Only a mirrored target can have stale items deleted from it """
+        self.deletestale_check.setEnabled(storage_order[self.storage_combobox.currentIndex()] == consts.MIRROR)
+
+    def confirmDeletions(self):
+        """ Asks before deleting stale items from the target, listing the first few; returns true to go ahead """
+        from macup.library.mirror import DELETE, planMirror
+        deletions = [item.path for item in planMirror(self.loaded_cfg.source_dir, self.loaded_cfg.target_dir,
+                                                      self.loaded_cfg.filters, self.loaded_cfg.mtime_tolerance)
+                     if item.action == DELETE]
+        if not deletions:
+            return True
+        listed = "\n".join(deletions[:10]) + ("\n..." if len(deletions) > 10 else "")
+        return QMessageBox.question(self, "", f"{len(deletions)} items will be deleted from the target, as they "
+                                              f"aren't in the source:\n{listed}\n\nContinue?") == \
+            QMessageBox.StandardButton.Yes
+
     def selectSourceDir(self):
         """ Opens the directory selection when the source directory button is pressed """
         self.openFileDialog(self.src_line)
@@ -167,7 +226,7 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow):
 
     def openAddFilterDialog(self):
         """ Opens the dialog for adding a filter """
-        edit_filter_dlg = ModifyFilterDialogUI()
+        edit_filter_dlg = ModifyFilterDialogUI(filter_cache=self.filter_cache)
         edit_filter_dlg.setWindowTitle("Add filter")
         response = edit_filter_dlg.exec()
 
@@ -204,16 +263,14 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow):
             QMessageBox.warning(self, "", "Filter could not be found. Please tell the developer.")
             return
 
-        edit_filter_dlg = ModifyFilterDialogUI()
+        edit_filter_dlg = ModifyFilterDialogUI(filter_cache=self.filter_cache)
         # Fill and disable name line edit
         edit_filter_dlg.ui.namelineedit.setText(editing_filter.name)
         edit_filter_dlg.ui.namelineedit.setEnabled(False)
 
         # Fill filter type
-        if editing_filter.filter_type == consts.REGEX:
-            index = 0
-        elif editing_filter.filter_type == consts.KEYWORD:
-            index = 1
+        if editing_filter.filter_type in filter_type_order:
+            index = filter_type_order.index(editing_filter.filter_type)
         else:
             QMessageBox(self, "",
                         "Invalid index for filter type - you shouldn't be seeing this. Please tell the developer.")
@@ -254,6 +311,10 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow):
         response = edit_filter_dlg.exec()
 
         if response == 1:
+            if edit_filter_dlg.filter_ is None:
+                QMessageBox.information(self, "", "The filter's data is not valid, so it was not changed.")
+                return
+
             # Edit filter with new attributes
             for i, filter_ in enumerate(self.loaded_cfg.filters):
                 # For each filter, compare its name with the name provided, break after editing the filter if found
@@ -297,17 +358,18 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow):
         # Check that the user didn't press cancel, which returns a blank, falsy string
         if selected_dir:
             # Set lineedit
+            self.filter_cache.forgetPath(selected_dir)
             self.testfilter_lnedit.setText(selected_dir)
             self.applyFiltersToTest()
             return selected_dir
 
     def applyFiltersToTest(self):
         """ Updates the test label """
-        from macup.library.filter import applyFilters
+        self.test_filter_timer.stop()
         if self.testfilter_lnedit.text() == "":
             # Path is blank
             self.testfilteroutput_label.setText("No item selected.")
-        elif applyFilters(self.loaded_cfg.filters, self.testfilter_lnedit.text()):
+        elif self.filter_cache.apply(self.loaded_cfg.filters, self.testfilter_lnedit.text()):
             # Item will be copied
             self.testfilteroutput_label.setText("Item matches this filter, and will be copied.")
         else:
@@ -382,11 +444,32 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow):
             QMessageBox.warning(self, "", "Invalid target directory.")
             return False
 
+        if self.loaded_cfg.delete_stale and not self.confirmDeletions():
+            return False
+
         from macup.library.backup import backup
-        backup(src_dir=self.loaded_cfg.source_dir,
-               target_dir=self.loaded_cfg.target_dir,
-               filters=self.loaded_cfg.filters,
-               overwrite=self.overwrite_check.isChecked())
+        from macup.library.changes import getJournalPath
+        from macup.library.delta import DELTA_THRESHOLD
+        from macup.library.scanindex import getIndexPath
+        from macup.library.scanner import DEFAULT_SCAN_WORKERS
+        report = backup(src_dir=self.loaded_cfg.source_dir,
+                        target_dir=self.loaded_cfg.target_dir,
+                        filters=self.loaded_cfg.filters,
+                        overwrite=self.loaded_cfg.copy_mode,
+                        mtime_tolerance=self.loaded_cfg.mtime_tolerance,
+                        storage=self.loaded_cfg.storage,
+                        compression=self.loaded_cfg.compression,
+                        delta_threshold=DELTA_THRESHOLD if self.loaded_cfg.delta_updates else None,
+                        delete_stale=self.loaded_cfg.delete_stale,
+                        scan_workers=DEFAULT_SCAN_WORKERS if self.loaded_cfg.parallel_scan else 1,
+                        index_path=getIndexPath(self.loaded_cfg.name, self.data_path),
+                        journal_path=getJournalPath(self.loaded_cfg.name, self.data_path))
+
+        if not report.succeeded:
+            failures = "\n".join(f"{failure.source}: {failure.error}" for failure in report.failures[:10])
+            QMessageBox.warning(self, "", f"{len(report.failures)} files could not be copied:\n{failures}")
+            return False
+        return True
 
 
 def main():
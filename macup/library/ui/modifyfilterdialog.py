@@ -1,14 +1,22 @@
+from PyQt6.QtCore import QTimer
 from PyQt6.QtWidgets import QDialog, QApplication, QFileDialog
 
 from macup.ui.modifyfilter import Ui_modifyfilter
 
 from macup.library.classes import Filter
 from macup.library.constants import *
-from macup.library.filter import applyFilters
+from macup.library.filter import FilterCache
+
+test_filter_delay = 250  # Milliseconds to wait after the last edit before testing the filter again
+
+# The filter types in the order of the filter type combobox, and examples of their data
+filter_type_order = (REGEX, KEYWORD, SIZE_GREATER, SIZE_LESS, MODIFIED_BEFORE, MODIFIED_AFTER, OLDER_THAN, NEWER_THAN)
+filter_data_examples = {SIZE_GREATER: "e.g. 500MB", SIZE_LESS: "e.g. 500MB", MODIFIED_BEFORE: "e.g. 2024-01-31",
+                        MODIFIED_AFTER: "e.g. 2024-01-31", OLDER_THAN: "e.g. 30d", NEWER_THAN: "e.g. 30d"}
 
 
 class ModifyFilterDialogUI(QDialog):
-    def __init__(self, parent=None):
+    def __init__(self, parent=None, filter_cache=None):
         super().__init__(parent)
         self.ui = Ui_modifyfilter()
         self.ui.setupUi(self)
@@ -16,6 +24,13 @@ class ModifyFilterDialogUI(QDialog):
 
         # Initialise filter
         self.filter_ = None
+        self.filter_cache = FilterCache() if filter_cache is None else filter_cache
+
+        # Testing the filter is delayed until editing pauses, rather than done on every keystroke
+        self.test_timer = QTimer(self)
+        self.test_timer.setSingleShot(True)
+        self.test_timer.setInterval(test_filter_delay)
+        self.test_timer.timeout.connect(self.updateFilterTestOutput)
 
         # Initialises the Data label
         self.whenFilterTypeCBoxChanged()
@@ -24,18 +39,26 @@ class ModifyFilterDialogUI(QDialog):
         self.ui.testfileselect_btn.clicked.connect(self.openFilterTestFile)
 
         # Update filter test output connections
-        self.ui.namelineedit.textChanged.connect(self.updateFilterTestOutput)
-        self.ui.filtertype_combobox.currentIndexChanged.connect(self.updateFilterTestOutput)
-        self.ui.datalineedit.textChanged.connect(self.updateFilterTestOutput)
-        self.ui.appcombobox.currentIndexChanged.connect(self.updateFilterTestOutput)
-        self.ui.typecombobox.currentIndexChanged.connect(self.updateFilterTestOutput)
-        self.ui.whitelistradiobtn.clicked.connect(self.updateFilterTestOutput)
-        self.ui.testlineedit.textChanged.connect(self.updateFilterTestOutput)
+        self.ui.namelineedit.textChanged.connect(self.filterEdited)
+        self.ui.filtertype_combobox.currentIndexChanged.connect(self.filterEdited)
+        self.ui.datalineedit.textChanged.connect(self.filterEdited)
+        self.ui.appcombobox.currentIndexChanged.connect(self.filterEdited)
+        self.ui.typecombobox.currentIndexChanged.connect(self.filterEdited)
+        self.ui.whitelistradiobtn.clicked.connect(self.filterEdited)
+        self.ui.testlineedit.textChanged.connect(self.filterEdited)
 
     def whenFilterTypeCBoxChanged(self):
         """ Updates some parts of the UI when the type of filter is changed """
-        filter_type = self.ui.filtertype_combobox.currentText()
-        self.ui.datalabel.setText(f"{filter_type}:")
+        self.ui.datalabel.setText(f"{self.ui.filtertype_combobox.currentText()}:")
+        filter_type = filter_type_order[self.ui.filtertype_combobox.currentIndex()]
+        self.ui.datalineedit.setPlaceholderText(filter_data_examples.get(filter_type, ""))
+
+        # Metadata filters apply to the item itself, not its path or name, and only to files
+        is_metadata = filter_type in METADATA_FILTER_TYPES
+        self.ui.appcombobox.setEnabled(not is_metadata)
+        self.ui.typecombobox.model().item(1).setEnabled(not is_metadata)
+        if is_metadata and self.ui.typecombobox.currentIndex() == 1:
+            self.ui.typecombobox.setCurrentIndex(2)
 
         # Hide/show the regex101 link
         if filter_type == REGEX:
@@ -46,11 +69,7 @@ class ModifyFilterDialogUI(QDialog):
     def buildFilter(self):
         """ Returns a Filter object, depending on the values set in the UI """
 
-        filter_type = self.ui.filtertype_combobox.currentIndex()
-        if filter_type == 0:
-            filter_type = REGEX
-        else:
-            filter_type = KEYWORD
+        filter_type = filter_type_order[self.ui.filtertype_combobox.currentIndex()]
 
         application_index = self.ui.appcombobox.currentIndex()
         if application_index == 0:
@@ -83,19 +102,35 @@ class ModifyFilterDialogUI(QDialog):
         # Check that the user didn't press cancel, which returns a blank, falsy string
         if selected_dir:
             # Set lineedit
+            self.filter_cache.forgetPath(selected_dir)
             self.ui.testlineedit.setText(selected_dir)
             self.updateFilterTestOutput()
             return selected_dir
 
+    def filterEdited(self):
+        """ Keeps the filter attribute up to date straight away, and tests it once editing pauses """
+        try:
+            self.filter_ = self.buildFilter()
+        except ValueError:
+            # The data isn't valid (yet), e.g. a size still being typed
+            self.filter_ = None
+        self.test_timer.start()
+
     def updateFilterTestOutput(self):
         """ Updates the output of the filter testing label, also updates the filter attribute to be passed back to main """
 
-        self.filter_ = self.buildFilter()
+        self.test_timer.stop()
+        try:
+            self.filter_ = self.buildFilter()
+        except ValueError as error:
+            self.filter_ = None
+            self.ui.testfilteroutputlabel.setText(str(error))
+            return
 
         if self.ui.testlineedit.text() == "":
             # Path is blank
             self.ui.testfilteroutputlabel.setText("No item selected.")
-        elif applyFilters([self.filter_], self.ui.testlineedit.text()):
+        elif self.filter_cache.apply([self.filter_], self.ui.testlineedit.text()):
             # Item will be copied
             self.ui.testfilteroutputlabel.setText("Item matches this filter, and will be copied.")
         else:
@@ -0,0 +1,63 @@
+"""
+Backs up a small tree three times in each copy mode, changing one file in between, and prints and checks what was
+copied and skipped. UPDATE should only copy the changed file, and keep the source's modification times on its copies.
+"""
+
+import os
+import tempfile
+import time
+
+from macup.library.backup import backup
+from macup.library.classes import Configuration
+from macup.library.config import parseConfigToDict, parseDictToConfig
+from macup.library.constants import *
+from macup.library.copyengine import COPIED, SKIPPED
+
+# What the second and third backups copy in each mode, after the first has copied all three files
+EXPECTED_COPIES = {SKIP_EXISTING: (0, 0), OVERWRITE: (3, 3), UPDATE: (0, 1), CHECKSUM: (0, 1)}
+
+for copy_mode in COPY_MODES:
+    with tempfile.TemporaryDirectory() as source, tempfile.TemporaryDirectory() as target:
+        for name in ("a.txt", "b.txt", "c.txt"):
+            with open(os.path.join(source, name), "w") as f:
+                f.write(name)
+        # Old enough that rewriting the file changes its mtime
+        past = time.time() - 60
+        for name in os.listdir(source):
+            os.utime(os.path.join(source, name), (past, past))
+
+        first = backup(source, target, [], copy_mode)
+        second = backup(source, target, [], copy_mode)
+        with open(os.path.join(source, "b.txt"), "w") as f:
+            f.write("changed")
+        third = backup(source, target, [], copy_mode)
+        with open(os.path.join(target, "b.txt")) as f:
+            contents = f.read()
+        same_mtime = os.stat(os.path.join(source, "a.txt")).st_mtime == os.stat(os.path.join(target, "a.txt")).st_mtime
+        print(copy_mode, first, second, third, contents, f"mtime kept: {same_mtime}")
+        assert first.succeeded and first.counts[COPIED] == 3, first
+        assert (second.counts[COPIED], third.counts[COPIED]) == EXPECTED_COPIES[copy_mode], (second, third)
+        assert contents == ("b.txt" if copy_mode == SKIP_EXISTING else "changed")
+        assert same_mtime == (copy_mode == UPDATE)
+
+# FAT tolerance: a copy whose mtime is a second off still counts as unchanged
+with tempfile.TemporaryDirectory() as source, tempfile.TemporaryDirectory() as target:
+    with open(os.path.join(source, "a.txt"), "w") as f:
+        f.write("a")
+    backup(source, target, [], UPDATE)
+    mtime = os.stat(os.path.join(source, "a.txt")).st_mtime
+    os.utime(os.path.join(target, "a.txt"), (mtime + 1, mtime + 1))
+    report = backup(source, target, [], UPDATE)
+    print("no tolerance:", report)
+    assert report.counts[COPIED] == 1 and report.counts[SKIPPED] == 0, report
+    os.utime(os.path.join(target, "a.txt"), (mtime + 1, mtime + 1))
+    report = backup(source, target, [], UPDATE, mtime_tolerance=FAT_MTIME_TOLERANCE)
+    print("FAT tolerance:", report)
+    assert report.counts[COPIED] == 0 and report.counts[SKIPPED] == 1, report
+
+# Configurations keep their copy mode through json, and older ones without it still load
+config = Configuration("cfg", "/src", "/dst", [], False, UPDATE, FAT_MTIME_TOLERANCE)
+print(parseDictToConfig(parseConfigToDict(config)))
+old_dict = parseConfigToDict(Configuration("old", "/src", "/dst", [], True))
+del old_dict["copy_mode"], old_dict["mtime_tolerance"]
+print(parseDictToConfig(old_dict))
@@ -0,0 +1,4 @@
+from macup.library.backup import partitionItems
+from macup.library.classes import FileTree
+
+print(partitionItems(FileTree("/Users/calebhair/Documents/Projects/MacUp/macup/tests/TestDir")))
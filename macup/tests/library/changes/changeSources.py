@@ -0,0 +1,109 @@
+"""
+Exercises each available change source on a temporary directory, then runs a watcher thread around two journaled
+backups, checking the second only copies what changed.
+"""
+
+import os
+import tempfile
+import threading
+import time
+
+import macup.library.backup as bk
+from macup.library.changes import CHANGE_SOURCES, ChangeJournal, ChangeSource, runWatcher
+
+
+def write(path, text="data"):
+    with open(path, "w") as f:
+        f.write(text)
+
+
+class IncompleteChangeSource(ChangeSource):
+    # Does not implement poll
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+
+for incomplete_class in (ChangeSource, IncompleteChangeSource):
+    try:
+        incomplete_class("/")
+        raise AssertionError(f"{incomplete_class.__name__} could be made without implementing every method")
+    except TypeError:
+        pass
+
+
+for change_source_class in CHANGE_SOURCES:
+    if not change_source_class.isAvailable():
+        print(f"{change_source_class.__name__}: not available")
+        continue
+
+    with tempfile.TemporaryDirectory() as root:
+        os.mkdir(os.path.join(root, "existing"))
+        write(os.path.join(root, "existing", "file"))
+        with change_source_class(root) as change_source:
+            write(os.path.join(root, "existing", "file"), "changed")
+            os.makedirs(os.path.join(root, "new", "nested"))
+            dirty = set()
+            for _ in range(3):
+                dirty |= change_source.poll(0.2)
+        assert os.path.join(root, "existing", "file") in dirty, dirty
+        assert os.path.join(root, "new") in dirty, dirty
+        print(f"{change_source_class.__name__}: {sorted(os.path.relpath(path, root) for path in dirty)}")
+
+
+with tempfile.TemporaryDirectory() as tmp:
+    source, target = os.path.join(tmp, "source"), os.path.join(tmp, "target")
+    os.makedirs(os.path.join(source, "a"))
+    os.mkdir(target)
+    write(os.path.join(source, "a", "one"))
+    write(os.path.join(source, "two"))
+    journal_path = os.path.join(tmp, "journal")
+
+    stop_event = threading.Event()
+    watcher = threading.Thread(target=runWatcher,
+                               args=(source, ChangeJournal(journal_path), stop_event, 0.1))
+    watcher.start()
+    time.sleep(0.5)
+
+    bk.backup(source, target, [], True, journal_path=journal_path)  # Full backup, as the journal is new
+    write(os.path.join(source, "a", "three"))
+    time.sleep(0.5)
+    print("Dirty paths:", ChangeJournal(journal_path).read())
+
+    copied = []
+    original_copy = bk.copyFiles
+    bk.copyFiles = lambda files, *args: copied.extend(files) or original_copy(files, *args)
+    bk.backup(source, target, [], True, journal_path=journal_path)
+    bk.copyFiles = original_copy
+    stop_event.set()
+    watcher.join()
+
+    assert copied == [os.path.join(source, "a", "three")], copied
+    assert os.path.isfile(os.path.join(target, "a", "three"))
+    print("Journaled backup copied:", copied)
+
+
+# A watcher appending while backups read and reset the journal, each through an object of its own as they would be in
+# separate processes: every recorded path must be read by exactly one of the backups
+with tempfile.TemporaryDirectory() as tmp:
+    journal_path = os.path.join(tmp, "journal")
+    ChangeJournal(journal_path).markStarted()
+    ChangeJournal(journal_path).reset()
+    recorded = [f"/source/{i}" for i in range(5000)]
+
+    def watch():
+        journal = ChangeJournal(journal_path)
+        for i in range(0, len(recorded), 10):
+            journal.record(recorded[i:i + 10])
+
+    watcher = threading.Thread(target=watch)
+    watcher.start()
+    read = []
+    while watcher.is_alive():
+        read.extend(ChangeJournal(journal_path).readAndReset())
+    watcher.join()
+    read.extend(ChangeJournal(journal_path).readAndReset())
+    assert sorted(read) == sorted(recorded), f"{len(recorded) - len(set(read))} paths lost"
+    print(f"Concurrent journal: {len(read)} paths read, none lost")
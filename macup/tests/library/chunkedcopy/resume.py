@@ -0,0 +1,107 @@
+"""
+Interrupts the chunked copy of a large file part way through, then copies it again, checking the second copy resumes
+from the last checkpoint rather than byte 0 and that the result is byte-exact. A partial copy that doesn't match the
+source is started again instead. A copy_file_range that returns 0 early still gives a complete copy, and a source
+that can't be read to the end leaves the target alone.
+"""
+
+import filecmp
+import os
+import tempfile
+
+from macup.library.chunkedcopy import copyLargeFile, getCheckpointPath, getPartialPath
+from macup.library.constants import *
+from macup.library.copyengine import ChunkedCopies, CopyEngine
+
+MB = 1024 * 1024
+
+
+class Interrupted(Exception):
+    pass
+
+
+def interruptAt(limit):
+    def progress(source, copied, total):
+        if copied >= limit:
+            raise Interrupted()
+    return progress
+
+
+def copy(source, target, progress=None, source_stat=None):
+    fd = os.open(source, os.O_RDONLY)
+    try:
+        return copyLargeFile(fd, os.fstat(fd) if source_stat is None else source_stat, source, target, OVERWRITE,
+                             chunk_size=MB, checkpoint_interval=8 * MB, progress=progress)
+    finally:
+        os.close(fd)
+
+
+with tempfile.TemporaryDirectory() as root:
+    source = os.path.join(root, "disk.img")
+    target = os.path.join(root, "copy.img")
+    with open(source, "wb") as f:
+        f.write(os.urandom(64 * MB))
+
+    try:
+        copy(source, target, interruptAt(40 * MB))
+    except Interrupted:
+        print("Interrupted; partial:", os.path.getsize(getPartialPath(target)) // MB, "MB, checkpoint exists:",
+              os.path.exists(getCheckpointPath(target)))
+
+    size, resumed_from, written = copy(source, target)
+    print(f"Resumed from {resumed_from // MB} MB, copied {size // MB} MB, byte-exact:",
+          filecmp.cmp(source, target, shallow=False), "leftovers:",
+          os.path.exists(getPartialPath(target)) or os.path.exists(getCheckpointPath(target)))
+
+    # Corrupt the partial copy's last chunk before its checkpoint, so it can't be trusted
+    os.remove(target)
+    try:
+        copy(source, target, interruptAt(20 * MB))
+    except Interrupted:
+        pass
+    with open(getPartialPath(target), "r+b") as f:
+        f.seek(16 * MB - 10)
+        f.write(b"corruption")
+    size, resumed_from, written = copy(source, target)
+    print(f"After corruption, resumed from {resumed_from // MB} MB, byte-exact:",
+          filecmp.cmp(source, target, shallow=False))
+
+    # copy_file_range returning 0 without copying, as it does on some filesystems
+    os.remove(target)
+    original_copy_file_range = os.copy_file_range
+    os.copy_file_range = lambda *args: 0
+    try:
+        size, resumed_from, written = copy(source, target)
+    finally:
+        os.copy_file_range = original_copy_file_range
+    assert filecmp.cmp(source, target, shallow=False)
+    print(f"copy_file_range returning 0: copied {size // MB} MB, byte-exact")
+
+    # A source shorter than its stat said, as if it shrank during the copy
+    with open(target, "rb") as f:
+        before = f.read()
+    source_stat = os.stat(source)
+    larger_stat = os.stat_result((source_stat.st_mode, source_stat.st_ino, source_stat.st_dev, source_stat.st_nlink,
+                                  source_stat.st_uid, source_stat.st_gid, source_stat.st_size + MB,
+                                  source_stat.st_atime, source_stat.st_mtime, source_stat.st_ctime))
+    try:
+        copy(source, target, source_stat=larger_stat)
+        raise AssertionError("a short source was copied over the target")
+    except OSError as error:
+        with open(target, "rb") as f:
+            assert f.read() == before
+        assert os.path.exists(getPartialPath(target)) and os.path.exists(getCheckpointPath(target))
+        print(f"Short source: {error}; target untouched, partial and checkpoint kept")
+    os.remove(getPartialPath(target))
+    os.remove(getCheckpointPath(target))
+
+    # Through the engine, with progress reports
+    os.remove(target)
+    reports = []
+    with CopyEngine(strategies=[ChunkedCopies(16 * MB, 16 * MB)],
+                    progress=lambda path, copied, total: reports.append(copied // MB)) as engine:
+        engine.submit(source, target, SKIP_EXISTING)
+    print(engine.report, "progress:", reports, "byte-exact:", filecmp.cmp(source, target, shallow=False))
+    with CopyEngine(strategies=[ChunkedCopies(16 * MB)]) as engine:
+        engine.submit(source, target, SKIP_EXISTING)
+    print("Again without overwrite:", engine.report)
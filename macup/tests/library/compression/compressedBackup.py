@@ -0,0 +1,120 @@
+"""
+Backs up a source of text, CSV, already-compressed and random files with each compression, printing the ratio and
+throughput, and checks the compressed files are ordinary gzip/xz/bzip2 files, the incompressible ones are copied as
+they are, and the target restores byte-exact. Then checks later runs skip unchanged files in UPDATE and CHECKSUM
+mode, and that a file which stops being compressible replaces its compressed copy.
+"""
+
+import filecmp
+import gzip
+import os
+import random
+import tempfile
+import time
+
+from macup.library.backup import backup
+from macup.library.compression import Compressor, DEFAULT_BLOCK_SIZE, restoreTree
+from macup.library.constants import *
+from macup.library.copyengine import COPIED, SKIPPED
+from macup.library.hashcache import HashCache, getHashCachePath
+from macup.library.copyengine import CompressedCopies, CopyEngine
+
+MB = 1024 * 1024
+
+rng = random.Random(19)
+
+
+def logLines(size):
+    levels = ("INFO", "DEBUG", "WARNING", "ERROR")
+    lines = []
+    length = 0
+    while length < size:
+        line = f"2024-01-{rng.randrange(1, 29):02} 12:{rng.randrange(60):02}:{rng.randrange(60):02} " \
+               f"{rng.choice(levels)} worker-{rng.randrange(16)} request {rng.randrange(10 ** 6)} took " \
+               f"{rng.randrange(1000)} ms\n"
+        lines.append(line)
+        length += len(line)
+    return "".join(lines).encode()
+
+
+def makeSource(root):
+    os.makedirs(os.path.join(root, "logs"))
+    with open(os.path.join(root, "logs", "server.log"), "wb") as f:
+        f.write(logLines(24 * MB))
+    with open(os.path.join(root, "export.csv"), "wb") as f:
+        f.write(b"id,name,value\n" + b"".join(f"{i},item{i},{i * 7 % 1000}\n".encode() for i in range(20000)))
+    with open(os.path.join(root, "photo.jpg"), "wb") as f:
+        f.write(os.urandom(MB))
+    with open(os.path.join(root, "random.bin"), "wb") as f:
+        f.write(os.urandom(MB))
+    with open(os.path.join(root, "tiny.txt"), "wb") as f:
+        f.write(b"tiny")
+
+
+def compareTrees(a, b):
+    stack = [filecmp.dircmp(a, b)]
+    while stack:
+        comparison = stack.pop()
+        assert not comparison.left_only and not comparison.right_only, (comparison.left_only, comparison.right_only)
+        _, mismatch, errors = filecmp.cmpfiles(comparison.left, comparison.right, comparison.common_files,
+                                               shallow=False)
+        assert not mismatch and not errors, (mismatch, errors)
+        stack.extend(comparison.subdirs.values())
+
+
+with tempfile.TemporaryDirectory() as root:
+    source = os.path.join(root, "source")
+    makeSource(source)
+
+    # Blocks of a large file compressed on one thread and on several
+    log = os.path.join(source, "logs", "server.log")
+    for workers in (1, 4):
+        with Compressor(ZLIB, workers=workers) as compressor:
+            source_fd = os.open(log, os.O_RDONLY)
+            target_fd = os.open(os.path.join(root, "server.log.gz"), os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
+            start = time.perf_counter()
+            read, written = compressor.compressFile(source_fd, target_fd)
+            elapsed = time.perf_counter() - start
+            os.close(source_fd)
+            os.close(target_fd)
+        print(f"ZLIB with {workers} workers: {read / MB / elapsed:.1f} MB/s")
+    # Several members, but an ordinary gzip file
+    assert read > DEFAULT_BLOCK_SIZE
+    assert gzip.decompress(open(os.path.join(root, "server.log.gz"), "rb").read()) == open(log, "rb").read()
+
+    for compression in (ZLIB, LZMA, BZ2):
+        target = os.path.join(root, compression.lower())
+        os.makedirs(target)
+        report = backup(source, target, [], UPDATE, compression=compression)
+        assert report.succeeded, report.failures
+        print(f"{compression}: {report}")
+
+        names = sorted(name for name in os.listdir(target) if name != METADATA_DIR)
+        suffix = {ZLIB: ".macup.gz", LZMA: ".macup.xz", BZ2: ".macup.bz2"}[compression]
+        assert names == sorted(["logs", "export.csv" + suffix, "photo.jpg", "random.bin", "tiny.txt"]), names
+        assert report.compression_ratio > 3, report.compression_ratio
+
+        restored = os.path.join(root, compression.lower() + " restored")
+        assert restoreTree(target, restored) == 5
+        compareTrees(source, restored)
+        assert os.stat(os.path.join(restored, "export.csv")).st_mtime_ns == \
+            os.stat(os.path.join(source, "export.csv")).st_mtime_ns
+
+    target = os.path.join(root, "zlib")
+    report = backup(source, target, [], UPDATE, compression=ZLIB)
+    assert report.counts[SKIPPED] == 5 and report.counts[COPIED] == 0, report
+
+    with HashCache(getHashCachePath(target)) as hash_cache, \
+            CopyEngine(hash_cache=hash_cache, strategies=[CompressedCopies(ZLIB)]) as engine:
+        for name in ("export.csv", "photo.jpg"):
+            engine.submit(os.path.join(source, name), os.path.join(target, name), CHECKSUM)
+    assert engine.report.counts[SKIPPED] == 2, engine.report
+
+    # The CSV now looks random, so it is copied as it is, and its compressed copy removed
+    with open(os.path.join(source, "export.csv"), "wb") as f:
+        f.write(os.urandom(MB))
+    report = backup(source, target, [], OVERWRITE, compression=ZLIB)
+    assert os.path.isfile(os.path.join(target, "export.csv"))
+    assert not os.path.exists(os.path.join(target, "export.csv.macup.gz"))
+
+print("Compression tests passed")
@@ -0,0 +1,84 @@
+"""
+Copies the same large files with each copy backend on its own, printing throughput and the CPU time the process
+spent, and checks every copy is byte-exact. Backends the filesystem doesn't support fall back to USERSPACE, which the
+backend column shows. Pass a directory as the first argument to benchmark another filesystem (e.g. a Btrfs or XFS
+loopback mount, where REFLINK works); by default /dev/shm (tmpfs) is used if it exists.
+
+First, copy_file_range is made to return 0 early, as it does on some filesystems, to check the copy still completes
+rather than leaving an empty or truncated target.
+"""
+
+import filecmp
+import os
+import sys
+import tempfile
+import time
+
+from macup.library.copybackends import BACKENDS, COPY_FILE_RANGE, availableBackends
+from macup.library.copyengine import CopyEngine
+from macup.library.constants import *
+
+FILES = 4
+FILE_SIZE = 128 * 1024 * 1024
+
+
+def checkZeroReturns(root):
+    if COPY_FILE_RANGE not in availableBackends():
+        return
+
+    original_copy_file_range = os.copy_file_range
+    with tempfile.TemporaryDirectory(dir=root) as tmp:
+        source = os.path.join(tmp, "source.bin")
+        with open(source, "wb") as f:
+            f.write(os.urandom(3 * 1024 * 1024 + 5))
+
+        for name, copy_file_range in (
+                ("returning 0 straight away", lambda *args: 0),
+                ("returning 0 after 1 MB", lambda src, dst, count, offset_src, offset_dst:
+                 0 if offset_src >= 1024 ** 2 else original_copy_file_range(src, dst, min(count, 1024 ** 2),
+                                                                             offset_src, offset_dst))):
+            target = os.path.join(tmp, name)
+            os.copy_file_range = copy_file_range
+            try:
+                with CopyEngine(workers=1, backends=[COPY_FILE_RANGE]) as engine:
+                    engine.submit(source, target, OVERWRITE)
+            finally:
+                os.copy_file_range = original_copy_file_range
+            assert engine.report.succeeded, engine.report.failures
+            assert filecmp.cmp(source, target, shallow=False), f"{os.path.getsize(target)} bytes copied"
+            print(f"copy_file_range {name}: copied in full, used {engine.report.backends}")
+
+
+def main(root):
+    with tempfile.TemporaryDirectory(dir=root) as source, tempfile.TemporaryDirectory(dir=root) as target:
+        block = os.urandom(1024 * 1024)
+        sources = []
+        for i in range(FILES):
+            path = os.path.join(source, f"file{i}.bin")
+            with open(path, "wb") as f:
+                for _ in range(FILE_SIZE // len(block)):
+                    f.write(block)
+            sources.append(path)
+
+        print(f"Available backends: {availableBackends()}")
+        for backend in BACKENDS:
+            for name in os.listdir(target):
+                os.remove(os.path.join(target, name))
+
+            start, start_cpu = time.perf_counter(), time.process_time()
+            with CopyEngine(workers=1, backends=[backend]) as engine:
+                for path in sources:
+                    engine.submit(path, os.path.join(target, os.path.basename(path)), OVERWRITE)
+            elapsed, cpu = time.perf_counter() - start, time.process_time() - start_cpu
+
+            assert engine.report.succeeded, engine.report.failures
+            assert all(filecmp.cmp(path, os.path.join(target, os.path.basename(path)), shallow=False)
+                       for path in sources)
+            megabytes = FILES * FILE_SIZE / 1024 ** 2
+            print(f"{backend:>16}: {megabytes / elapsed:7.0f} MB/s, {cpu:.2f}s CPU, used {engine.report.backends}")
+
+
+if __name__ == "__main__":
+    root = sys.argv[1] if len(sys.argv) > 1 else "/dev/shm" if os.path.isdir("/dev/shm") else None
+    checkZeroReturns(root)
+    main(root)
@@ -0,0 +1,99 @@
+"""
+Copies a synthetic tree of small files one at a time, as copyFiles used to, and with the CopyEngine at several
+numbers of copies at a time to the one device, printing the best of a few runs in files per second, then with the
+engine's defaults. Pass a target directory as the first argument to benchmark a real (e.g. external or network)
+volume instead of a temporary directory.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from macup.library.backup import buildDirectories, graftItem
+from macup.library.constants import *
+from macup.library.copyengine import CopyEngine, COPIED, DEFAULT_COPY_WORKERS, DEFAULT_DEVICE_LIMIT, FAILED, \
+    SKIPPED
+from macup.library.scanner import scanTree
+
+DIRECTORIES = 50
+FILES_PER_DIR = 200
+FILE_SIZE = 4096
+RUNS = 3
+
+
+def buildSourceTree(root):
+    data = os.urandom(FILE_SIZE)
+    for i in range(DIRECTORIES):
+        directory = os.path.join(root, f"dir{i}")
+        os.mkdir(directory)
+        for j in range(FILES_PER_DIR):
+            with open(os.path.join(directory, f"file{j}.bin"), "wb") as f:
+                f.write(data)
+
+
+def prepareTarget(source, target):
+    if os.path.exists(target):
+        shutil.rmtree(target)
+    os.mkdir(target)
+    entries = list(scanTree(source))
+    buildDirectories([graftItem(entry.path, source, target) for entry in entries if entry.is_dir()])
+    return [entry.path for entry in entries if not entry.is_dir()]
+
+
+def main(target_root):
+    with tempfile.TemporaryDirectory() as source:
+        buildSourceTree(source)
+        target = os.path.join(target_root, "copyengine_benchmark")
+
+        files = prepareTarget(source, target)
+        start = time.perf_counter()
+        for file in files:
+            new_file = graftItem(file, source, target)
+            if not os.path.isfile(new_file):
+                shutil.copy(file, new_file)
+        elapsed = time.perf_counter() - start
+        print(f"Serial shutil.copy: {len(files) / elapsed:.0f} files/s")
+
+        def engineRate(workers, device_limit):
+            best = 0
+            for _ in range(RUNS):
+                files = prepareTarget(source, target)
+                start = time.perf_counter()
+                with CopyEngine(workers, device_limit, device_limit) as engine:
+                    for file in files:
+                        engine.submit(file, graftItem(file, source, target), SKIP_EXISTING)
+                elapsed = time.perf_counter() - start
+                assert engine.report.counts[COPIED] == len(files) and engine.report.succeeded, engine.report
+                best = max(best, len(files) / elapsed)
+            return best
+
+        # The source and target are each one device, so at most the device limit are copied at once
+        for copies in (1, 2, 4, 8, 16):
+            print(f"CopyEngine, {copies} at a time: {engineRate(copies, copies):.0f} files/s")
+        print(f"CopyEngine, defaults ({DEFAULT_COPY_WORKERS} workers, {DEFAULT_DEVICE_LIMIT} per device): "
+              f"{engineRate(DEFAULT_COPY_WORKERS, DEFAULT_DEVICE_LIMIT):.0f} files/s")
+        assert DEFAULT_DEVICE_LIMIT < DEFAULT_COPY_WORKERS
+
+        # Copying again without overwrite skips everything
+        with CopyEngine() as engine:
+            for file in files:
+                engine.submit(file, graftItem(file, source, target), SKIP_EXISTING)
+        assert engine.report.counts[SKIPPED] == len(files), engine.report
+
+        # A missing source is reported rather than raised
+        with CopyEngine() as engine:
+            engine.submit(os.path.join(source, "missing"), os.path.join(target, "missing"), OVERWRITE)
+        assert engine.report.counts[FAILED] == 1, engine.report
+        print(engine.report, engine.report.failures)
+
+        shutil.rmtree(target)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        main(sys.argv[1])
+    else:
+        with tempfile.TemporaryDirectory() as temp_target:
+            main(temp_target)
@@ -0,0 +1,137 @@
+"""
+Backs up synthetic near-identical data into a deduplicating store: versions of a disk image with small edits and
+insertions, and two copies of a project tree in different sources. Prints the chunking throughput and the dedup ratio
+(the size of the files backed up over the size of the chunks stored), and checks every snapshot restores byte-exact.
+"""
+
+import filecmp
+import io
+import os
+import random
+import shutil
+import tempfile
+import time
+
+from macup.library.backup import backup
+from macup.library.constants import *
+from macup.library.copyengine import COPIED, SKIPPED
+from macup.library.dedup import SnapshotReader, SnapshotWriter, iterChunks
+
+MB = 1024 * 1024
+IMAGE_SIZE = 32 * MB
+
+rng = random.Random(18)
+
+
+def randomBytes(size):
+    return rng.getrandbits(size * 8).to_bytes(size, "little")
+
+
+def edit(data):
+    """ Overwrites a few small ranges and inserts bytes in a couple of places, shifting everything after them """
+    data = bytearray(data)
+    for _ in range(5):
+        position = rng.randrange(len(data) - 4096)
+        data[position:position + 4096] = randomBytes(4096)
+    for _ in range(2):
+        position = rng.randrange(len(data))
+        data[position:position] = randomBytes(rng.randrange(1, 1000))
+    return bytes(data)
+
+
+def compareTrees(a, b):
+    stack = [filecmp.dircmp(a, b)]
+    while stack:
+        comparison = stack.pop()
+        assert not comparison.left_only and not comparison.right_only, (comparison.left_only, comparison.right_only)
+        _, mismatch, errors = filecmp.cmpfiles(comparison.left, comparison.right, comparison.common_files,
+                                               shallow=False)
+        assert not mismatch and not errors, (mismatch, errors)
+        stack.extend(comparison.subdirs.values())
+
+
+# Chunking alone
+data = randomBytes(IMAGE_SIZE)
+start = time.perf_counter()
+chunks = list(iterChunks(io.BytesIO(data)))
+elapsed = time.perf_counter() - start
+assert b"".join(chunks) == data
+print(f"Chunking: {IMAGE_SIZE / MB / elapsed:.1f} MB/s, {len(chunks)} chunks averaging "
+      f"{IMAGE_SIZE // len(chunks) // 1024} KB")
+
+# An insertion only changes the chunks around it
+shifted = data[:1000] + b"inserted" + data[1000:]
+shifted_chunks = list(iterChunks(io.BytesIO(shifted)))
+shared = len(set(chunks) & set(shifted_chunks))
+assert shared >= len(chunks) - 2, (shared, len(chunks))
+
+with tempfile.TemporaryDirectory() as root:
+    target = os.path.join(root, "target")
+    images = os.path.join(root, "images")
+    os.makedirs(images)
+    image = os.path.join(images, "disk.img")
+    restores = []
+
+    # Versions of an image, each an edit of the one before
+    version = data
+    for run in range(4):
+        with open(image, "wb") as f:
+            f.write(version)
+        start = time.perf_counter()
+        report = backup(images, target, [], UPDATE, storage=DEDUPLICATED)
+        elapsed = time.perf_counter() - start
+        assert report.succeeded, report.failures
+        print(f"Image version {run}: {IMAGE_SIZE / MB / elapsed:.1f} MB/s, {report.bytes_copied / MB:.2f} MB stored")
+        restores.append(version)
+        version = edit(version)
+
+    # Nothing has changed, so the image isn't even read
+    report = backup(images, target, [], UPDATE, storage=DEDUPLICATED)
+    assert report.counts[SKIPPED] == 1 and report.bytes_copied == 0, report
+    restores.append(restores[-1])
+
+    # Two copies of a project in different sources share all their chunks
+    projects = []
+    for name in ("project", "project copy"):
+        project = os.path.join(root, name)
+        projects.append(project)
+        if name == "project":
+            for d in range(10):
+                os.makedirs(os.path.join(project, f"module{d}"))
+                for f in range(20):
+                    with open(os.path.join(project, f"module{d}", f"file{f}.py"), "wb") as file:
+                        file.write(randomBytes(rng.randrange(100, 200000)))
+            os.makedirs(os.path.join(project, "empty"))
+        else:
+            shutil.copytree(projects[0], project)
+        report = backup(project, target, [], UPDATE, storage=DEDUPLICATED)
+        assert report.succeeded and report.counts[COPIED] == 200, report
+        print(f"{name}: {report.bytes_copied / MB:.2f} MB stored")
+
+    logical = stored = 0
+    with SnapshotReader(target) as reader:
+        image_snapshots = reader.snapshots(images)
+        assert len(image_snapshots) == len(restores)
+        for (snapshot, _, _), expected in zip(image_snapshots, restores):
+            assert reader.read(snapshot, "disk.img") == expected
+            logical += len(expected)
+
+        for project in projects:
+            destination = os.path.join(root, "restored", os.path.basename(project))
+            assert reader.restore(reader.latest(project), destination) == 200
+            compareTrees(project, destination)
+            logical += sum(os.path.getsize(os.path.join(d, f)) for d, _, files in os.walk(project) for f in files)
+
+        stored = sum(row[0] for row in reader.connection.execute("SELECT sum(size) FROM chunks"))
+    print(f"Dedup ratio: {logical / MB:.1f} MB backed up in {stored / MB:.1f} MB, {logical / stored:.1f}x")
+
+    # A failed backup isn't used as the base of the next one
+    try:
+        with SnapshotWriter(target, images) as writer:
+            raise RuntimeError()
+    except RuntimeError:
+        pass
+    with SnapshotReader(target) as reader:
+        assert len(reader.snapshots(images)) == len(restores)
+
+print("Dedup tests passed")
@@ -0,0 +1,127 @@
+"""
+Delta updates a target after random edits to its source (pages overwritten, bytes inserted and deleted, the file cut
+short and extended), checking each time that the target comes out byte-exact, and that when only pages were
+overwritten, only the blocks holding them were written. Then backs up a large file twice with a page changed in
+between, checking the second backup writes one block, and that a hard-linked target is copied in full instead.
+"""
+
+import os
+import random
+import tempfile
+import time
+
+from macup.library.backup import backup
+from macup.library.constants import *
+from macup.library.delta import DELTA, SignatureCache, deltaUpdate, getSignatureCachePath
+
+MB = 1024 * 1024
+BLOCK_SIZE = 4096
+
+rng = random.Random(21)
+
+
+def randomBytes(size):
+    return rng.getrandbits(size * 8).to_bytes(size, "little") if size else b""
+
+
+def edit(data):
+    """ :return: The edited data, and the blocks the edits touched if they only overwrote, otherwise None """
+    data = bytearray(data)
+    kind = rng.choice(("overwrite", "overwrite", "insert", "delete", "truncate", "extend", "none"))
+    if kind == "overwrite":
+        touched = set()
+        for _ in range(rng.randrange(1, 6)):
+            start = rng.randrange(len(data))
+            length = min(rng.randrange(1, 3 * BLOCK_SIZE), len(data) - start)
+            data[start:start + length] = randomBytes(length)
+            touched.update(range(start // BLOCK_SIZE, (start + length - 1) // BLOCK_SIZE + 1))
+        return bytes(data), touched
+    if kind == "insert":
+        start = rng.randrange(len(data))
+        data[start:start] = randomBytes(rng.randrange(1, 10000))
+    elif kind == "delete":
+        start = rng.randrange(len(data))
+        del data[start:start + rng.randrange(1, 10000)]
+    elif kind == "truncate":
+        del data[rng.randrange(len(data)):]
+    elif kind == "extend":
+        data += randomBytes(rng.randrange(1, 50000))
+    else:
+        return bytes(data), set()
+    return bytes(data), None
+
+
+def patch(source, target, signature_cache=None):
+    source_fd = os.open(source, os.O_RDONLY)
+    try:
+        return deltaUpdate(source_fd, os.fstat(source_fd), target, signature_cache, BLOCK_SIZE)
+    finally:
+        os.close(source_fd)
+
+
+with tempfile.TemporaryDirectory() as root:
+    source = os.path.join(root, "source.bin")
+    target = os.path.join(root, "target.bin")
+
+    with SignatureCache(os.path.join(root, "signatures.sqlite")) as signature_cache:
+        for trial in range(200):
+            # Half the trials compare against cached signatures, rather than reading the target
+            cache = signature_cache if trial % 2 else None
+            if trial % 20 == 0:
+                data = randomBytes(rng.randrange(1, 2 * MB))
+                with open(target, "wb") as f:
+                    f.write(data)
+                if cache is not None:
+                    patch(target, target, cache)
+
+            data, touched = edit(data)
+            with open(source, "wb") as f:
+                f.write(data)
+            os.chmod(source, rng.choice((0o600, 0o644, 0o755)))
+            written = patch(source, target, cache)
+
+            with open(target, "rb") as f:
+                assert f.read() == data, f"trial {trial} isn't byte-exact"
+            assert os.stat(target).st_mode == os.stat(source).st_mode
+            if touched is not None:
+                assert written <= len(touched) * BLOCK_SIZE, (trial, written, len(touched))
+            if cache is not None:
+                assert cache.lookup(target, os.stat(target), BLOCK_SIZE) is not None
+
+    # A whole backup, with a 4 KB page of a 64 MB file changed between runs
+    source_dir = os.path.join(root, "source")
+    target_dir = os.path.join(root, "target")
+    os.makedirs(source_dir)
+    os.makedirs(target_dir)
+    database = os.path.join(source_dir, "database.db")
+    with open(database, "wb") as f:
+        for _ in range(64):
+            f.write(os.urandom(MB))
+
+    report = backup(source_dir, target_dir, [], UPDATE, delta_threshold=MB)
+    assert report.succeeded and report.bytes_copied == 64 * MB, report
+    assert DELTA not in report.backends, report
+    assert os.path.isfile(getSignatureCachePath(target_dir))
+
+    for run in range(2):
+        with open(database, "r+b") as f:
+            f.seek(rng.randrange(64 * MB // 4096) * 4096)
+            f.write(os.urandom(4096))
+        start = time.perf_counter()
+        report = backup(source_dir, target_dir, [], UPDATE, delta_threshold=MB)
+        elapsed = time.perf_counter() - start
+        print(f"Run {run + 2}: {report.bytes_copied} bytes written in {elapsed:.2f} s")
+        assert report.succeeded and report.backends == {DELTA: 1}, report
+        # The changed page is within one 64 KB block
+        assert report.bytes_copied == 64 * 1024, report
+        with open(database, "rb") as a, open(os.path.join(target_dir, "database.db"), "rb") as b:
+            assert a.read() == b.read()
+
+    # A target with other hard links isn't patched, as they would see the patch too
+    os.link(os.path.join(target_dir, "database.db"), os.path.join(root, "other link"))
+    with open(database, "r+b") as f:
+        f.write(os.urandom(4096))
+    report = backup(source_dir, target_dir, [], OVERWRITE, delta_threshold=MB)
+    assert report.succeeded and DELTA not in report.backends, report
+
+print("Delta tests passed")
@@ -0,0 +1,85 @@
+"""
+Times making a synthetic tree of 200k directories with os.makedirs(exist_ok=True) for each, as buildDirectories used
+to, against a DirectoryMaker: into an empty target, into a target where they all exist, and with the existing ones
+given as known. Checks the trees come out the same, that a file in the way is still reported, and that a known
+directory that has gone missing is made again when something is made in it.
+"""
+
+import os
+import shutil
+import tempfile
+import time
+
+from macup.library.directories import DirectoryMaker, topologicalOrder
+
+
+def syntheticTree(root):
+    directories = []
+    for a in range(20):
+        for b in range(10):
+            for c in range(10):
+                parent = os.path.join(root, f"a{a}", f"b{b}", f"c{c}")
+                directories.append(parent)
+                directories.extend(os.path.join(parent, f"d{d}") for d in range(100))
+    return directories
+
+
+def timed(label, function):
+    start = time.perf_counter()
+    function()
+    print(f"{label}: {time.perf_counter() - start:.2f} s")
+
+
+def listTree(root):
+    return sorted(os.path.relpath(directory, root) for directory, _, _ in os.walk(root))
+
+
+with tempfile.TemporaryDirectory() as root:
+    makedirs_root = os.path.join(root, "makedirs")
+    maker_root = os.path.join(root, "maker")
+    makedirs_tree = syntheticTree(makedirs_root)
+    maker_tree = syntheticTree(maker_root)
+    print(f"{len(maker_tree)} directories")
+    assert topologicalOrder(reversed(maker_tree))[:2] == [os.path.join(maker_root, "a0", "b0", "c0"),
+                                                          os.path.join(maker_root, "a0", "b0", "c0", "d0")]
+
+    def makedirs():
+        for directory in makedirs_tree:
+            os.makedirs(directory, exist_ok=True)
+
+    timed("makedirs, new", makedirs)
+    maker = DirectoryMaker()
+    timed("DirectoryMaker, new", lambda: maker.makeAll(maker_tree))
+    # Every directory, including the parents that weren't listed, was made once
+    assert maker.made == len(maker_tree) + 20 + 200 + 1, maker.made
+    assert listTree(makedirs_root) == listTree(maker_root)
+
+    timed("makedirs, existing", makedirs)
+    maker = DirectoryMaker()
+    timed("DirectoryMaker, existing", lambda: maker.makeAll(maker_tree))
+    assert maker.made == 0
+    known = set(maker_tree)
+    maker = DirectoryMaker(known)
+    timed("DirectoryMaker, existing and known", lambda: maker.makeAll(maker_tree))
+
+    # Made again after being removed, and a file in the way is an error
+    shutil.rmtree(os.path.join(maker_root, "a3"))
+    shutil.rmtree(os.path.join(maker_root, "a4"))
+    open(os.path.join(maker_root, "a4"), "w").close()
+    maker = DirectoryMaker()
+    maker.make(os.path.join(maker_root, "a3", "b0", "c0", "d0"))
+    assert os.path.isdir(os.path.join(maker_root, "a3", "b0", "c0", "d0")) and maker.made == 4
+    try:
+        maker.make(os.path.join(maker_root, "a4", "b0"))
+    except (FileExistsError, NotADirectoryError):
+        pass
+    else:
+        raise AssertionError("a file in the way wasn't reported")
+
+    # Known, but deleted since
+    shutil.rmtree(os.path.join(maker_root, "a5"))
+    maker = DirectoryMaker(known)
+    maker.make(os.path.join(maker_root, "a5", "b0", "c0", "new"))
+    assert os.path.isdir(os.path.join(maker_root, "a5", "b0", "c0", "new")) and maker.missing_known == 1
+
+print("DirectoryMaker tests passed")
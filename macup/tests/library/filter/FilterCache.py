@@ -0,0 +1,23 @@
+"""
+Checks FilterCache gives the same results as applyFilters, notices changed filters, and evicts the least recently
+used results.
+"""
+
+from macup.library.classes import Filter
+from macup.library.constants import *
+from macup.library.filter import FilterCache, applyFilters
+
+filters = [Filter("no git", KEYWORD, ".git", PATHS, BOTH, False)]
+paths = ["macup/library/filter.py", "macup/library", ".git/config", "missing/.git/file"]
+
+cache = FilterCache(max_size=3)
+for path in paths:
+    print(path, cache.apply(filters, path), applyFilters(filters, path))
+
+# Changing the filter in place gives a new fingerprint, so the old result isn't reused
+filters[0].data = "filter"
+print("after change:", cache.apply(filters, paths[0]), applyFilters(filters, paths[0]))
+
+print("results remembered:", len(cache._results))
+cache.invalidate()
+print("after invalidate:", len(cache._results))
@@ -0,0 +1,107 @@
+"""
+Scans a synthetic home directory with a config that only backs up Documents/Projects/**/src, counting directory
+listings with and without subtree pruning, and checks both scans accept the same items. A whitelist of files and
+folders only lets through the folders leading to what it matches, so only a small part of the tree is listed, and
+every file it matches is still found. A whitelist of files alone accepts every directory, so it must not prune; a
+filter that rejects everything under a folder that itself passes does, which saves listing that folder.
+"""
+
+import os
+import re
+import tempfile
+
+import macup.library.scanner as scanner
+from macup.library.classes import Filter
+from macup.library.constants import *
+from macup.library.filter import buildFilter, _splitLiteralPrefix
+
+print(_splitLiteralPrefix(r"/Users/me/Documents/Projects/.*/src/"))
+print(_splitLiteralPrefix(r"^/Users/me\.old/a+b"))
+print(_splitLiteralPrefix(r"/Users/(me|you)/x"))
+print(_splitLiteralPrefix(r"/Users/me|/Users/you"))
+
+
+def makeTree(root, width, depth):
+    for i in range(3):
+        open(os.path.join(root, f"file{i}"), "w").close()
+    if depth:
+        for i in range(width):
+            child = os.path.join(root, "src" if i == 0 else f"dir{i}")
+            os.mkdir(child)
+            makeTree(child, width, depth - 1)
+
+
+def scanItems(root, filter_):
+    listings = 0
+    original_scandir = scanner.os.scandir
+
+    def countingScandir(path):
+        nonlocal listings
+        listings += 1
+        return original_scandir(path)
+
+    scanner.os.scandir = countingScandir
+    try:
+        items = {entry.path for entry in scanner.scanTree(root, filter_)}
+    finally:
+        scanner.os.scandir = original_scandir
+    return items, listings
+
+
+class UnprunedFilter:
+    """ The same filter, but not a CompiledFilter, so the scanner can't prune with it """
+
+    def __init__(self, filter_):
+        self.filter_ = filter_
+
+    def __call__(self, path):
+        return self.filter_(path)
+
+
+with tempfile.TemporaryDirectory() as home:
+    for top in ("Music", "Pictures", "Library", "Downloads"):
+        os.mkdir(os.path.join(home, top))
+        makeTree(os.path.join(home, top), 4, 4)
+    os.makedirs(os.path.join(home, "Documents", "Projects"))
+    makeTree(os.path.join(home, "Documents", "Projects"), 4, 3)
+
+    sources_pattern = re.escape(home) + r"/Documents/Projects/.*/src/"
+    sources = Filter("only project sources", REGEX, sources_pattern, PATHS, BOTH, True)
+    source_files = Filter("only project source files", REGEX, sources_pattern, PATHS, FILES, True)
+    folders = Filter("only project folders", REGEX, re.escape(home) + r"/Documents(/Projects(/.*)?)?$", PATHS,
+                     DIRECTORY, True)
+
+    # The Library folder itself passes, but nothing in it does
+    library = Filter("no Library contents", REGEX, re.escape(os.path.join(home, "Library", "")), PATHS, BOTH, False)
+
+    _, tree_listings = scanItems(home, None)
+    print(f"Without filters: {tree_listings} directories listed")
+    listings = []
+    for filters in ([sources], [source_files, folders], [source_files, library]):
+        compiled = buildFilter(filters)
+        pruned_items, pruned_listings = scanItems(home, compiled)
+        full_items, full_listings = scanItems(home, UnprunedFilter(compiled))
+        assert pruned_items == full_items, sorted(full_items - pruned_items)[:5]
+        listings.append((pruned_items, pruned_listings, full_listings))
+
+        print(" and ".join(filter_.name for filter_ in filters) + ":")
+        print(f"{len(full_items)} items accepted, {sum(map(os.path.isfile, full_items))} of them files")
+        print(f"Without pruning: {full_listings} directories listed")
+        print(f"With pruning: {pruned_listings} directories listed ({pruned_listings / full_listings:.1%} of those, "
+              f"{pruned_listings / tree_listings:.1%} of the tree)")
+
+    # Only Documents, Projects and the project folders are listed, and every source file is found
+    pruned_items, pruned_listings, _ = listings[0]
+    expected_files = {os.path.join(directory, name) for directory, _, files in os.walk(home) for name in files
+                      if re.match(sources_pattern, os.path.join(directory, name))}
+    assert expected_files and {item for item in pruned_items if os.path.isfile(item)} == expected_files
+    assert pruned_listings / tree_listings < 0.1, (pruned_listings, tree_listings)
+    # The Library folder passes, but isn't listed
+    _, pruned_listings, full_listings = listings[2]
+    assert pruned_listings == full_listings - 1, (pruned_listings, full_listings)
+
+    # A whitelist of files alone accepts every directory, however deep
+    filter_ = buildFilter([Filter("only b's file", REGEX, re.escape(home) + r"/b/file$", PATHS, FILES, True)])
+    os.makedirs(os.path.join(home, "b", "c", "d"))
+    accepted = {os.path.relpath(entry.path, home) for entry in scanner.scanTree(home, filter_)}
+    assert {"b", os.path.join("b", "c"), os.path.join("b", "c", "d")} <= accepted, accepted
@@ -0,0 +1,76 @@
+"""
+Checks applyFiltersBatch gives exactly the same results as applyFilters over random rules and real paths, then
+measures how the cost per path grows with the number of keyword blacklist rules, against the one-rule-at-a-time
+CompiledFilter.
+"""
+
+import os
+import random
+import tempfile
+import time
+
+from macup.library.batchfilter import applyFiltersBatch, BatchFilter
+from macup.library.classes import Filter
+from macup.library.constants import *
+from macup.library.filter import applyFilters, buildFilter
+
+rng = random.Random(0)
+ALPHABET = "abcde/._"
+
+
+def randomWord(max_length=4):
+    return "".join(rng.choice(ALPHABET) for _ in range(rng.randint(0, max_length)))
+
+
+def randomFilter(i):
+    filter_type = rng.choice((KEYWORD, REGEX))
+    data = randomWord() if filter_type == KEYWORD else rng.choice(
+        [".*" + randomWord(2).replace(".", r"\."), randomWord(2).replace(".", r"\.") + ".*", "(a|b).*", r".*\.e$",
+         r"(?P<x>a).*", r"(a)\1.*", "(?i).*A"])
+    return Filter(f"rule {i}", filter_type, data, rng.choice((FILENAMES, PATHS)),
+                  rng.choice((FILES, DIRECTORY, BOTH)), rng.random() < 0.3)
+
+
+# Exactness
+with tempfile.TemporaryDirectory() as root:
+    paths = []
+    for _ in range(300):
+        path = os.path.join(root, *(randomWord() or "x" for _ in range(rng.randint(1, 3))))
+        try:
+            if rng.random() < 0.5:
+                os.makedirs(path, exist_ok=True)
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                open(path, "a").close()
+        except OSError:
+            pass
+        paths.append(path)
+
+    for trial in range(200):
+        filters = [randomFilter(i) for i in range(rng.randint(1, 12))]
+        expected = [applyFilters(filters, path) for path in paths]
+        assert applyFiltersBatch(filters, paths) == expected, filters
+print("applyFiltersBatch matches applyFilters")
+
+# Scaling with the number of keyword rules
+WORDS = ["src", "Documents", "Photos", "project", "notes", "lib", "assets", "2023", "report"]
+test_paths = ["/home/user/" + "/".join(rng.choice(WORDS) for _ in range(rng.randint(2, 6))) + f"/f{i}.txt"
+              for i in range(100_000)]
+types = [(False, True)] * len(test_paths)
+
+for rule_count in (5, 20, 50, 100, 200):
+    filters = [Filter(f"kw {i}", KEYWORD, f"cache{i}", PATHS, BOTH, False) for i in range(rule_count)]
+
+    compiled = buildFilter(filters)
+    start = time.perf_counter()
+    one_by_one = [compiled.matches(path, False, True) for path in test_paths]
+    one_by_one_time = time.perf_counter() - start
+
+    batch = BatchFilter(filters)
+    start = time.perf_counter()
+    batched = batch.evaluate(test_paths, types)
+    batch_time = time.perf_counter() - start
+    assert batched == one_by_one
+
+    print(f"{rule_count:3} keyword rules: one by one {one_by_one_time / len(test_paths) * 1e6:6.2f} us/path, "
+          f"batched {batch_time / len(test_paths) * 1e6:6.2f} us/path")
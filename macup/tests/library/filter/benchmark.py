@@ -0,0 +1,118 @@
+"""
+Micro-benchmark of filter evaluation over a million synthetic paths, with configs of 5, 10 and 20 rules. The original
+per-path applyFilters (copied below) stats every path once per rule, so it is timed on a smaller sample of real files;
+the compiled filter is timed both on paths (one stat each) and with the item type given, as the scanner does.
+"""
+
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+
+from macup.library.classes import Filter
+from macup.library.constants import *
+from macup.library.filter import buildFilter
+
+PATH_COUNT = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+LEGACY_SAMPLE = PATH_COUNT // 20
+
+WORDS = ["src", "build", "node_modules", "Documents", "Photos", "cache", "project", "notes", "lib", "tmp", ".git"]
+EXTENSIONS = [".py", ".txt", ".jpg", ".o", ".log", ".md"]
+
+RULES = [
+    Filter("no build", KEYWORD, "/build/", PATHS, BOTH, False),
+    Filter("no objects", REGEX, r".*\.o$", FILENAMES, FILES, False),
+    Filter("no node_modules", KEYWORD, "node_modules", PATHS, BOTH, False),
+    Filter("no logs", REGEX, r".*\.log$", FILENAMES, FILES, False),
+    Filter("no git", KEYWORD, ".git", FILENAMES, DIRECTORY, False),
+    Filter("no caches", REGEX, r".*/cache/", PATHS, BOTH, False),
+    Filter("no tmp", KEYWORD, "tmp", FILENAMES, BOTH, False),
+    Filter("no pyc", KEYWORD, ".pyc", FILENAMES, FILES, False),
+    Filter("no DS_Store", KEYWORD, ".DS_Store", FILENAMES, FILES, False),
+    Filter("no backups", REGEX, r".*~$", FILENAMES, FILES, False),
+    Filter("no swap", REGEX, r"\..*\.swp$", FILENAMES, FILES, False),
+    Filter("no venv", KEYWORD, "/venv/", PATHS, BOTH, False),
+    Filter("no dist", KEYWORD, "/dist/", PATHS, BOTH, False),
+    Filter("no trash", KEYWORD, ".Trash", PATHS, BOTH, False),
+    Filter("no iso", REGEX, r".*\.iso$", FILENAMES, FILES, False),
+    Filter("no vm", REGEX, r".*\.(vmdk|vdi|qcow2)$", FILENAMES, FILES, False),
+    Filter("no thumbs", KEYWORD, "Thumbs.db", FILENAMES, FILES, False),
+    Filter("no coverage", KEYWORD, ".coverage", FILENAMES, FILES, False),
+    Filter("no idea", KEYWORD, ".idea", FILENAMES, DIRECTORY, False),
+    Filter("no target", REGEX, r".*/target/.*", PATHS, FILES, False),
+]
+
+
+def legacyApplyFilters(filters, path):
+    """ applyFilters as it was before filters were compiled """
+
+    def handleFilter(filter_, path_):
+        if filter_.application == FILENAMES:
+            str_to_use = os.path.basename(path_)
+        else:
+            str_to_use = path_
+
+        if (filter_.item_type != FILES and os.path.isdir(path_)) \
+                or (filter_.item_type != DIRECTORY and os.path.isfile(path_)):
+            if filter_.filter_type == REGEX:
+                match = bool(re.match(filter_.data, str_to_use))
+                result = match is filter_.whitelist
+            else:
+                kw_in_str = filter_.data in str_to_use
+                result = kw_in_str is filter_.whitelist
+        else:
+            result = True
+
+        return result
+
+    results = []
+    for f in filters:
+        results.append(handleFilter(f, path))
+
+    return all(results)
+
+
+def syntheticPath(rng):
+    parts = [rng.choice(WORDS) for _ in range(rng.randint(2, 6))]
+    return "/" + "/".join(parts) + f"/file{rng.randint(0, 999)}" + rng.choice(EXTENSIONS)
+
+
+def timeIt(func, paths):
+    start = time.perf_counter()
+    accepted = sum(1 for path in paths if func(path))
+    return accepted, time.perf_counter() - start
+
+
+def main(real_root):
+    rng = random.Random(0)
+    paths = [syntheticPath(rng) for _ in range(PATH_COUNT)]
+
+    # Real files for the benchmarks that stat, reusing a small set of names so the sample stays cheap to create
+    real_paths = []
+    for path in paths[:2000]:
+        real_path = real_root + path
+        os.makedirs(os.path.dirname(real_path), exist_ok=True)
+        open(real_path, "w").close()
+        real_paths.append(real_path)
+    sample = [real_paths[i % len(real_paths)] for i in range(LEGACY_SAMPLE)]
+
+    for rule_count in (5, 10, 20):
+        rules = RULES[:rule_count]
+        compiled = buildFilter(rules)
+
+        legacy_accepted, legacy_time = timeIt(lambda path: legacyApplyFilters(rules, path), sample)
+        path_accepted, path_time = timeIt(compiled, sample)
+        assert legacy_accepted == path_accepted
+        _, typed_time = timeIt(lambda path: compiled.matches(path, False, True), paths)
+
+        print(f"{rule_count} rules:")
+        print(f"  original applyFilters: {legacy_time / len(sample) * 1e6:6.2f} us/path ({len(sample)} real paths)")
+        print(f"  compiled, from path:   {path_time / len(sample) * 1e6:6.2f} us/path ({len(sample)} real paths)")
+        print(f"  compiled, typed:       {typed_time / len(paths) * 1e6:6.2f} us/path ({len(paths)} paths)")
+
+
+if __name__ == "__main__":
+    with tempfile.TemporaryDirectory() as tmp:
+        main(tmp)
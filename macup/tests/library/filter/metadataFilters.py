@@ -0,0 +1,73 @@
+"""
+Checks the metadata filter types against files with known sizes and modification times, scanned and checked by
+path, and that invalid data is rejected. Directories are never filtered by their own size or age, so a metadata
+filter for directories alone is rejected too.
+"""
+
+import os
+import tempfile
+import time
+
+from macup.library.batchfilter import applyFiltersBatch
+from macup.library.classes import Filter
+from macup.library.constants import *
+from macup.library.filter import applyFilters, buildFilter, parseDictToFilter, parseFilterToDict, parseSize
+from macup.library.scanner import scanTree
+
+print(parseSize("500"), parseSize("500MB"), parseSize("1.5G"), parseSize("2 GiB"))
+
+with tempfile.TemporaryDirectory() as root:
+    now = time.time()
+    for name, size, age_days in (("small_new", 10, 1), ("small_old", 10, 60), ("big_new", 2 * 1024 ** 2, 1),
+                                 ("big_old", 2 * 1024 ** 2, 60)):
+        path = os.path.join(root, name)
+        with open(path, "wb") as f:
+            f.truncate(size)
+        os.utime(path, (now - age_days * 86400,) * 2)
+    # An old folder, with a new file in it
+    os.mkdir(os.path.join(root, "old_folder"))
+    with open(os.path.join(root, "old_folder", "new_file"), "w") as f:
+        f.write("new")
+    os.utime(os.path.join(root, "old_folder"), (now - 2000 * 86400,) * 2)
+
+    for filters in ([Filter("no big", SIZE_GREATER, "1MB", PATHS, FILES, False)],
+                    [Filter("only small", SIZE_LESS, "1MB", PATHS, BOTH, True)],
+                    [Filter("no stale", OLDER_THAN, "30d", PATHS, BOTH, False)],
+                    [Filter("recent", MODIFIED_AFTER, time.strftime("%Y-%m-%d", time.localtime(now - 7 * 86400)),
+                            PATHS, BOTH, True),
+                     Filter("no big", SIZE_GREATER, "1M", PATHS, FILES, False)]):
+        scanned = sorted(os.path.relpath(entry.path, root) for entry in scanTree(root, buildFilter(filters))
+                         if entry.name != "old_folder")
+        paths = [os.path.join(root, name) for name in sorted(os.listdir(root))]
+        paths.append(os.path.join(root, "old_folder", "new_file"))
+        by_path = sorted(os.path.relpath(path, root) for path in paths
+                         if applyFilters(filters, path) and not path.endswith("old_folder"))
+        batched = sorted(os.path.relpath(path, root) for path, result in zip(paths, applyFiltersBatch(filters, paths))
+                         if result and not path.endswith("old_folder"))
+        print([filter_.name for filter_ in filters], scanned, scanned == by_path == batched)
+        assert scanned == by_path == batched
+        if filters[0].name == "no stale":
+            assert os.path.join("old_folder", "new_file") in scanned, scanned
+
+filter_ = Filter("no big", SIZE_GREATER, "4GB", PATHS, FILES, False)
+print(parseDictToFilter(parseFilterToDict(filter_)))
+
+for filter_type, data in ((SIZE_GREATER, "big"), (MODIFIED_BEFORE, "yesterday"), (OLDER_THAN, "30")):
+    try:
+        Filter("invalid", filter_type, data, PATHS, BOTH, False)
+    except ValueError as error:
+        print(error)
+    else:
+        raise AssertionError(f"'{data}' was accepted as {filter_type} data")
+
+# Whether created in the filter dialog or loaded from a configuration
+old_folders = parseFilterToDict(Filter("old folders", OLDER_THAN, "30d", PATHS, BOTH, False))
+old_folders["item_type"] = DIRECTORY
+for create in (lambda: Filter("old folders", OLDER_THAN, "30d", PATHS, DIRECTORY, False),
+               lambda: parseDictToFilter(old_folders)):
+    try:
+        create()
+    except ValueError as error:
+        print(error)
+    else:
+        raise AssertionError("a metadata filter for directories alone was accepted")
@@ -0,0 +1,70 @@
+"""
+Backs up a small tree in CHECKSUM mode several times, checking which files are hashed each time: unchanged files
+should never be hashed again, and files whose contents changed without their size or mtime changing are still
+copied once their metadata changes in any other way.
+"""
+
+import os
+import tempfile
+import time
+
+import macup.library.copyengine as copyengine
+import macup.library.hashcache as hashcache
+from macup.library.backup import backup
+from macup.library.constants import *
+from macup.library.copyengine import COPIED, SKIPPED
+
+hashed = []
+original_hashFile = copyengine.hashFile
+
+
+def countingHashFile(path):
+    hashed.append(os.path.relpath(path, os.path.dirname(os.path.dirname(path))))
+    return original_hashFile(path)
+
+
+# The engine looks hashFile up each time it hashes, so every hash goes through the counter
+copyengine.hashFile = countingHashFile
+
+
+def run(source, target, label, expected_hashed, copied):
+    hashed.clear()
+    report = backup(source, target, [], CHECKSUM)
+    print(f"{label}: {report}, hashed {sorted(hashed)}")
+    assert report.succeeded and report.counts[COPIED] == copied and report.counts[SKIPPED] == 3 - copied, report
+    assert sorted(hashed) == expected_hashed, hashed
+
+
+with tempfile.TemporaryDirectory() as root:
+    source = os.path.join(root, "source")
+    target = os.path.join(root, "target")
+    os.makedirs(source)
+    os.makedirs(target)
+    for name in ("a.txt", "b.txt", "c.txt"):
+        with open(os.path.join(source, name), "w") as f:
+            f.write(name * 1000)
+
+    # Only the sources are hashed; the copies' hashes are taken from them
+    run(source, target, "First backup", ["source/a.txt", "source/b.txt", "source/c.txt"], 3)
+    run(source, target, "Nothing changed", [], 0)
+
+    # Touched, e.g. by a sync tool, but the same contents: hashed again, found the same, and not copied
+    future = time.time() + 60
+    os.utime(os.path.join(source, "a.txt"), (future, future))
+    run(source, target, "a.txt touched", ["source/a.txt"], 0)
+
+    # Same size, different contents, mtime put back as an archive restore would; it is a new file, with a new inode
+    path = os.path.join(source, "b.txt")
+    mtime = os.stat(path).st_mtime
+    os.rename(path, path + ".old")
+    with open(path, "w") as f:
+        f.write("B" * 5000)
+    os.remove(path + ".old")
+    os.utime(path, (mtime, mtime))
+    run(source, target, "b.txt restored with new contents", ["source/b.txt"], 1)
+    with open(os.path.join(target, "b.txt")) as f:
+        assert f.read() == "B" * 5000
+
+    assert os.path.relpath(hashcache.getHashCachePath(target), target) == os.path.join(METADATA_DIR, "hashes.sqlite")
+
+print("Checksum mode tests passed")
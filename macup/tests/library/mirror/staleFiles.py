@@ -0,0 +1,129 @@
+"""
+Backs up a source, then changes it in every way that leaves stale items in the target (deleted files and folders,
+renames, a file that became a folder and the other way round, a newly filtered out file), and checks a dry run prints
+the plan without changing anything, and a backup deleting stale items leaves the target an exact mirror. Also checks
+MacUp's metadata folder, compressed copies and symlinks in the target are handled, and times planning a large tree.
+"""
+
+import contextlib
+import io
+import os
+import shutil
+import tempfile
+import time
+
+from macup.library.backup import backup
+from macup.library.classes import Filter
+from macup.library.constants import *
+from macup.library.copyengine import COPIED, DELETED
+from macup.library.mirror import ADD, CHANGE, DELETE, planMirror
+
+
+def write(path, data=b"data"):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def listTree(root):
+    items = set()
+    for directory, directories, files in os.walk(root):
+        if directory == root and METADATA_DIR in directories:
+            directories.remove(METADATA_DIR)
+        relative = os.path.relpath(directory, root)
+        items.update(os.path.normpath(os.path.join(relative, name)) + os.sep for name in directories)
+        items.update(os.path.normpath(os.path.join(relative, name)) for name in files)
+    return items
+
+
+with tempfile.TemporaryDirectory() as root:
+    source = os.path.join(root, "source")
+    target = os.path.join(root, "target")
+    outside = os.path.join(root, "outside")
+    for path in ("a.txt", "b.txt", "docs/report.txt", "docs/old/notes.txt", "became dir", "became file/x.txt",
+                 "logs/app.log", "a-b/c.txt", "a/b.txt"):
+        write(os.path.join(source, path))
+    write(os.path.join(outside, "keep.txt"))
+    os.makedirs(target)
+    report = backup(source, target, [], UPDATE)
+    assert report.succeeded and listTree(source) == listTree(target)
+    metadata = os.path.join(target, METADATA_DIR, "something")
+    write(metadata)
+    # A symlink in the target to a folder elsewhere is removed, not followed
+    os.symlink(outside, os.path.join(target, "link"))
+
+    os.remove(os.path.join(source, "b.txt"))
+    shutil.rmtree(os.path.join(source, "docs", "old"))
+    os.rename(os.path.join(source, "a.txt"), os.path.join(source, "renamed.txt"))
+    os.remove(os.path.join(source, "became dir"))
+    write(os.path.join(source, "became dir", "inside.txt"))
+    shutil.rmtree(os.path.join(source, "became file"))
+    write(os.path.join(source, "became file"))
+    write(os.path.join(source, "docs", "report.txt"), b"changed contents")
+    filters = [Filter("no logs", KEYWORD, ".log", FILENAMES, FILES, False)]
+
+    expected = {
+        ("became dir", DELETE), ("became dir", ADD), ("became dir/inside.txt", ADD),
+        ("became file", DELETE), ("became file", ADD), ("b.txt", DELETE), ("a.txt", DELETE), ("link", DELETE),
+        ("docs/old", DELETE), ("docs/report.txt", CHANGE), ("logs/app.log", DELETE), ("renamed.txt", ADD),
+    }
+    plan = list(planMirror(source, target, filters))
+    assert {(item.path, item.action) for item in plan} == expected, plan
+    # In sorted order, each directory before its contents
+    assert [item.path for item in plan].index("became dir") < [item.path for item in plan].index(
+        "became dir/inside.txt")
+
+    before = listTree(target)
+    printed = io.StringIO()
+    with contextlib.redirect_stdout(printed):
+        report = backup(source, target, filters, UPDATE, delete_stale=True, dry_run=True)
+    assert listTree(target) == before and report.counts[DELETED] == 0
+    assert "delete docs/old/" in printed.getvalue() and "update docs/report.txt" in printed.getvalue()
+    print(printed.getvalue().splitlines()[-1])
+
+    report = backup(source, target, filters, UPDATE, delete_stale=True)
+    assert report.succeeded, report.failures
+    assert report.counts[DELETED] == 7, report
+    expected_items = listTree(source) - {"logs/app.log"}
+    assert listTree(target) == expected_items, listTree(target) ^ expected_items
+    assert os.path.isfile(metadata) and os.path.isfile(os.path.join(outside, "keep.txt"))
+    assert list(planMirror(source, target, filters)) == []
+
+    # A compressed copy belongs to its source file, so only the copies of deleted files are deleted
+    compressed_target = os.path.join(root, "compressed")
+    os.makedirs(compressed_target)
+    write(os.path.join(source, "text.txt"), b"compress me " * 1000)
+    write(os.path.join(source, "gone.txt"), b"compress me too " * 1000)
+    backup(source, compressed_target, filters, UPDATE, compression=ZLIB)
+    assert os.path.isfile(os.path.join(compressed_target, "gone.txt.macup.gz"))
+    os.remove(os.path.join(source, "gone.txt"))
+    report = backup(source, compressed_target, filters, UPDATE, compression=ZLIB, delete_stale=True)
+    assert report.counts[DELETED] == 1 and report.counts[COPIED] == 0, report
+    assert not os.path.exists(os.path.join(compressed_target, "gone.txt.macup.gz"))
+    assert os.path.isfile(os.path.join(compressed_target, "text.txt.macup.gz"))
+
+    try:
+        backup(source, target, filters, UPDATE, storage=SNAPSHOTS, delete_stale=True)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("mirroring a snapshot target wasn't refused")
+
+    # Planning a larger tree: 100 folders of 500 files, with half the folders gone from the source
+    large_source = os.path.join(root, "large source")
+    large_target = os.path.join(root, "large target")
+    for d in range(100):
+        for f in range(500):
+            write(os.path.join(large_target, f"dir{d}", f"file{f}"), b"")
+            if d % 2 == 0:
+                write(os.path.join(large_source, f"dir{d}", f"file{f}"), b"")
+    start = time.perf_counter()
+    plan = list(planMirror(large_source, large_target))
+    elapsed = time.perf_counter() - start
+    # Each folder only in the target is deleted whole, without its files being listed
+    deletions = [item.path for item in plan if item.action == DELETE]
+    assert sorted(deletions) == sorted(f"dir{d}" for d in range(1, 100, 2)), deletions
+    assert all(item.action == CHANGE for item in plan if item.action != DELETE)
+    print(f"Planned 25000 source files against 50000 target files in {elapsed:.2f} s")
+
+print("Mirror tests passed")
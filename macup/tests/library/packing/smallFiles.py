@@ -0,0 +1,94 @@
+"""
+Backs up a tree of many small files and a few large ones with the MIRROR and PACKED storage formats, comparing the
+times and how many files each writes to the target, then restores the packed backup and checks it matches the source.
+A second run should skip everything, and a changed file should be packed again and restored with its new contents.
+"""
+
+import filecmp
+import os
+import tempfile
+import time
+
+from macup.library.backup import backup
+from macup.library.constants import *
+from macup.library.copyengine import COPIED, SKIPPED
+from macup.library.packing import PackReader, SMALL_FILE_THRESHOLD
+
+SMALL_FILES = 5000
+DIRECTORIES = 50
+
+
+def makeTree(root):
+    for d in range(DIRECTORIES):
+        directory = os.path.join(root, f"dir{d}")
+        os.makedirs(directory)
+        for f in range(SMALL_FILES // DIRECTORIES):
+            with open(os.path.join(directory, f"file{f}.txt"), "wb") as file:
+                file.write(os.urandom(100 + (d * f) % 4000))
+    os.makedirs(os.path.join(root, "empty"))
+    with open(os.path.join(root, "big.bin"), "wb") as file:
+        file.write(os.urandom(4 * SMALL_FILE_THRESHOLD))
+
+
+def countFiles(root):
+    return sum(len(files) for _, _, files in os.walk(root))
+
+
+def compareTrees(a, b):
+    comparison = filecmp.dircmp(a, b)
+    stack = [comparison]
+    while stack:
+        comparison = stack.pop()
+        assert not comparison.left_only and not comparison.right_only, (comparison.left_only, comparison.right_only)
+        _, mismatch, errors = filecmp.cmpfiles(comparison.left, comparison.right, comparison.common_files,
+                                               shallow=False)
+        assert not mismatch and not errors, (mismatch, errors)
+        stack.extend(comparison.subdirs.values())
+
+
+with tempfile.TemporaryDirectory() as root:
+    source = os.path.join(root, "source")
+    makeTree(source)
+
+    for storage in (MIRROR, PACKED):
+        target = os.path.join(root, storage.lower())
+        os.makedirs(target)
+        start = time.perf_counter()
+        report = backup(source, target, [], UPDATE, storage=storage)
+        elapsed = time.perf_counter() - start
+        assert report.succeeded, report.failures
+        print(f"{storage}: {elapsed:.2f}s, {countFiles(target)} files in the target, {report}")
+
+    packed = os.path.join(root, "packed")
+    assert os.path.isfile(os.path.join(packed, "big.bin"))
+    assert not os.path.exists(os.path.join(packed, "dir0")), "Folders of packed files shouldn't be built"
+
+    restored = os.path.join(root, "restored")
+    with PackReader(packed) as reader:
+        assert reader.read(os.path.join("dir3", "file7.txt")) == \
+            open(os.path.join(source, "dir3", "file7.txt"), "rb").read()
+        assert reader.restore(restored) == SMALL_FILES
+    os.link(os.path.join(packed, "big.bin"), os.path.join(restored, "big.bin"))
+    compareTrees(source, restored)
+    assert os.path.isdir(os.path.join(restored, "empty"))
+    assert os.stat(os.path.join(restored, "dir1", "file1.txt")).st_mtime_ns == \
+        os.stat(os.path.join(source, "dir1", "file1.txt")).st_mtime_ns
+
+    # Nothing has changed, so nothing is packed again
+    report = backup(source, packed, [], UPDATE, storage=PACKED)
+    assert report.counts[COPIED] == 0 and report.counts[SKIPPED] == SMALL_FILES + 1, report
+
+    changed = os.path.join(source, "dir2", "file5.txt")
+    with open(changed, "wb") as file:
+        file.write(b"new contents")
+    report = backup(source, packed, [], UPDATE, storage=PACKED)
+    assert report.counts[COPIED] == 1, report
+
+    # Only that folder is restored
+    restored_again = os.path.join(root, "restored again")
+    with PackReader(packed) as reader:
+        assert reader.restore(restored_again, "dir2" + os.sep) == SMALL_FILES // DIRECTORIES
+    assert os.listdir(restored_again) == ["dir2"]
+    assert open(os.path.join(restored_again, "dir2", "file5.txt"), "rb").read() == b"new contents"
+
+print("Packing tests passed")
@@ -0,0 +1,83 @@
+"""
+Scans a synthetic tree through a scan index twice, changing one directory in between, and checks both scans match a
+plain scan. Timings of the first (full) and second (incremental) scans are printed. A third scan stats every item it
+yields, which the index answers without stat'ing any file, with the same sizes and times as the disk.
+"""
+
+import os
+import tempfile
+import time
+
+from macup.library.scanindex import ScanIndex, indexedScanTree, verifyIndex
+from macup.library.scanner import scanTree
+
+WIDTH = 10
+FILES_PER_DIR = 200
+
+
+def ageDirectories(root):
+    # Listings of directories modified in the last couple of seconds aren't trusted, so backdate them
+    old = time.time() - 60
+    for directory, _, _ in os.walk(root):
+        os.utime(directory, (old, old))
+
+
+def scanPaths(root, index_path):
+    start = time.perf_counter()
+    with ScanIndex(index_path) as index:
+        paths = {entry.path for entry in indexedScanTree(root, index)}
+    return paths, time.perf_counter() - start
+
+
+with tempfile.TemporaryDirectory() as tmp:
+    source = os.path.join(tmp, "source")
+    index_file = os.path.join(tmp, "index.sqlite")
+    for i in range(WIDTH):
+        for j in range(WIDTH):
+            directory = os.path.join(source, f"dir{i}", f"sub{j}")
+            os.makedirs(directory)
+            for k in range(FILES_PER_DIR):
+                open(os.path.join(directory, f"file{k}"), "w").close()
+    ageDirectories(source)
+
+    first, first_time = scanPaths(source, index_file)
+    assert first == {entry.path for entry in scanTree(source)}
+    print(f"First scan: {len(first)} items in {first_time:.3f}s")
+
+    # Change one directory: add a file and remove a subtree
+    open(os.path.join(source, "dir3", "sub4", "new file"), "w").close()
+    for name in os.listdir(os.path.join(source, "dir5", "sub1")):
+        os.remove(os.path.join(source, "dir5", "sub1", name))
+    os.rmdir(os.path.join(source, "dir5", "sub1"))
+    ageDirectories(source)
+
+    second, second_time = scanPaths(source, index_file)
+    assert second == {entry.path for entry in scanTree(source)}
+    print(f"Second scan: {len(second)} items in {second_time:.3f}s")
+
+    print("Verify:", verifyIndex(source, index_file) or "consistent")
+
+    stat_calls = []
+    original_stat = os.stat
+
+    def countingStat(path, *args, **kwargs):
+        stat_calls.append(path)
+        return original_stat(path, *args, **kwargs)
+
+    os.stat = countingStat
+    try:
+        start = time.perf_counter()
+        with ScanIndex(index_file) as index:
+            stats = {entry.path: entry.stat() for entry in indexedScanTree(source, index)}
+        third_time = time.perf_counter() - start
+    finally:
+        os.stat = original_stat
+    print(f"Third scan, with stat(): {len(stats)} items in {third_time:.3f}s, {len(stat_calls)} stat calls")
+    # Only the directories are stat'ed, to check their listings are current
+    assert not [path for path in stat_calls if not os.path.isdir(path)], stat_calls[:5]
+    for path, indexed_stat in list(stats.items())[::97]:
+        disk_stat = os.stat(path)
+        assert (indexed_stat.st_size, indexed_stat.st_mtime_ns, indexed_stat.st_mode, indexed_stat.st_ino) == \
+            (disk_stat.st_size, disk_stat.st_mtime_ns, disk_stat.st_mode, disk_stat.st_ino), path
+        # A field the index doesn't store comes from the disk
+        assert indexed_stat.st_nlink == disk_stat.st_nlink
@@ -0,0 +1,57 @@
+"""
+Compares the serial FileTree path with the parallel scanner on a synthetic deep/wide tree, checking that both produce
+the same items. Pass a directory as the first argument to benchmark a real (e.g. network) volume instead.
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+from macup.library.backup import getAll
+from macup.library.classes import FileTree, Filter
+from macup.library.constants import *
+from macup.library.filter import buildFilter
+from macup.library.scanner import scanTree
+
+WIDTH = 6
+DEPTH = 4
+FILES_PER_DIR = 5
+
+
+def buildSyntheticTree(root, depth=DEPTH):
+    for i in range(FILES_PER_DIR):
+        open(os.path.join(root, f"file{i}.txt"), "w").close()
+    if depth:
+        for i in range(WIDTH):
+            child = os.path.join(root, f"dir{i}")
+            os.mkdir(child)
+            buildSyntheticTree(child, depth - 1)
+
+
+def timeIt(func):
+    start = time.perf_counter()
+    result = func()
+    return result, time.perf_counter() - start
+
+
+def main(root):
+    filter_ = buildFilter([Filter("no file0", KEYWORD, "file0", FILENAMES, FILES, False)])
+
+    serial, serial_time = timeIt(lambda: {ft.path for type_ in (DIRECTORY, FILES)
+                                          for ft in getAll(type_, FileTree(root, filter_))})
+    print(f"Serial FileTree: {len(serial)} items in {serial_time:.3f}s")
+
+    for workers in (2, 4, 8, 16):
+        parallel, parallel_time = timeIt(lambda: {entry.path for entry in scanTree(root, filter_, workers)})
+        assert parallel == serial, "Parallel scan produced a different set of items"
+        print(f"Parallel scanner, {workers} workers: {len(parallel)} items in {parallel_time:.3f}s")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        main(os.path.abspath(sys.argv[1]))
+    else:
+        with tempfile.TemporaryDirectory() as tmp:
+            buildSyntheticTree(tmp)
+            main(tmp)
@@ -0,0 +1,89 @@
+"""
+Checks that scanAhead yields the scan's entries in order while only getting a bounded way ahead of a slow consumer,
+that an exception from the scan reaches the consumer, and that stopping early stops the scan. Then times a backup of
+a tree of small files, printing how soon the first file was copied.
+"""
+
+import os
+import tempfile
+import threading
+import time
+
+from macup.library.backup import backup
+from macup.library.constants import *
+from macup.library.copyengine import COPIED
+from macup.library.scanner import scanAhead
+
+produced = 0
+closed = threading.Event()
+
+
+def counting(count):
+    global produced
+    try:
+        for i in range(count):
+            produced += 1
+            yield i
+    finally:
+        closed.set()
+
+
+# In order, and never far ahead of a consumer that takes its time
+furthest_ahead = 0
+consumed = 0
+for i in scanAhead(counting(100000), max_ahead=4096):
+    assert i == consumed
+    consumed += 1
+    if consumed % 5000 == 0:
+        time.sleep(0.05)
+        furthest_ahead = max(furthest_ahead, produced - consumed)
+assert consumed == 100000
+assert furthest_ahead <= 4096 + 2 * 256, furthest_ahead
+print(f"At most {furthest_ahead} entries ahead")
+
+
+def failing():
+    yield 1
+    raise PermissionError("can't list")
+
+
+try:
+    list(scanAhead(failing()))
+except PermissionError:
+    pass
+else:
+    raise AssertionError("the scan's exception wasn't raised")
+
+# Stopping early closes the scan on its own thread
+closed.clear()
+threads = threading.active_count()
+entries = scanAhead(counting(10 ** 9))
+next(entries)
+entries.close()
+assert closed.is_set() and threading.active_count() == threads
+
+with tempfile.TemporaryDirectory() as root:
+    source = os.path.join(root, "source")
+    for d in range(200):
+        directory = os.path.join(source, f"dir{d}")
+        os.makedirs(directory)
+        for f in range(50):
+            with open(os.path.join(directory, f"file{f}.txt"), "wb") as file:
+                file.write(os.urandom(4096))
+
+    first_copied = []
+
+    def progress(path, copied, size):
+        if not first_copied:
+            first_copied.append(time.perf_counter())
+
+    target = os.path.join(root, "target")
+    os.makedirs(target)
+    start = time.perf_counter()
+    report = backup(source, target, [], OVERWRITE, progress=progress)
+    elapsed = time.perf_counter() - start
+    assert report.succeeded and report.counts[COPIED] == 10000, report
+    print(f"10000 files backed up in {elapsed:.2f} s, the first copied after {first_copied[0] - start:.3f} s")
+    assert first_copied[0] - start < elapsed / 10
+
+print("scanAhead tests passed")
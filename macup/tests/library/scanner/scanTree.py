@@ -0,0 +1,8 @@
+import os
+
+from macup.library.scanner import scanTree
+
+test_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), "TestDir")
+
+for entry in scanTree(test_dir):
+    print(entry.path, entry.is_dir())
@@ -0,0 +1,137 @@
+"""
+Takes snapshots of a source as it changes, checking that each is a complete copy of the source as it was, that
+unchanged files are hard links to the previous snapshot's rather than new copies, and that earlier snapshots keep
+the old versions, even when an interrupted snapshot that already links to them is carried on with. Prints how long
+each snapshot took and how much new space it used.
+"""
+
+import filecmp
+import os
+import tempfile
+import time
+
+from macup.library.backup import backup
+from macup.library.constants import *
+from macup.library.copyengine import COPIED, LINKED, SKIPPED
+from macup.library.snapshots import INCOMPLETE_SUFFIX, SnapshotFolder, listSnapshots
+
+FILES = 2000
+
+
+def makeSource(root):
+    for d in range(20):
+        os.makedirs(os.path.join(root, f"dir{d}"))
+        for f in range(FILES // 20):
+            with open(os.path.join(root, f"dir{d}", f"file{f}"), "wb") as file:
+                file.write(os.urandom(1000 + f * 100))
+
+
+def compareTrees(a, b):
+    stack = [filecmp.dircmp(a, b)]
+    while stack:
+        comparison = stack.pop()
+        assert not comparison.left_only and not comparison.right_only, (comparison.left_only, comparison.right_only)
+        _, mismatch, errors = filecmp.cmpfiles(comparison.left, comparison.right, comparison.common_files,
+                                               shallow=False)
+        assert not mismatch and not errors, (mismatch, errors)
+        stack.extend(comparison.subdirs.values())
+
+
+def newSpace(snapshot, seen_inodes):
+    """ The bytes of the files in a snapshot that no earlier snapshot shares """
+    size = 0
+    for directory, _, files in os.walk(snapshot):
+        for name in files:
+            stat = os.stat(os.path.join(directory, name))
+            if stat.st_ino not in seen_inodes:
+                seen_inodes.add(stat.st_ino)
+                size += stat.st_size
+    return size
+
+
+def snapshot(source, target, copy_mode=UPDATE):
+    start = time.perf_counter()
+    report = backup(source, target, [], copy_mode, storage=SNAPSHOTS)
+    elapsed = time.perf_counter() - start
+    assert report.succeeded, report.failures
+    return report, elapsed
+
+
+with tempfile.TemporaryDirectory() as root:
+    source = os.path.join(root, "source")
+    target = os.path.join(root, "target")
+    os.makedirs(target)
+    makeSource(source)
+    seen_inodes = set()
+
+    report, elapsed = snapshot(source, target)
+    assert report.counts[COPIED] == FILES, report
+    first = os.path.join(target, listSnapshots(target)[0])
+    compareTrees(source, first)
+    print(f"First snapshot: {elapsed:.2f}s, {newSpace(first, seen_inodes)} bytes")
+
+    changed = os.path.join(source, "dir3", "file5")
+    original = open(changed, "rb").read()
+    with open(changed, "wb") as f:
+        f.write(b"changed")
+    os.remove(os.path.join(source, "dir4", "file6"))
+    with open(os.path.join(source, "dir4", "new"), "wb") as f:
+        f.write(b"new")
+
+    report, elapsed = snapshot(source, target)
+    assert report.counts[COPIED] == 2 and report.counts[LINKED] == FILES - 2, report
+    second = os.path.join(target, listSnapshots(target)[1])
+    compareTrees(source, second)
+    space = newSpace(second, seen_inodes)
+    assert space == len(b"changed") + len(b"new"), space
+    print(f"Second snapshot: {elapsed:.2f}s, {space} bytes, {report}")
+
+    # The first snapshot still has the source as it was
+    assert open(os.path.join(first, "dir3", "file5"), "rb").read() == original
+    assert os.path.isfile(os.path.join(first, "dir4", "file6"))
+    assert os.stat(os.path.join(first, "dir0", "file0")).st_ino == os.stat(os.path.join(second, "dir0", "file0")).st_ino
+
+    # A touched file has a new modification time, so UPDATE copies it, but CHECKSUM finds the same contents
+    touched = os.path.join(source, "dir0", "file1")
+    os.utime(touched, (time.time() + 100, time.time() + 100))
+    report, _ = snapshot(source, target, CHECKSUM)
+    assert report.counts[COPIED] == 0 and report.counts[LINKED] == FILES, report
+    report, _ = snapshot(source, target, UPDATE)
+    assert report.counts[COPIED] == 1, report
+
+    # OVERWRITE makes a full copy
+    report, _ = snapshot(source, target, OVERWRITE)
+    assert report.counts[COPIED] == FILES and report.counts[LINKED] == 0, report
+
+    # An interrupted snapshot isn't linked from, but carried on with by the next backup
+    try:
+        with SnapshotFolder(target) as folder:
+            os.makedirs(os.path.join(folder.path, "dir0"))
+            os.link(os.path.join(target, listSnapshots(target)[-1], "dir0", "file0"),
+                    os.path.join(folder.path, "dir0", "file0"))
+            raise KeyboardInterrupt()
+    except KeyboardInterrupt:
+        pass
+    count = len(listSnapshots(target))
+    report, _ = snapshot(source, target)
+    assert report.counts[LINKED] == FILES - 1 and report.counts[SKIPPED] == 1, report
+    assert len(listSnapshots(target)) == count + 1
+    assert not any(name.endswith(INCOMPLETE_SUFFIX) for name in os.listdir(target))
+    compareTrees(source, os.path.join(target, listSnapshots(target)[-1]))
+
+    # Carrying on with an interrupted snapshot whose files are already linked to the previous one: a file that has
+    # changed since is copied to a new file, leaving the previous snapshot's copy as it was
+    *_, previous, latest = listSnapshots(target)
+    os.rename(os.path.join(target, latest), os.path.join(target, latest + INCOMPLETE_SUFFIX))
+    edited = os.path.join("dir1", "file2")
+    before = open(os.path.join(target, previous, edited), "rb").read()
+    with open(os.path.join(source, edited), "wb") as f:
+        f.write(b"VERSION TWO")
+    report, _ = snapshot(source, target)
+    assert report.counts[COPIED] == 1, report
+    assert open(os.path.join(target, previous, edited), "rb").read() == before
+    assert open(os.path.join(target, latest, edited), "rb").read() == b"VERSION TWO"
+    compareTrees(source, os.path.join(target, latest))
+    print(f"Snapshots: {listSnapshots(target)}")
+
+print("Snapshot tests passed")
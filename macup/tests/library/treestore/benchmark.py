@@ -0,0 +1,85 @@
+"""
+Compares the peak memory of scanning and planning a backup with FileTree objects against a TreeStore, on two synthetic
+trees: one whose file names recur in every folder, as in real sources, and one where every name is unique, so none can
+be interned. Pass a directory as the first argument to measure a real source instead.
+"""
+
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from macup.library.backup import getAll
+from macup.library.classes import FileTree
+from macup.library.constants import *
+from macup.library.treestore import TreeStore
+
+WIDTH = 20
+DEPTH = 2
+FILES_PER_DIR = 100
+EXPECTED_REDUCTION = 10  # On the tree with recurring names
+
+
+def buildSyntheticTree(root, depth=DEPTH, prefix=None):
+    """ :param prefix: If given, it is put in front of every name below root, so that no two names are the same """
+    tag = "" if prefix is None else f"{prefix}_"
+    for i in range(FILES_PER_DIR):
+        open(os.path.join(root, f"document_{tag}{i:04}.txt"), "w").close()
+    if depth:
+        for i in range(WIDTH):
+            child = os.path.join(root, f"folder_{tag}{i:02}")
+            os.mkdir(child)
+            buildSyntheticTree(child, depth - 1, None if prefix is None else f"{prefix}{i:02}")
+
+
+def measure(func):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, peak, elapsed
+
+
+def planWithFileTree(root):
+    # As backup used to: build the tree, then gather the directory and file paths to create and copy
+    tree = FileTree(root)
+    dir_paths = [dir_filetree.path for dir_filetree in getAll(DIRECTORY, tree)]
+    file_paths = [file_filetree.path for file_filetree in getAll(FILES, tree)]
+    return tree, dir_paths, file_paths
+
+
+def planWithTreeStore(root):
+    store = TreeStore.fromScan(root)
+    return store, store.totals()
+
+
+def main(root):
+    (tree, dir_paths, file_paths), tree_peak, tree_time = measure(lambda: planWithFileTree(root))
+    item_count = len(dir_paths) + len(file_paths)
+    del tree
+    (store, totals), store_peak, store_time = measure(lambda: planWithTreeStore(root))
+    assert len(store) == item_count
+    assert set(store.paths(DIRECTORY)) == set(dir_paths) and set(store.paths(FILES)) == set(file_paths)
+
+    print(f"{item_count} items")
+    print(f"FileTree:  peak {tree_peak / 2 ** 20:.1f} MiB ({tree_peak / item_count:.0f} B/item) in {tree_time:.2f}s")
+    print(f"TreeStore: peak {store_peak / 2 ** 20:.1f} MiB ({store_peak / item_count:.0f} B/item) in {store_time:.2f}s")
+    print(f"Reduction: {tree_peak / store_peak:.1f}x")
+    return tree_peak / store_peak
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        main(os.path.abspath(sys.argv[1]))
+    else:
+        with tempfile.TemporaryDirectory() as tmp:
+            print("Recurring names:")
+            buildSyntheticTree(tmp)
+            assert main(tmp) >= EXPECTED_REDUCTION
+        with tempfile.TemporaryDirectory() as tmp:
+            print("\nUnique names:")
+            buildSyntheticTree(tmp, prefix="r")
+            main(tmp)
@@ -129,9 +129,48 @@ class Ui_MainWindow(object):
         self.verticalLayout_8.addLayout(self.verticalLayout_4)
         self.verticalLayout_5 = QtWidgets.QVBoxLayout()
         self.verticalLayout_5.setObjectName("verticalLayout_5")
-        self.overwrite_check = QtWidgets.QCheckBox(self.centralwidget)
-        self.overwrite_check.setObjectName("overwrite_check")
-        self.verticalLayout_5.addWidget(self.overwrite_check)
+        self.copymode_label = QtWidgets.QLabel(self.centralwidget)
+        self.copymode_label.setObjectName("copymode_label")
+        self.verticalLayout_5.addWidget(self.copymode_label)
+        self.copymode_combobox = QtWidgets.QComboBox(self.centralwidget)
+        self.copymode_combobox.setObjectName("copymode_combobox")
+        self.copymode_combobox.addItem("")
+        self.copymode_combobox.addItem("")
+        self.copymode_combobox.addItem("")
+        self.copymode_combobox.addItem("")
+        self.verticalLayout_5.addWidget(self.copymode_combobox)
+        self.fattolerance_check = QtWidgets.QCheckBox(self.centralwidget)
+        self.fattolerance_check.setObjectName("fattolerance_check")
+        self.verticalLayout_5.addWidget(self.fattolerance_check)
+        self.storage_label = QtWidgets.QLabel(self.centralwidget)
+        self.storage_label.setObjectName("storage_label")
+        self.verticalLayout_5.addWidget(self.storage_label)
+        self.storage_combobox = QtWidgets.QComboBox(self.centralwidget)
+        self.storage_combobox.setObjectName("storage_combobox")
+        self.storage_combobox.addItem("")
+        self.storage_combobox.addItem("")
+        self.storage_combobox.addItem("")
+        self.storage_combobox.addItem("")
+        self.verticalLayout_5.addWidget(self.storage_combobox)
+        self.compression_label = QtWidgets.QLabel(self.centralwidget)
+        self.compression_label.setObjectName("compression_label")
+        self.verticalLayout_5.addWidget(self.compression_label)
+        self.compression_combobox = QtWidgets.QComboBox(self.centralwidget)
+        self.compression_combobox.setObjectName("compression_combobox")
+        self.compression_combobox.addItem("")
+        self.compression_combobox.addItem("")
+        self.compression_combobox.addItem("")
+        self.compression_combobox.addItem("")
+        self.verticalLayout_5.addWidget(self.compression_combobox)
+        self.delta_check = QtWidgets.QCheckBox(self.centralwidget)
+        self.delta_check.setObjectName("delta_check")
+        self.verticalLayout_5.addWidget(self.delta_check)
+        self.deletestale_check = QtWidgets.QCheckBox(self.centralwidget)
+        self.deletestale_check.setObjectName("deletestale_check")
+        self.verticalLayout_5.addWidget(self.deletestale_check)
+        self.parallelscan_check = QtWidgets.QCheckBox(self.centralwidget)
+        self.parallelscan_check.setObjectName("parallelscan_check")
+        self.verticalLayout_5.addWidget(self.parallelscan_check)
         self.line = QtWidgets.QFrame(self.centralwidget)
         self.line.setFrameShape(QtWidgets.QFrame.Shape.HLine)
         self.line.setFrameShadow(QtWidgets.QFrame.Shadow.Sunken)
@@ -188,7 +227,31 @@ class Ui_MainWindow(object):
         self.testfilter_label.setText(_translate("MainWindow", "Test filter:"))
         self.testfilter_btn.setText(_translate("MainWindow", "Select..."))
         self.testfilteroutput_label.setText(_translate("MainWindow", "Nothing selected."))
-        self.overwrite_check.setStatusTip(_translate("MainWindow", "Overwrite files that already exist during the backup."))
-        self.overwrite_check.setText(_translate("MainWindow", "Overwrite already existing files?"))
+        self.copymode_label.setText(_translate("MainWindow", "Files that already exist in the target:"))
+        self.copymode_combobox.setStatusTip(_translate("MainWindow", "What to do with files that already exist during the backup."))
+        self.copymode_combobox.setItemText(0, _translate("MainWindow", "Skip them"))
+        self.copymode_combobox.setItemText(1, _translate("MainWindow", "Overwrite them"))
+        self.copymode_combobox.setItemText(2, _translate("MainWindow", "Update them if their size or modification time changed"))
+        self.copymode_combobox.setItemText(3, _translate("MainWindow", "Update them if their contents changed (slower)"))
+        self.fattolerance_check.setStatusTip(_translate("MainWindow", "Treat modification times up to 2 seconds apart as the same, as FAT and exFAT drives store them in 2 second steps."))
+        self.fattolerance_check.setText(_translate("MainWindow", "Target is a FAT or exFAT drive?"))
+        self.storage_label.setText(_translate("MainWindow", "Store files in the target:"))
+        self.storage_combobox.setStatusTip(_translate("MainWindow", "How files are laid out in the target directory."))
+        self.storage_combobox.setItemText(0, _translate("MainWindow", "As they are"))
+        self.storage_combobox.setItemText(1, _translate("MainWindow", "Pack small files into archives (faster for many small files)"))
+        self.storage_combobox.setItemText(2, _translate("MainWindow", "Deduplicate, keeping every backup (saves space when files repeat)"))
+        self.storage_combobox.setItemText(3, _translate("MainWindow", "Dated snapshots, hard-linking unchanged files"))
+        self.compression_label.setText(_translate("MainWindow", "Compress copied files:"))
+        self.compression_combobox.setStatusTip(_translate("MainWindow", "Compress files as they are copied; files that wouldn't shrink are copied as they are."))
+        self.compression_combobox.setItemText(0, _translate("MainWindow", "No"))
+        self.compression_combobox.setItemText(1, _translate("MainWindow", "gzip (fast)"))
+        self.compression_combobox.setItemText(2, _translate("MainWindow", "xz (smallest, slow)"))
+        self.compression_combobox.setItemText(3, _translate("MainWindow", "bzip2"))
+        self.delta_check.setStatusTip(_translate("MainWindow", "When a large file has changed, write only the parts of it that differ over its copy in the target, rather than the whole file."))
+        self.delta_check.setText(_translate("MainWindow", "Only write the changed parts of large files?"))
+        self.deletestale_check.setStatusTip(_translate("MainWindow", "Make the target an exact mirror of the source, deleting files and folders that are no longer in the source or are now filtered out."))
+        self.deletestale_check.setText(_translate("MainWindow", "Delete items from the target that aren't in the source?"))
+        self.parallelscan_check.setStatusTip(_translate("MainWindow", "List several of the source's folders at the same time, which is faster on external disks and network volumes."))
+        self.parallelscan_check.setText(_translate("MainWindow", "Source is a slow or network volume?"))
         self.backup_btn.setStatusTip(_translate("MainWindow", "Start the backup..."))
         self.backup_btn.setText(_translate("MainWindow", "Start Backup"))
@@ -37,6 +37,12 @@ class Ui_modifyfilter(object):
         self.filtertype_combobox.setObjectName("filtertype_combobox")
         self.filtertype_combobox.addItem("")
         self.filtertype_combobox.addItem("")
+        self.filtertype_combobox.addItem("")
+        self.filtertype_combobox.addItem("")
+        self.filtertype_combobox.addItem("")
+        self.filtertype_combobox.addItem("")
+        self.filtertype_combobox.addItem("")
+        self.filtertype_combobox.addItem("")
         self.horizontalLayout_3.addWidget(self.filtertype_combobox)
         self.verticalLayout.addLayout(self.horizontalLayout_3)
         self.horizontalLayout_4 = QtWidgets.QHBoxLayout()
@@ -123,6 +129,12 @@ class Ui_modifyfilter(object):
         self.filtertype_label.setText(_translate("modifyfilter", "Filter type:"))
         self.filtertype_combobox.setItemText(0, _translate("modifyfilter", "Regex"))
         self.filtertype_combobox.setItemText(1, _translate("modifyfilter", "Keyword"))
+        self.filtertype_combobox.setItemText(2, _translate("modifyfilter", "Size greater than"))
+        self.filtertype_combobox.setItemText(3, _translate("modifyfilter", "Size less than"))
+        self.filtertype_combobox.setItemText(4, _translate("modifyfilter", "Modified before"))
+        self.filtertype_combobox.setItemText(5, _translate("modifyfilter", "Modified after"))
+        self.filtertype_combobox.setItemText(6, _translate("modifyfilter", "Older than"))
+        self.filtertype_combobox.setItemText(7, _translate("modifyfilter", "Newer than"))
         self.datalabel.setText(_translate("modifyfilter", "Data:"))
         self.applabel.setText(_translate("modifyfilter", "Apply this filter to:"))
         self.appcombobox.setItemText(0, _translate("modifyfilter", "The entire path of each item"))